@@ -0,0 +1,37 @@
+"""Leest het event journal uit voor analyse achteraf.
+
+    python3 barkr_journal.py                    (alles)
+    python3 barkr_journal.py <device_id> [--since 2026-01-31]
+"""
+import argparse
+from datetime import datetime
+
+import pi_backend as pb
+
+_KINDS = {pb.EV_PING: "PING", pb.EV_WINDOW: "VENSTER", pb.EV_INACTIVITY: "INACTIVITEIT"}
+_WINDOW = {pb.WINDOW_UNMONITORED: "niet bewaakt", pb.WINDOW_ACTIVE: "actief", pb.WINDOW_ALARM: "ALARM"}
+
+
+def describe(kind: int, flag: int, text: str) -> str:
+    if kind == pb.EV_PING:
+        return ("ontgrendeld" if flag & 1 else "vergrendeld") + (f" | {text}" if text else "")
+    if kind == pb.EV_WINDOW:
+        return f"{text} → {_WINDOW.get(flag, flag)}"
+    return text
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("device_id", nargs="?")
+    p.add_argument("--since", help="datum/tijd in ISO-formaat")
+    args = p.parse_args()
+    since = datetime.fromisoformat(args.since).timestamp() if args.since else 0.0
+    for kind, ts, device_id, flag, text in pb.journal.events():
+        if ts < since or (args.device_id and device_id != args.device_id):
+            continue
+        print(f"{datetime.fromtimestamp(ts):%Y-%m-%d %H:%M:%S}  {_KINDS.get(kind, kind):<12} "
+              f"{device_id[:12]:<12} {describe(kind, flag, text)}")
+
+
+if __name__ == "__main__":
+    main()
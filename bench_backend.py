@@ -0,0 +1,378 @@
+"""Belastingstest van de backend met gesimuleerde toestellen.
+
+    python3 bench_backend.py [--devices 100,500,1000] [--duration 150] [--json out.json]
+
+Per aantal toestellen wordt een verse pi_backend.py gestart in een eigen
+tijdelijke HOME. TextMeBot, FCM en de OAuth token-URL wijzen naar een
+lokale stub server, zodat er niets naar buiten gaat. Elk toestel stuurt
+elke 20 s een /heartbeat (willekeurige fase), met een mix van
+vergrendeld/in gebruik en een spreiding van weekplanningen:
+
+  - geen venster
+  - een dagvenster dat niet tijdens de meting afloopt
+  - een venster dat tijdens de meting afloopt, met activiteit (geen alarm)
+  - idem zonder activiteit → moet precies één alarm geven
+
+Gemeten: heartbeat latency (p50/p99), duur van een engine-pass (via
+/admin/stats), alarmvertraging na endTime tot het bericht bij de stub is,
+gemiste/onterechte alarmen en de groei van de database. De resultaten
+per aantal toestellen gaan ook als JSON weg, om versies te vergelijken.
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from bench_ingest import _post, SECRET
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HEARTBEAT_INTERVAL = 20
+PROFILES = (("none", 0.2), ("daytime", 0.5), ("active", 0.15), ("alarm", 0.15))
+
+
+# ============================================================
+#   STUB PROVIDERS
+# ============================================================
+
+class StubProviders(BaseHTTPRequestHandler):
+    """TextMeBot (GET /send.php), FCM (POST /fcm) en OAuth (POST /token)."""
+    messages: list = []   # (ontvangen, recipient, text)
+    fcm_calls: list = []  # ontvangen
+    lock = threading.Lock()
+
+    def _reply(self, status: int, body: dict):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/send.php":
+            return self._reply(404, {})
+        query = parse_qs(url.query)
+        with self.lock:
+            self.messages.append((time.time(), query.get("recipient", [""])[0], query.get("text", [""])[0]))
+        self._reply(200, {"status": "ok"})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/token":
+            return self._reply(200, {"access_token": "stub-token", "expires_in": 3600})
+        if self.path == "/fcm":
+            with self.lock:
+                self.fcm_calls.append(time.time())
+            return self._reply(200, {"name": "projects/stub/messages/1"})
+        self._reply(404, {})
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stubs() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubProviders)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_service_account(path: str) -> bool:
+    """Nep service account zodat de FCM-route meedoet; zonder cryptography geen FCM."""
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+    except ImportError:
+        return False
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption()).decode()
+    with open(path, "w") as f:
+        json.dump({"client_email": "bench@stub", "private_key": pem}, f)
+    return True
+
+
+# ============================================================
+#   GESIMULEERDE TOESTELLEN
+# ============================================================
+
+def _hhmm(moment: datetime) -> str:
+    return moment.strftime("%H:%M")
+
+
+def build_devices(count: int, start: datetime, duration: float, rng: random.Random) -> list:
+    """Maakt toestellen met profiel, weekplanning en contact.
+
+    Vensters die tijdens de meting aflopen beginnen op de hele minuut
+    vóór de start en eindigen op een hele minuut ruim na de eerste ping.
+    """
+    first_end = (start + timedelta(seconds=HEARTBEAT_INTERVAL + 60)).replace(second=0, microsecond=0)
+    last_end = start + timedelta(seconds=duration - 30)
+    ends = []
+    moment = first_end
+    while moment <= last_end:
+        ends.append(moment)
+        moment += timedelta(minutes=1)
+    window_start = _hhmm(start.replace(second=0, microsecond=0) - timedelta(minutes=1))
+    quiet = {(start + timedelta(minutes=m)).strftime("%H:%M") for m in range(-1, int(duration // 60) + 4)}
+
+    devices = []
+    for i in range(count):
+        profile = rng.choices([p for p, _w in PROFILES], [w for _p, w in PROFILES])[0]
+        if profile in ("active", "alarm") and not ends:
+            profile = "daytime"  # meting te kort voor een venstereinde
+        end = None
+        if profile in ("active", "alarm"):
+            end = rng.choice(ends)
+            window = {"startTime": window_start, "endTime": _hhmm(end)}
+        elif profile == "daytime":
+            while True:
+                begin = rng.randrange(6 * 60, 11 * 60)
+                finish = rng.randrange(begin + 60, 23 * 60)
+                if f"{finish // 60:02d}:{finish % 60:02d}" not in quiet:
+                    break
+            window = {"startTime": f"{begin // 60:02d}:{begin % 60:02d}",
+                      "endTime": f"{finish // 60:02d}:{finish % 60:02d}"}
+        else:
+            window = {"startTime": "00:00", "endTime": "00:00"}
+        devices.append({
+            "device_id": f"bench-{i:06d}",
+            "name":      f"Bench {i}",
+            "profile":   profile,
+            "own_phone": f"3169{i:08d}",
+            "contact":   f"3168{i:08d}",
+            "schedules": {str(day): window for day in range(7)},
+            "end_ts":    end.timestamp() if end else None,
+            "unlocked":  {"active": 1.0, "alarm": 0.0}.get(profile, 0.3),
+        })
+    return devices
+
+
+async def _request(conn_holder: list, host: str, port: int, path: str, payload: dict) -> int:
+    """POST over een hergebruikte verbinding; verbindt opnieuw waar nodig."""
+    for _ in range(2):
+        try:
+            if conn_holder[0] is None:
+                conn_holder[0] = await asyncio.open_connection(host, port)
+            status, keep_alive = await _post(*conn_holder[0], host, path, payload)
+            if not keep_alive:
+                conn_holder[0][1].close()
+                conn_holder[0] = None
+            return status
+        except (OSError, IndexError, asyncio.IncompleteReadError):
+            if conn_holder[0] is not None:
+                conn_holder[0][1].close()
+            conn_holder[0] = None
+    return 0
+
+
+async def register(host: str, port: int, devices: list, connections: int = 8):
+    queue: asyncio.Queue = asyncio.Queue()
+    for device in devices:
+        queue.put_nowait(device)
+
+    async def worker():
+        conn = [None]
+        while not queue.empty():
+            device = queue.get_nowait()
+            await _request(conn, host, port, "/save_settings", {
+                "secret": SECRET, "device_id": device["device_id"], "name": device["name"],
+                "ownPhone": device["own_phone"], "schedules": device["schedules"],
+                "contacts": [{"name": "Contact", "phone": device["contact"]}],
+                "vacationMode": False, "notifySelf": True})
+        if conn[0] is not None:
+            conn[0][1].close()
+    await asyncio.gather(*(worker() for _ in range(connections)))
+
+
+async def run_heartbeats(host: str, port: int, devices: list, duration: float, rng: random.Random,
+                         connections: int = 16) -> dict:
+    """Elk toestel pingt elke 20 s; latency per verzoek, achterstand van de zender apart."""
+    start = time.time()
+    heap = [(start + rng.uniform(0, HEARTBEAT_INTERVAL), i) for i in range(len(devices))]
+    heapq.heapify(heap)
+    queue: asyncio.Queue = asyncio.Queue()
+    latencies, errors, behind = [], [], []
+
+    async def sender():
+        conn = [None]
+        while True:
+            planned, device = await queue.get()
+            if device is None:
+                break
+            behind.append(time.time() - planned)
+            t0 = time.perf_counter()
+            status = await _request(conn, host, port, "/heartbeat", {
+                "secret": SECRET, "device_id": device["device_id"], "name": device["name"],
+                "own_phone": device["own_phone"], "source": "bench",
+                "device_status": "unlocked" if rng.random() < device["unlocked"] else "locked"})
+            latencies.append(time.perf_counter() - t0)
+            if status != 200:
+                errors.append(status)
+        if conn[0] is not None:
+            conn[0][1].close()
+
+    senders = [asyncio.create_task(sender()) for _ in range(connections)]
+    while heap and heap[0][0] < start + duration:
+        due, i = heapq.heappop(heap)
+        await asyncio.sleep(max(0.0, due - time.time()))
+        queue.put_nowait((due, devices[i]))
+        heapq.heappush(heap, (due + HEARTBEAT_INTERVAL, i))
+    for _ in senders:
+        queue.put_nowait((0, None))
+    await asyncio.gather(*senders)
+
+    latencies.sort()
+    behind.sort()
+    return {"requests": len(latencies), "errors": len(errors),
+            "p50_ms": _pick(latencies, 0.50), "p99_ms": _pick(latencies, 0.99),
+            "sender_behind_p99_ms": _pick(behind, 0.99)}
+
+
+def _pick(values: list, q: float):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+
+def _stats(host: str, port: int) -> dict:
+    async def fetch():
+        reader, writer = await asyncio.open_connection(host, port)
+        body = json.dumps({"secret": SECRET}).encode()
+        writer.write((f"POST /admin/stats HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                      f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode() + body)
+        raw = await reader.read()
+        writer.close()
+        return json.loads(raw.split(b"\r\n\r\n", 1)[1])
+    return asyncio.run(fetch())
+
+
+# ============================================================
+#   MEETRONDE
+# ============================================================
+
+def _spawn(port: int, stub_url: str, home: str) -> subprocess.Popen:
+    env = dict(os.environ, HOME=home, BARKR_PORT=str(port),
+               BARKR_TEXTMEBOT_URL=f"{stub_url}/send.php", BARKR_FCM_URL=f"{stub_url}/fcm",
+               BARKR_OAUTH_TOKEN_URL=f"{stub_url}/token")
+    log = open(os.path.join(home, "backend.log"), "w")
+    proc = subprocess.Popen([sys.executable, "pi_backend.py"], cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT)
+    for _ in range(100):
+        try:
+            asyncio.run(asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), 1))
+            return proc
+        except (OSError, asyncio.TimeoutError):
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"backend op poort {port} start niet (zie {home}/backend.log)")
+
+
+def run_round(count: int, duration: float, grace: float, port: int, stubs: ThreadingHTTPServer,
+              seed: int) -> dict:
+    rng = random.Random(seed)
+    home = tempfile.mkdtemp(prefix="barkr-bench-")
+    os.makedirs(os.path.join(home, "barkr"))
+    fcm = write_service_account(os.path.join(home, "barkr", "firebase-service-account.json"))
+    with StubProviders.lock:
+        StubProviders.messages.clear()
+        StubProviders.fcm_calls.clear()
+
+    proc = _spawn(port, f"http://127.0.0.1:{stubs.server_address[1]}", home)
+    try:
+        host = "127.0.0.1"
+        t0 = time.perf_counter()
+        start = datetime.now() + timedelta(seconds=5)  # tijd voor registratie
+        devices = build_devices(count, start, duration, rng)
+        asyncio.run(register(host, port, devices))
+        setup_s = time.perf_counter() - t0
+        db_before = _stats(host, port)["db_bytes"]
+
+        heartbeats = asyncio.run(run_heartbeats(host, port, devices, duration, rng))
+        time.sleep(grace)  # laatste alarmen door de outbox laten gaan
+        stats = _stats(host, port)
+    finally:
+        proc.terminate()
+        proc.wait(30)
+
+    with StubProviders.lock:
+        messages = list(StubProviders.messages)
+        fcm_calls = len(StubProviders.fcm_calls)
+    alarms: dict = {}
+    for received, recipient, text in messages:
+        if "BARKR ALARM" in text:
+            alarms.setdefault(recipient, []).append(received)
+    lags, missed, false_alarms, duplicates = [], 0, 0, 0
+    for device in devices:
+        hits = alarms.get(device["contact"], [])
+        duplicates += max(0, len(hits) - 1)
+        if device["profile"] == "alarm":
+            if hits:
+                lags.append(min(hits) - device["end_ts"])
+            else:
+                missed += 1
+        elif hits:
+            false_alarms += 1
+    lags.sort()
+
+    return {
+        "devices":    count,
+        "profiles":   {p: sum(1 for d in devices if d["profile"] == p) for p, _w in PROFILES},
+        "setup_s":    round(setup_s, 2),
+        "heartbeat":  heartbeats,
+        "loop":       stats["loop"],
+        "loop_busy":  stats["loop_busy"],
+        "alarms":     {"expected": sum(1 for d in devices if d["profile"] == "alarm"),
+                       "received": len(lags), "missed": missed, "false": false_alarms,
+                       "duplicates": duplicates,
+                       "lag_p50_s": round(lags[len(lags) // 2], 2) if lags else None,
+                       "lag_max_s": round(lags[-1], 2) if lags else None},
+        "fcm_wakeups": fcm_calls if fcm else None,
+        "db_bytes":   {"after_setup": db_before, "after_run": stats["db_bytes"],
+                       "per_device": round(stats["db_bytes"] / count) if count else 0},
+        "messages":   len(messages),
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--devices", default="100,500,1000", help="kommagescheiden aantallen")
+    p.add_argument("--duration", type=float, default=150, help="seconden heartbeats per ronde")
+    p.add_argument("--grace", type=float, default=20, help="seconden wachten op de laatste alarmen")
+    p.add_argument("--port", type=int, default=5920)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="schrijf resultaten ook als JSON")
+    args = p.parse_args()
+
+    if args.duration < 150:
+        print("let op: korter dan 150 s → geen vensters die tijdens de meting aflopen, dus geen alarmmeting")
+    stubs = start_stubs()
+    rounds = []
+    for count in (int(n) for n in args.devices.split(",")):
+        r = run_round(count, args.duration, args.grace, args.port, stubs, args.seed)
+        rounds.append(r)
+        hb, a = r["heartbeat"], r["alarms"]
+        print(f"{count:>6} toestellen | heartbeat p50 {hb['p50_ms']} ms p99 {hb['p99_ms']} ms "
+              f"({hb['requests']} verzoeken, {hb['errors']} fouten) | "
+              f"engine-pass p99 {r['loop_busy'].get('p99_ms')} ms max {r['loop'].get('max_ms')} ms | "
+              f"alarmen {a['received']}/{a['expected']} lag p50 {a['lag_p50_s']} s max {a['lag_max_s']} s "
+              f"(gemist {a['missed']}, onterecht {a['false']}, dubbel {a['duplicates']}) | "
+              f"db {r['db_bytes']['after_run'] // 1024} KiB")
+    stubs.shutdown()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"started": datetime.now().isoformat(timespec="seconds"),
+                       "duration": args.duration, "seed": args.seed, "rounds": rounds}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Doorvoervergelijking heartbeat ingest: Flask vs asyncio.
+
+    python3 bench_ingest.py [--devices 500] [--connections 64] [--duration 10] [--json out.json]
+
+Start beide servers in een eigen tijdelijke HOME (eigen database), maakt
+eerst alle toestellen aan en stuurt daarna zoveel mogelijk /heartbeat
+POSTs over keep-alive verbindingen. Rapporteert req/s en p50/p99 latency.
+Met --flask-url / --async-url meet je tegen al draaiende servers.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SECRET = "BARKR_SECURE_V1"
+
+
+async def _post(reader, writer, host: str, path: str, payload: dict) -> tuple[int, bool]:
+    """Eén POST; geeft (status, verbinding nog open)."""
+    body = json.dumps(payload).encode()
+    writer.write((f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                  f"Content-Length: {len(body)}\r\n\r\n").encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length, keep_alive = 0, True
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+        elif name.lower() == "connection" and value.strip().lower() == "close":
+            keep_alive = False
+    if length:
+        await reader.readexactly(length)
+    return status, keep_alive
+
+
+def _heartbeat(device: int) -> dict:
+    return {"device_id": f"bench-{device:06d}", "name": f"Bench {device}", "secret": SECRET,
+            "source": "bench", "device_status": random.choice(("locked", "unlocked"))}
+
+
+async def _client(host, port, devices, deadline, latencies, errors):
+    """Eén client; verbindt opnieuw als de server de verbinding sluit
+    (de Flask ontwikkelserver doet geen keep-alive)."""
+    conn = None
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        try:
+            if conn is None:
+                conn = await asyncio.open_connection(host, port)
+            status, keep_alive = await _post(*conn, host, "/heartbeat", _heartbeat(random.randrange(devices)))
+        except (OSError, IndexError, asyncio.IncompleteReadError):
+            status, keep_alive = 0, False
+        latencies.append(time.perf_counter() - t0)
+        if status != 200:
+            errors.append(status)
+        if not keep_alive and conn is not None:
+            conn[1].close()
+            conn = None
+    if conn is not None:
+        conn[1].close()
+
+
+async def _warmup(host, port, devices):
+    """Maakt alle toestellen aan zodat de meting het bekende-toestel pad meet."""
+    for device in range(devices):
+        reader, writer = await asyncio.open_connection(host, port)
+        await _post(reader, writer, host, "/heartbeat", _heartbeat(device))
+        writer.close()
+
+
+async def measure(url: str, devices: int, connections: int, duration: float) -> dict:
+    host, port = url.split("//", 1)[-1].rstrip("/").split(":")
+    port = int(port)
+    await _warmup(host, port, devices)
+    latencies, errors = [], []
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*(_client(host, port, devices, deadline, latencies, errors)
+                           for _ in range(connections)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    pick = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 2) if latencies else None
+    return {"requests": len(latencies), "errors": len(errors), "req_per_s": round(len(latencies) / elapsed, 1),
+            "p50_ms": pick(0.50), "p99_ms": pick(0.99)}
+
+
+def _spawn(args: list, env_extra: dict, check_port: int) -> subprocess.Popen:
+    home = tempfile.mkdtemp(prefix="barkr-bench-")
+    os.makedirs(os.path.join(home, "barkr"), exist_ok=True)
+    env = dict(os.environ, HOME=home, **env_extra)
+    proc = subprocess.Popen([sys.executable] + args, cwd=HERE, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            asyncio.run(asyncio.wait_for(asyncio.open_connection("127.0.0.1", check_port), 1))
+            return proc
+        except (OSError, asyncio.TimeoutError):
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"server op poort {check_port} start niet")
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--devices", type=int, default=500)
+    p.add_argument("--connections", type=int, default=64)
+    p.add_argument("--duration", type=float, default=10)
+    p.add_argument("--flask-url")
+    p.add_argument("--async-url")
+    p.add_argument("--json", help="schrijf resultaten ook als JSON")
+    args = p.parse_args()
+
+    procs = []
+    try:
+        flask_url, async_url = args.flask_url, args.async_url
+        if not flask_url:
+            procs.append(_spawn(["pi_backend.py"], {"BARKR_PORT": "5900"}, 5900))
+            flask_url = "http://127.0.0.1:5900"
+        if not async_url:
+            procs.append(_spawn(["pi_ingest_async.py"], {"BARKR_ASYNC_PORT": "5901"}, 5901))
+            async_url = "http://127.0.0.1:5901"
+
+        results = {}
+        for name, url in (("flask", flask_url), ("asyncio", async_url)):
+            results[name] = asyncio.run(measure(url, args.devices, args.connections, args.duration))
+            r = results[name]
+            print(f"{name:8s} {r['req_per_s']:>9} req/s  p50 {r['p50_ms']} ms  p99 {r['p99_ms']} ms"
+                  f"  ({r['requests']} verzoeken, {r['errors']} fouten)")
+        if results["flask"]["req_per_s"]:
+            print(f"asyncio / flask: {results['asyncio']['req_per_s'] / results['flask']['req_per_s']:.2f}x")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"devices": args.devices, "connections": args.connections,
+                           "duration": args.duration, "results": results}, f, indent=2)
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait(10)
+
+
+if __name__ == "__main__":
+    main()
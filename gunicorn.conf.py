@@ -0,0 +1,31 @@
+# Productieserver voor de Barkr backend
+#
+#   pip install gunicorn
+#   gunicorn -c gunicorn.conf.py
+#
+# Meerdere workers nemen /heartbeat, /ping en de andere endpoints aan.
+# Eén van de workers wordt via een flock gekozen als engine en draait de
+# monitoring loop, outbox en FCM credentials (zie SERVING MODES in
+# pi_backend.py).
+import os
+
+wsgi_app = "pi_backend:app"
+bind = os.environ.get("BARKR_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("BARKR_WORKERS", "4"))
+worker_class = "gthread"
+threads = int(os.environ.get("BARKR_THREADS", "8"))
+keepalive = 30
+timeout = 60
+graceful_timeout = 20
+
+
+def on_starting(server):
+    # Migraties één keer in de master, vóór de workers forken
+    import pi_backend
+    pi_backend.init_db()
+    pi_backend.db_pool.close_all()
+
+
+def post_worker_init(worker):
+    import pi_backend
+    pi_backend.start_worker_services()
@@ -1,13 +1,29 @@
 import os
+import sys
+import socket
+import bisect
+import hashlib
 import json
+import gzip
+import zlib
+import heapq
+import struct
 import sqlite3
 import time
+import atexit
+import signal
 import threading
+import multiprocessing
 import logging
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time as dtime
+from queue import Empty, Full, Queue
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # ============================================================
 #   BARKR BACKEND v10.2
@@ -21,44 +37,594 @@ from datetime import datetime, timedelta
 DB_FILE         = os.path.expanduser("~/barkr/barkr_users.db")
 APP_SECRET      = "BARKR_SECURE_V1"
 TEXTMEBOT_KEY   = "ojtHErzSmwgW"
-TEXTMEBOT_URL   = "https://api.textmebot.com/send.php"
+TEXTMEBOT_URL   = os.environ.get("BARKR_TEXTMEBOT_URL", "https://api.textmebot.com/send.php")
 PING_TIMEOUT    = 120
 INACTIVITY_HOURS = 8  # 8 uur zodat nachtelijke stilte geen melding triggert
 
 # FCM V1 API voor wake-up pings naar Android telefoons
 FCM_PROJECT_ID = "infinite-unity-470121-u7"
 FCM_SERVICE_ACCOUNT_FILE = os.path.expanduser("~/barkr/firebase-service-account.json")
-FCM_URL_V1 = f"https://fcm.googleapis.com/v1/projects/{FCM_PROJECT_ID}/messages:send"
+FCM_URL_V1 = os.environ.get("BARKR_FCM_URL", f"https://fcm.googleapis.com/v1/projects/{FCM_PROJECT_ID}/messages:send")
+FCM_TOKEN_URL = os.environ.get("BARKR_OAUTH_TOKEN_URL", "https://oauth2.googleapis.com/token")
 FCM_WAKEUP_INTERVAL = 900  # 15 minuten
-_fcm_token_cache = {"token": "", "expires": 0}
+FCM_TOKEN_REFRESH_MARGIN = 300  # token 5 minuten voor verlopen verversen
+FCM_KEY_CHECK_INTERVAL = 30     # seconden tussen controles op een gewijzigd sleutelbestand
 DEVELOPER_PHONE = "31615964009"
+HTTP_PORT = int(os.environ.get("BARKR_PORT", "5000"))
 
 app = Flask(__name__)
 CORS(app)
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
-user_states: dict = {}
-_dev_alert_cooldown: dict = {}
+
+# ============================================================
+#   LOGGING
+#
+#   log_status() zet een record alleen in een begrensde wachtrij; één
+#   achtergrondthread schrijft per batch JSON-lines naar
+#   ~/barkr/logs/barkr.jsonl (roteert op grootte, ook met meerdere
+#   gunicorn workers via een flock) en dezelfde regels als tekst naar
+#   stdout. Extra velden (device_id, event, window, source, ...) gaan
+#   mee als keyword arguments. Drukke events zoals PING worden
+#   gesampled: BARKR_LOG_SAMPLE="ping=10" logt 1 op de 10.
+#   BARKR_LOG_CONSOLE=0 zet stdout uit (systemd journal op de SD-kaart).
+# ============================================================
+
+LOG_DIR           = os.path.expanduser("~/barkr/logs")
+LOG_FILE          = os.path.join(LOG_DIR, "barkr.jsonl")
+LOG_MAX_BYTES     = int(os.environ.get("BARKR_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS       = int(os.environ.get("BARKR_LOG_BACKUPS", "5"))
+LOG_QUEUE_SIZE    = 20000   # daarboven vallen records weg i.p.v. de aanroeper te blokkeren
+LOG_BATCH         = 500
+LOG_CONSOLE       = os.environ.get("BARKR_LOG_CONSOLE", "1") != "0"
+LOG_CONSOLE_LEVEL = os.environ.get("BARKR_LOG_CONSOLE_LEVEL", "info")
+LOG_SAMPLE        = {event: int(rate) for event, _, rate in
+                     (item.partition("=") for item in os.environ.get("BARKR_LOG_SAMPLE", "ping=10").split(",") if item)}
+
+_LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+
+def _infer_level(msg: str) -> str:
+    head = msg.lstrip()[:2]
+    if head.startswith("❌"):
+        return "error"
+    if head.startswith("⚠️") or head.startswith("⚠"):
+        return "warning"
+    return "info"
+
+
+class LogPipeline:
+    def __init__(self, path: str, max_bytes: int = LOG_MAX_BYTES, backups: int = LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self._pid = None
+        self._queue: Queue | None = None
+        self._fd = None
+        self._lock_fd = None
+        self._sample_counts: dict = {}
+        self._console_level = _LOG_LEVELS.get(LOG_CONSOLE_LEVEL, 20)
+        self._start_lock = threading.Lock()
+        self._sample_lock = threading.Lock()
+        # Een lock die tijdens de fork vastgehouden werd blijft in het kind dicht
+        os.register_at_fork(after_in_child=self._reset_locks)
+
+    def _reset_locks(self):
+        self._start_lock = threading.Lock()
+        self._sample_lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Per proces: na een fork (gunicorn) bestaat de thread niet meer
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return  # een andere thread was net eerder
+            self._queue = Queue(maxsize=LOG_QUEUE_SIZE)
+            self._fd = self._lock_fd = None
+            threading.Thread(target=self._run, name="log-writer", daemon=True).start()
+            self._pid = os.getpid()  # pas na de queue: anders schrijft een thread in de oude
+
+    def sampled(self, event: str) -> int:
+        """0 = overslaan, anders de samplefactor die dit record vertegenwoordigt."""
+        rate = LOG_SAMPLE.get(event, 1)
+        if rate <= 1:
+            return 1
+        with self._sample_lock:
+            count = self._sample_counts.get(event, 0)
+            self._sample_counts[event] = count + 1
+        return rate if count % rate == 0 else 0
+
+    def emit(self, record: dict):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def _run(self):
+        q = self._queue
+        while True:
+            batch = [q.get()]
+            try:
+                while len(batch) < LOG_BATCH:
+                    batch.append(q.get_nowait())
+            except Empty:
+                pass
+            try:
+                self._write(batch)
+            except Exception as e:
+                sys.stderr.write(f"log-writer fout: {e}\n")
+            for _ in batch:
+                q.task_done()
+
+    def _write(self, batch: list):
+        if LOG_CONSOLE:
+            text = "".join(f"[{r['ts'][11:19]}] {r['msg']}\n" for r in batch
+                           if _LOG_LEVELS.get(r["level"], 20) >= self._console_level)
+            if text:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+        data = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in batch).encode()
+        self._append(data)
+
+    def _append(self, data: bytes):
+        import fcntl
+        if self._lock_fd is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            # Een andere worker kan intussen geroteerd hebben
+            try:
+                current = os.stat(self.path)
+            except FileNotFoundError:
+                current = None
+            if self._fd is not None and (current is None or os.fstat(self._fd).st_ino != current.st_ino):
+                os.close(self._fd)
+                self._fd = None
+            if current is not None and current.st_size and current.st_size + len(data) > self.max_bytes:
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                for i in range(self.backups - 1, 0, -1):
+                    if os.path.exists(f"{self.path}.{i}"):
+                        os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+                os.replace(self.path, f"{self.path}.1")
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self._fd, data)
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def close(self, timeout: float = 5.0):
+        """Bij afsluiten: wachtrij leegschrijven (hooguit `timeout` seconden)."""
+        if self._pid != os.getpid() or self._queue is None:
+            return
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+
+log_pipeline = LogPipeline(LOG_FILE)
+atexit.register(log_pipeline.close)  # als eerste geregistreerd → draait als laatste
+
+
+def log_status(msg: str, event: str = "", level: str | None = None, **fields):
+    """Logt een regel zonder te blokkeren; velden komen in het JSON-record."""
+    sample = log_pipeline.sampled(event) if event else 1
+    if not sample:
+        return
+    record = {"ts": datetime.now().isoformat(timespec="milliseconds"),
+              "level": level or _infer_level(msg), "msg": msg, "pid": os.getpid()}
+    if event:
+        record["event"] = event
+    if sample > 1:
+        record["sample"] = sample
+    record.update(fields)
+    log_pipeline.emit(record)
+
+
+# ============================================================
+#   METRICS
+#
+#   Tellers en histogrammen in het geheugen, als Prometheus tekst op
+#   /metrics (alleen lokaal). Een observatie is een bisect en een paar
+#   optellingen onder één lock per metriek. Cijfers zijn per proces:
+#   onder gunicorn toont /metrics de worker die het verzoek afhandelt,
+#   de engine-cijfers staan alleen in de engine-worker.
+# ============================================================
+
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _metric_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = (f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+             for n, v in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self._lock = threading.Lock()
+        self._values: dict = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"] + \
+               [f"{self.name}{_metric_labels(self.labels, k)} {v:g}" for k, v in values]
+
+
+class _Timer:
+    __slots__ = ("_hist", "_labels", "_start")
+
+    def __init__(self, hist: "Histogram", labels: tuple):
+        self._hist, self._labels = hist, labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._hist.observe(time.perf_counter() - self._start, *self._labels)
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = METRIC_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self._lock = threading.Lock()
+        self._series: dict = {}  # labels → [tellingen per bucket (+Inf), som, aantal]
+
+    def observe(self, value: float, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *label_values) -> _Timer:
+        return _Timer(self, label_values)
+
+    def render(self) -> list:
+        with self._lock:
+            series = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._series.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{_metric_labels(self.labels + ('le',), label_values + (le,))} {cumulative}")
+            labels = _metric_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total:.6f}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge:
+    """Waarde die pas bij het uitlezen wordt opgehaald: fn() → getal of {labels: getal}."""
+
+    def __init__(self, name: str, help_text: str, fn, labels: tuple = ()):
+        self.name, self.help, self.fn, self.labels = name, help_text, fn, labels
+
+    def render(self) -> list:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        values = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"] + \
+               [f"{self.name}{_metric_labels(self.labels, k)} {v:g}" for k, v in values]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Counter:
+        return self._add(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = METRIC_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name: str, help_text: str, fn, labels: tuple = ()) -> Gauge:
+        return self._add(Gauge(name, help_text, fn, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+HTTP_REQUEST_SECONDS = metrics.histogram("barkr_http_request_seconds", "Duur van HTTP verzoeken per endpoint.",
+                                         ("endpoint", "method"))
+HTTP_RESPONSES       = metrics.counter("barkr_http_responses_total", "HTTP antwoorden per endpoint en status.",
+                                       ("endpoint", "status"))
+ENGINE_PASS_SECONDS  = metrics.histogram("barkr_engine_pass_seconds", "Duur van één pass van de monitoring loop.")
+ENGINE_PHASE_SECONDS = metrics.histogram("barkr_engine_phase_seconds", "Duur per fase van de monitoring loop.",
+                                         ("phase",))
+ENGINE_DEADLINES     = metrics.counter("barkr_engine_deadlines_total", "Verwerkte deadlines per soort.", ("kind",))
+DB_ACQUIRE_SECONDS   = metrics.histogram("barkr_db_acquire_seconds",
+                                         "Tijd om een SQLite verbinding te krijgen (incl. openen).")
+DB_HOLD_SECONDS      = metrics.histogram("barkr_db_hold_seconds",
+                                         "Tijd dat een SQLite verbinding uitgeleend is (queries en lock-wachttijd).")
+PROVIDER_SECONDS     = metrics.histogram("barkr_provider_request_seconds", "Duur van uitgaande verzoeken per provider.",
+                                         ("provider",))
+PROVIDER_ERRORS      = metrics.counter("barkr_provider_errors_total",
+                                       "Mislukte uitgaande verzoeken per provider en reden.", ("provider", "reason"))
+metrics.gauge("barkr_log_dropped", "Logrecords weggevallen door een volle wachtrij.", lambda: log_pipeline.dropped)
+
+
+def _process_rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+metrics.gauge("barkr_process_rss_bytes", "Resident geheugen van dit proces.", _process_rss)
+
+
+# ============================================================
+#   STATE STORES
+#
+#   Per-proces toestand (presence, cooldowns) staat in een begrensde
+#   StateStore in plaats van een los dict dat alleen groeit. Records
+#   zijn kleine __slots__ objecten met een tijdstempel `ts`; de store
+#   houdt ze in LRU-volgorde en gooit het oudste weg zodra het er meer
+#   dan max_entries worden of het ouder is dan de ttl. Evict() loopt
+#   alleen over wat echt weg moet. Aantal en geschat geheugen per store
+#   staan in /metrics en /admin/stats.
+# ============================================================
+
+STATE_MAX_DEVICES = int(os.environ.get("BARKR_STATE_MAX", "20000"))
+STATE_TTL         = int(os.environ.get("BARKR_STATE_TTL", str(7 * 24 * 3600)))  # offline toestel vergeten
+ALERT_COOLDOWN    = 3600   # seconden tussen twee developer alerts van dezelfde soort
+
+
+class StateStore:
+    def __init__(self, name: str, max_entries: int, ttl: float):
+        self.name, self.max_entries, self.ttl = name, max_entries, ttl
+        self._lock = threading.Lock()
+        self._data: OrderedDict = OrderedDict()   # key → record, oudste eerst
+        state_stores.append(self)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def put(self, key, record) -> list:
+        """Zet record vooraan als meest recent; geeft de records die
+        voor de grootte moesten wijken."""
+        with self._lock:
+            self._data[key] = record
+            self._data.move_to_end(key)
+            evicted = []
+            while len(self._data) > self.max_entries:
+                evicted.append(self._data.popitem(last=False))
+        if evicted:
+            STATE_EVICTIONS.inc(self.name, "size", amount=len(evicted))
+        return evicted
+
+    def touch(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def evict(self, now: float) -> list:
+        """Verwijdert records ouder dan de ttl, vanaf de oudste kant."""
+        cutoff = now - self.ttl
+        evicted = []
+        with self._lock:
+            while self._data:
+                key, record = next(iter(self._data.items()))
+                if record.ts >= cutoff:
+                    break
+                evicted.append(self._data.popitem(last=False))
+        if evicted:
+            STATE_EVICTIONS.inc(self.name, "ttl", amount=len(evicted))
+        return evicted
+
+    def memory_bytes(self) -> int:
+        """Schatting: de dict zelf plus sleutels, records en hun velden."""
+        with self._lock:
+            items = list(self._data.items())
+        total = sys.getsizeof(self._data)
+        for key, record in items:
+            total += sys.getsizeof(key) + sys.getsizeof(record)
+            for slot in record.__slots__:
+                value = getattr(record, slot, None)
+                if value is not None and not isinstance(value, bool):
+                    total += sys.getsizeof(value)
+        return total
+
+    def stats(self) -> dict:
+        return {"entries": len(self._data), "max": self.max_entries, "bytes": self.memory_bytes()}
+
+
+class _Stamp:
+    __slots__ = ("ts",)
+
+    def __init__(self, ts: float):
+        self.ts = ts
+
+
+state_stores: list = []
+STATE_EVICTIONS = metrics.counter("barkr_state_evictions_total", "Verwijderde records per store en reden.",
+                                  ("store", "reason"))
+metrics.gauge("barkr_state_entries", "Records per state store.",
+              lambda: {(s.name,): len(s) for s in state_stores}, ("store",))
+metrics.gauge("barkr_state_bytes", "Geschat geheugen per state store.",
+              lambda: {(s.name,): s.memory_bytes() for s in state_stores}, ("store",))
+
+_dev_alert_cooldown = StateStore("alert_cooldown", 256, ALERT_COOLDOWN)
+
+
+# ============================================================
+#   TRANSPORT & PROVIDERS
+#
+#   Eén keep-alive sessie per provider zodat niet elk bericht of
+#   elke wake-up een nieuwe TCP+TLS handshake kost. Pool-grootte en
+#   timeout per provider zijn te overschrijven met
+#   BARKR_HTTP_POOL_<NAAM> en BARKR_HTTP_TIMEOUT_<NAAM>. Voor tests
+#   kan een provider vervangen worden via register_provider() of
+#   door de URL's naar een lokale stub server te laten wijzen.
+# ============================================================
+
+HTTP_POOL_SIZE = {"whatsapp": 4, "fcm": 16, "oauth": 1}
+HTTP_TIMEOUT   = {"whatsapp": 15, "fcm": 10, "oauth": 10}
+
+
+class Transport:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: dict = {}
+
+    def session(self, name: str) -> requests.Session:
+        with self._lock:
+            session = self._sessions.get(name)
+            if session is None:
+                size = int(os.environ.get(f"BARKR_HTTP_POOL_{name.upper()}", HTTP_POOL_SIZE.get(name, 4)))
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=False)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[name] = session
+            return session
+
+    def timeout(self, name: str) -> float:
+        return float(os.environ.get(f"BARKR_HTTP_TIMEOUT_{name.upper()}", HTTP_TIMEOUT.get(name, 10)))
+
+    def request(self, name: str, method: str, url: str, **kwargs) -> requests.Response:
+        """Verzoek via de sessie van `name`; latency en fouten gaan naar de metrics."""
+        start = time.perf_counter()
+        try:
+            r = self.session(name).request(method, url, timeout=self.timeout(name), **kwargs)
+        except Exception as e:
+            PROVIDER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            PROVIDER_SECONDS.observe(time.perf_counter() - start, name)
+        if r.status_code != 200:
+            PROVIDER_ERRORS.inc(name, str(r.status_code))
+        return r
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+transport = Transport()
+
+
+class Provider:
+    """Basis voor uitgaande kanalen; `name` bepaalt de transport-sessie."""
+    name = ""
+
+    def send(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+class WhatsAppProvider(Provider):
+    name = "whatsapp"
+
+    def __init__(self, url: str = TEXTMEBOT_URL, apikey: str = TEXTMEBOT_KEY):
+        self.url = url
+        self.apikey = apikey
+
+    def send(self, recipient: str, text: str) -> bool:
+        r = transport.request(self.name, "GET", self.url, params={
+            "recipient": recipient, "apikey": self.apikey, "text": text
+        })
+        return r.status_code == 200
+
+
+class FcmProvider(Provider):
+    name = "fcm"
+
+    def __init__(self, url: str = FCM_URL_V1):
+        self.url = url
+
+    def send(self, fcm_token: str, data: dict, access_token: str) -> requests.Response:
+        payload = {
+            "message": {
+                "token": fcm_token,
+                "data": data,
+                "android": {"priority": "high"}
+            }
+        }
+        return transport.request(self.name, "POST", self.url,
+            headers={
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": "application/json"
+            },
+            json=payload
+        )
+
+
+class DeveloperAlertProvider(Provider):
+    """Stuurt foutmeldingen via het WhatsApp kanaal naar de ontwikkelaar."""
+    name = "developer"
+
+    def __init__(self, phone: str = DEVELOPER_PHONE):
+        self.phone = phone
+
+    def send(self, text: str) -> bool:
+        return get_provider("whatsapp").send(self.phone, text)
 
 
-def log_status(msg: str):
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}", flush=True)
+_providers: dict = {
+    "whatsapp":  WhatsAppProvider(),
+    "fcm":       FcmProvider(),
+    "developer": DeveloperAlertProvider(),
+}
+
+
+def register_provider(name: str, provider: Provider):
+    _providers[name] = provider
+
+
+def get_provider(name: str) -> Provider:
+    return _providers[name]
 
 
 def alert_developer(error_type: str, detail: str):
-    now = datetime.now()
-    last = _dev_alert_cooldown.get(error_type)
-    if last and (now - last).total_seconds() < 3600:
+    """Zet een foutmelding voor de ontwikkelaar in de outbox; nooit HTTP op de aanroepende thread."""
+    now = time.time()
+    _dev_alert_cooldown.evict(now)
+    if _dev_alert_cooldown.get(error_type):
         return
-    _dev_alert_cooldown[error_type] = now
+    _dev_alert_cooldown.put(error_type, _Stamp(now))
     try:
-        requests.get(TEXTMEBOT_URL, params={
-            "recipient": DEVELOPER_PHONE,
-            "apikey": TEXTMEBOT_KEY,
-            "text": f"🔧 BARKR FOUT\n{error_type}\n{detail}"
-        }, timeout=10)
-    except Exception:
-        pass
+        outbox.enqueue(DEVELOPER_PHONE, f"🔧 BARKR FOUT\n{error_type}\n{detail}", context=f"developer:{error_type}",
+                       kind="developer", meta={"label": f"ONTWIKKELAAR GEWAARSCHUWD → {error_type}"})
+    except Exception as e:
+        log_status(f"⚠️ Developer alert niet in outbox ({error_type}): {e}")
 
 
 def normalize_phone(phone: str) -> str:
@@ -73,12 +639,137 @@ def is_valid_phone(phone: str) -> bool:
     return clean.isdigit() and 10 <= len(clean) <= 15
 
 
+# ============================================================
+#   CONNECTION POOL
+#
+#   Verbindingen worden hergebruikt door de Flask request threads en
+#   de engine. PRAGMA's worden één keer per verbinding gezet en de
+#   statement cache van sqlite3 blijft zo warm. Een gedeelde LIFO pool
+#   i.p.v. puur thread-local, omdat de Flask server per request een
+#   nieuwe thread start.
+# ============================================================
+
+DB_POOL_SIZE         = 8
+DB_CACHED_STATEMENTS = 256
+DB_MMAP_SIZE         = 64 * 1024 * 1024
+DB_CACHE_SIZE_KB     = 16 * 1024
+
+
+class _PooledConnection:
+    """Gedraagt zich als sqlite3.Connection; close() geeft hem terug aan de pool."""
+    __slots__ = ("_conn", "_pool", "_since")
+
+    def __init__(self, conn: sqlite3.Connection, pool: "ConnectionPool"):
+        object.__setattr__(self, "_conn", conn)
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_since", time.perf_counter())
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self):
+        conn = self._conn
+        if conn is not None:
+            object.__setattr__(self, "_conn", None)
+            DB_HOLD_SECONDS.observe(time.perf_counter() - self._since)
+            self._pool.release(conn)
+
+
+class ConnectionPool:
+    def __init__(self, path: str, size: int = DB_POOL_SIZE, readonly: bool = False):
+        self.path = path
+        self.size = size
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        self._idle: list = []
+        self.created = 0
+        self.checkouts = 0
+        self.reused = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.overflow_closed = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.readonly:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=10,
+                                   check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+        else:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False,
+                                   cached_statements=DB_CACHED_STATEMENTS)
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        return conn
+
+    def acquire(self) -> _PooledConnection:
+        start = time.perf_counter()
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            conn = self._idle.pop() if self._idle else None
+            if conn is not None:
+                self.reused += 1
+            else:
+                self.created += 1
+        if conn is None:
+            # Geen wachtrij: een lege pool maakt een extra verbinding aan,
+            # die bij teruggave gesloten wordt als de pool vol zit
+            conn = self._connect()
+        DB_ACQUIRE_SECONDS.observe(time.perf_counter() - start)
+        return _PooledConnection(conn, self)
+
+    def release(self, conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = None
+        except sqlite3.Error:
+            conn = None
+        with self._lock:
+            self.in_use -= 1
+            if conn is not None and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+            self.overflow_closed += 1
+        if conn is not None:
+            conn.close()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size, "idle": len(self._idle), "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use, "created": self.created,
+                "checkouts": self.checkouts, "reused": self.reused,
+                "overflow_closed": self.overflow_closed,
+            }
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+db_pool = ConnectionPool(DB_FILE)
+metrics.gauge("barkr_db_connections", "SQLite verbindingen in de pool per toestand.",
+              lambda: {(k,): v for k, v in db_pool.metrics().items() if k in ("idle", "in_use")}, ("state",))
+
+
 def get_db():
-    """Open database met WAL mode en timeout om locking te voorkomen."""
-    conn = sqlite3.connect(DB_FILE, timeout=10)
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA busy_timeout=5000")
-    return conn
+    """Leent een verbinding uit de pool; conn.close() geeft hem terug."""
+    return db_pool.acquire()
 
 def init_db():
     os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
@@ -98,7 +789,15 @@ def init_db():
         notify_self          INTEGER DEFAULT 1,
         last_inactivity_alert TEXT DEFAULT "",
         fcm_token            TEXT DEFAULT "",
-        last_fcm_wakeup      TEXT DEFAULT ""
+        last_fcm_wakeup      TEXT DEFAULT "",
+        schedule_packed      BLOB,
+        last_ping_ts             INTEGER DEFAULT 0,
+        last_unlocked_ts         INTEGER DEFAULT 0,
+        last_fcm_wakeup_ts       INTEGER DEFAULT 0,
+        last_inactivity_alert_ts INTEGER DEFAULT 0,
+        settings_updated_ts      INTEGER DEFAULT 0,
+        window_ping_ts           INTEGER DEFAULT 0,
+        window_unlocked_ts       INTEGER DEFAULT 0
     )''')
 
     # Migratie: voeg nieuwe kolommen toe
@@ -118,6 +817,54 @@ def init_db():
     except Exception:
         pass  # Kolom bestaat al
 
+    # Migratie: weekplanning voorgecompileerd opslaan naast de JSON
+    try:
+        c.execute("ALTER TABLE users ADD COLUMN schedule_packed BLOB")
+        conn.commit()
+    except Exception:
+        pass  # Kolom bestaat al
+    c.execute("SELECT device_id, schedules FROM users WHERE schedule_packed IS NULL")
+    to_compile = c.fetchall()
+    if to_compile:
+        c.executemany("UPDATE users SET schedule_packed=? WHERE device_id=?",
+                      [(compile_schedules(sched), dev) for dev, sched in to_compile])
+        conn.commit()
+        log_status(f"📅 {len(to_compile)} weekplanningen gecompileerd")
+
+    # Migratie: tijdstempels als epoch integers i.p.v. opgemaakte tekst.
+    # De oude TEXT kolommen blijven staan maar worden niet meer bijgewerkt.
+    for ts_col, text_col in [("last_ping_ts", "last_ping_time"),
+                             ("last_unlocked_ts", "last_unlocked_ping"),
+                             ("last_fcm_wakeup_ts", "last_fcm_wakeup"),
+                             ("last_inactivity_alert_ts", "last_inactivity_alert")]:
+        try:
+            c.execute(f"ALTER TABLE users ADD COLUMN {ts_col} INTEGER DEFAULT 0")
+            # Tekst is lokale tijd; 'utc' zet die om naar echte epoch seconden
+            c.execute(f"""UPDATE users SET {ts_col} = COALESCE(CAST(strftime('%s', {text_col}, 'utc') AS INTEGER), 0)
+                          WHERE {text_col} != '' AND {text_col} IS NOT NULL""")
+            conn.commit()
+            log_status(f"🕒 {ts_col} gemigreerd uit {text_col}")
+        except sqlite3.OperationalError:
+            pass  # Kolom bestaat al
+    try:
+        c.execute("ALTER TABLE users ADD COLUMN settings_updated_ts INTEGER DEFAULT 0")
+        conn.commit()
+    except sqlite3.OperationalError:
+        pass  # Kolom bestaat al
+    # Migratie: laatste ping/ontgrendeling binnen het venster van die dag
+    for col in ("window_ping_ts", "window_unlocked_ts"):
+        try:
+            c.execute(f"ALTER TABLE users ADD COLUMN {col} INTEGER DEFAULT 0")
+            conn.commit()
+        except sqlite3.OperationalError:
+            pass  # Kolom bestaat al
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_last_ping ON users(last_ping_ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_settings_updated ON users(settings_updated_ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_fcm_stale ON users(last_ping_ts, last_fcm_wakeup_ts) WHERE fcm_token != ''")
+    # Fallback-zoekpaden van oude APK's (WHERE own_phone=? / user_name=? ORDER BY rowid DESC)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_own_phone ON users(own_phone)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_user_name ON users(user_name)")
+
     # Migratie: voeg device_id kolom toe aan alarm_log
     try:
         c.execute("ALTER TABLE alarm_log ADD COLUMN device_id TEXT DEFAULT ''")
@@ -125,28 +872,39 @@ def init_db():
         c.execute("UPDATE alarm_log SET device_id = own_phone WHERE device_id = '' OR device_id IS NULL")
         conn.commit()
     except Exception:
-        pass  # Kolom bestaat al
+        pass  # Kolom bestaat al (of alarm_log is al gepartitioneerd)
 
-    c.execute('''CREATE TABLE IF NOT EXISTS alarm_log (
-        id           INTEGER PRIMARY KEY AUTOINCREMENT,
-        device_id    TEXT,
-        own_phone    TEXT DEFAULT "",
-        alarm_date   TEXT,
-        window_start TEXT,
-        window_end   TEXT,
-        fired_at     TEXT,
-        UNIQUE(device_id, alarm_date, window_start, window_end)
-    )''')
+    # Alarmen staan per maand in alarm_log_YYYYMM (zie ALARM LOG)
+    migrate_alarm_log(conn)
+    ensure_alarm_partition(c, alarm_partition(datetime.now().strftime("%Y-%m-%d")))
 
     c.execute('''CREATE TABLE IF NOT EXISTS whatsapp_opted_in (
         phone TEXT PRIMARY KEY, opted_in_at TEXT, opted_in_by TEXT
     )''')
 
+    # Uitgaande berichten — verstuurd door de worker pool, niet inline
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox (
+        id           INTEGER PRIMARY KEY AUTOINCREMENT,
+        recipient    TEXT,
+        text         TEXT,
+        context      TEXT DEFAULT "",
+        kind         TEXT DEFAULT "",
+        meta         TEXT DEFAULT "{}",
+        status       TEXT DEFAULT "queued",
+        attempts     INTEGER DEFAULT 0,
+        next_attempt REAL DEFAULT 0,
+        created_at   TEXT,
+        sent_at      TEXT DEFAULT "",
+        last_error   TEXT DEFAULT ""
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt)")
+
     conn.commit()
     conn.close()
     # Automatische cleanup bij opstart
     try:
         conn_clean2 = get_db()
+        changes_before = conn_clean2.total_changes
         c_clean = conn_clean2.cursor()
         # Verwijder records waar device_id = own_phone (oude telefoonnummer records)
         c_clean.execute("DELETE FROM users WHERE device_id = own_phone AND length(device_id) < 20")
@@ -161,8 +919,9 @@ def init_db():
                 CASE WHEN length(device_id) >= 20 THEN device_id ELSE own_phone END
             )
         """)
-        deleted = conn.total_changes
-        conn.commit()
+        deleted = conn_clean2.total_changes - changes_before
+        conn_clean2.commit()
+        conn_clean2.close()
         if deleted > 0:
             log_status(f"🧹 {deleted} vervuilde records verwijderd bij opstart")
     except Exception as e:
@@ -179,15 +938,20 @@ def send_whatsapp(phone: str, message: str, context: str = "") -> bool:
     if not clean:
         return False
     try:
-        r = requests.get(TEXTMEBOT_URL, params={
-            "recipient": clean, "apikey": TEXTMEBOT_KEY, "text": message
-        }, timeout=15)
-        return r.status_code == 200
+        return get_provider("whatsapp").send(clean, message)
     except Exception as e:
         alert_developer("WhatsApp fout", f"{e} | {context}")
         return False
 
 
+def _send_developer_alert(text: str) -> bool:
+    # Geen alert_developer bij een fout: de outbox probeert het later opnieuw
+    try:
+        return get_provider("developer").send(text)
+    except Exception:
+        return False
+
+
 def is_opted_in(phone: str) -> bool:
     clean = normalize_phone(phone)
     conn = get_db()
@@ -208,44 +972,437 @@ def register_opt_in(phone: str, opted_in_by: str):
     conn.close()
 
 
-def get_todays_window(user: dict) -> tuple[str, str]:
-    """Haalt het tijdvenster op uit de weekplanning voor vandaag."""
-    day_idx = datetime.now().weekday()
-    schedules = {}
-    if user.get('schedules'):
+# ============================================================
+#   OUTBOUND QUEUE
+#
+#   Alarmlogica en endpoints zetten berichten alleen in de outbox
+#   tabel. Een pool van workers verstuurt ze, met een minimale tijd
+#   tussen berichten naar hetzelfde nummer, retry met backoff en
+#   een status per bericht (queued/sending/sent/failed).
+# ============================================================
+
+OUTBOX_WORKERS            = int(os.environ.get("BARKR_OUTBOX_WORKERS", "2"))
+OUTBOX_RECIPIENT_SLOTS    = 10000  # bijgehouden ontvangers voor de rate limit
+OUTBOX_CLAIM_PAGE         = 100  # kandidaten per query; niet-klare ontvangers worden overgeslagen
+OUTBOX_RECIPIENT_INTERVAL = 6    # seconden tussen berichten naar één nummer
+OUTBOX_MAX_ATTEMPTS       = 5
+OUTBOX_BACKOFF_BASE       = 30   # seconden, verdubbelt per poging
+
+
+class OutboundQueue:
+    def __init__(self):
+        self._cond = threading.Condition()
+        # recipient → _Stamp(laatste verzending); verloopt na het interval
+        self._last_sent = StateStore("outbox_recipients", OUTBOX_RECIPIENT_SLOTS, OUTBOX_RECIPIENT_INTERVAL)
+        self._in_flight: set = set()
+        self._signals = 0            # telt notify's, zodat een worker er geen mist tussen claim en wait
+
+    def _notify(self):
+        with self._cond:
+            self._signals += 1
+            self._cond.notify()
+
+    def enqueue(self, recipient: str, text: str, context: str = "", kind: str = "",
+                meta: dict | None = None, dedupe: bool = False) -> int | None:
+        clean = normalize_phone(recipient)
+        if not clean:
+            return None
+        conn = get_db()
+        c = conn.cursor()
+        if dedupe:
+            c.execute("SELECT id FROM outbox WHERE recipient=? AND kind=? AND status IN ('queued','sending')",
+                      (clean, kind))
+            row = c.fetchone()
+            if row:
+                conn.close()
+                return row[0]
+        c.execute("INSERT INTO outbox (recipient, text, context, kind, meta, created_at) VALUES (?,?,?,?,?,?)",
+                  (clean, text, context, kind, json.dumps(meta or {}),
+                   datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        msg_id = c.lastrowid
+        conn.commit()
+        conn.close()
+        self._notify()
+        return msg_id
+
+    def recover(self) -> int:
+        """Biedt berichten die bleven hangen in 'sending' opnieuw aan.
+
+        Alleen de engine verstuurt; wie de engine-rol overneemt (ook na een
+        gestorven worker, zonder nieuwe init_db) heeft dus geen lopende
+        verzendingen van een ander proces naast zich.
+        """
+        conn = get_db()
+        with conn:
+            recovered = conn.execute("UPDATE outbox SET status='queued' WHERE status='sending'").rowcount
+        conn.close()
+        if recovered:
+            log_status(f"📤 OUTBOX → {recovered} berichten uit 'sending' opnieuw in de wachtrij")
+        return recovered
+
+    def start(self, workers: int = OUTBOX_WORKERS):
+        self.recover()
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True).start()
+        log_status(f"📤 OUTBOX GESTART → {workers} workers")
+
+    def _claim(self):
+        """Pakt het oudste verzendklare bericht waarvan de ontvanger niet gelimiteerd is.
+
+        Geeft (bericht, wachttijd) terug; wachttijd is de tijd tot het
+        eerstvolgende bericht klaar is als er nu niets te doen is. De
+        queries draaien buiten de lock; alleen het reserveren van de
+        ontvanger gebeurt eronder. Berichten aan een gelimiteerde
+        ontvanger worden per pagina overgeslagen, zodat één drukke
+        ontvanger de rest niet ophoudt.
+        """
+        now = time.time()
+        wait = 5.0
+        cursor = (float("-inf"), 0)
+        self._last_sent.evict(now)
+        conn = get_db()
+        c = conn.cursor()
         try:
-            schedules = json.loads(user['schedules'])
-        except Exception:
-            pass
-    day_sched = schedules.get(str(day_idx), {})
-    return day_sched.get('startTime', '00:00'), day_sched.get('endTime', '00:00')
+            while True:
+                c.execute("""SELECT id, recipient, text, context, kind, meta, attempts, next_attempt
+                             FROM outbox WHERE status='queued' AND next_attempt<=? AND (next_attempt, id) > (?, ?)
+                             ORDER BY next_attempt, id LIMIT ?""", (now, *cursor, OUTBOX_CLAIM_PAGE))
+                rows = c.fetchall()
+                for row in rows:
+                    msg_id, recipient = row[0], row[1]
+                    with self._cond:
+                        if recipient in self._in_flight:
+                            continue
+                        previous = self._last_sent.get(recipient)
+                        if previous and previous.ts + OUTBOX_RECIPIENT_INTERVAL > now:
+                            wait = min(wait, previous.ts + OUTBOX_RECIPIENT_INTERVAL - now)
+                            continue
+                        self._in_flight.add(recipient)
+                        self._last_sent.put(recipient, _Stamp(now))
+                    c.execute("UPDATE outbox SET status='sending', attempts=attempts+1 WHERE id=? AND status='queued'",
+                              (msg_id,))
+                    conn.commit()
+                    if c.rowcount:
+                        return row, 0.0
+                    with self._cond:  # een andere worker of proces was eerder
+                        self._in_flight.discard(recipient)
+                        if previous:
+                            self._last_sent.put(recipient, previous)
+                        else:
+                            self._last_sent.pop(recipient)
+                if len(rows) < OUTBOX_CLAIM_PAGE:
+                    break
+                cursor = (rows[-1][7], rows[-1][0])
+            c.execute("SELECT MIN(next_attempt) FROM outbox WHERE status='queued' AND next_attempt>?", (now,))
+            upcoming = c.fetchone()[0]
+            if upcoming is not None:
+                wait = min(wait, upcoming - now)
+        finally:
+            conn.close()
+        return None, max(0.1, wait)
 
+    def _worker(self):
+        while True:
+            try:
+                with self._cond:
+                    signals = self._signals
+                msg, wait = self._claim()
+                if not msg:
+                    with self._cond:
+                        if self._signals == signals:
+                            self._cond.wait(wait)
+                    continue
+                self._deliver(msg)
+            except Exception as e:
+                log_status(f"⚠️ OUTBOX FOUT: {e}")
+                time.sleep(5)
 
-def alarm_already_fired(device_id_key: str, alarm_date: str, window_start: str, window_end: str) -> bool:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT id FROM alarm_log WHERE device_id=? AND alarm_date=? AND window_start=? AND window_end=?",
-              (device_id_key, alarm_date, window_start, window_end))
-    found = c.fetchone() is not None
-    conn.close()
-    return found
+    def _deliver(self, msg):
+        msg_id, recipient, text, context, kind, meta_json, attempts, _ = msg
+        meta = json.loads(meta_json or "{}")
+        attempts += 1
+        try:
+            if kind == "developer":
+                ok = _send_developer_alert(text)
+            else:
+                ok = send_whatsapp(recipient, text, context=context)
+        finally:
+            with self._cond:
+                self._in_flight.discard(recipient)
+                self._signals += 1
+                self._cond.notify()
+        conn = get_db()
+        if ok:
+            conn.execute("UPDATE outbox SET status='sent', sent_at=?, last_error='' WHERE id=?",
+                         (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), msg_id))
+        elif attempts < OUTBOX_MAX_ATTEMPTS:
+            delay = OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1)
+            conn.execute("UPDATE outbox SET status='queued', next_attempt=?, last_error=? WHERE id=?",
+                         (time.time() + delay, "verzenden mislukt", msg_id))
+        else:
+            conn.execute("UPDATE outbox SET status='failed', last_error=? WHERE id=?",
+                         (f"opgegeven na {attempts} pogingen", msg_id))
+        conn.commit()
+        conn.close()
 
+        label = meta.get('label', f"{kind} → {recipient}")
+        if ok:
+            log_status(f"✅ {label}")
+            self._on_delivered(recipient, kind, meta)
+        elif attempts < OUTBOX_MAX_ATTEMPTS:
+            log_status(f"🔁 {label} | poging {attempts} mislukt, opnieuw over {OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1)}s")
+        else:
+            log_status(f"❌ {label} | opgegeven na {attempts} pogingen")
 
-def mark_alarm_fired(device_id_key: str, alarm_date: str, window_start: str, window_end: str):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO alarm_log (device_id, alarm_date, window_start, window_end, fired_at) VALUES (?,?,?,?,?)",
-              (device_id_key, alarm_date, window_start, window_end, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
+    def _on_delivered(self, recipient: str, kind: str, meta: dict):
+        if kind in ("welcome", "optin"):
+            register_opt_in(recipient, meta.get('opted_in_by', ''))
+        confirm_to = meta.get('confirm_to')
+        if kind == "optin" and confirm_to:
+            self.enqueue(confirm_to,
+                f"✅ *Barkr*\n\nActivatiebericht verstuurd naar *{meta.get('contact_name', 'Contact')}*. 🐾",
+                context=f"confirm:{confirm_to}", kind="confirm",
+                meta={"label": f"BEVESTIGING VERSTUURD → {confirm_to}"})
 
 
-def upsert_user(device_id: str, fields: dict):
-    """Voegt gebruiker toe of werkt bij. Sleutel is ALTIJD device_id."""
-    clean = device_id.strip()
-    if not clean:
-        log_status("⚠️ upsert_user aangeroepen zonder device_id — genegeerd")
-        return
+outbox = OutboundQueue()
+
+
+# Weekplanning als 7 x (start_minuut, eind_minuut), maandag eerst.
+# (0, 0) betekent geen venster op die dag.
+SCHEDULE_FORMAT = "<14H"
+
+
+def _hhmm_to_minutes(value) -> int | None:
+    try:
+        h, m = str(value).split(':')
+        h, m = int(h), int(m)
+    except ValueError:
+        return None
+    if 0 <= h < 24 and 0 <= m < 60:
+        return h * 60 + m
+    return None
+
+
+def _minutes_to_hhmm(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def compile_schedules(schedules) -> bytes:
+    """Compileert de weekplanning (dict of JSON) naar een blob van 28 bytes."""
+    if isinstance(schedules, str):
+        try:
+            schedules = json.loads(schedules) if schedules else {}
+        except Exception:
+            schedules = {}
+    if not isinstance(schedules, dict):
+        schedules = {}
+    pairs = []
+    for idx in range(7):
+        day_sched = schedules.get(str(idx)) or {}
+        if not isinstance(day_sched, dict):
+            day_sched = {}
+        start = _hhmm_to_minutes(day_sched.get('startTime', '00:00'))
+        end   = _hhmm_to_minutes(day_sched.get('endTime', '00:00'))
+        if start is None or end is None:
+            start = end = 0
+        pairs += [start, end]
+    return struct.pack(SCHEDULE_FORMAT, *pairs)
+
+
+def todays_window_minutes(user: dict, now: datetime | None = None) -> tuple[int, int]:
+    packed = user.get('schedule_packed')
+    if not packed:
+        return 0, 0
+    return struct.unpack_from("<2H", packed, (now or datetime.now()).weekday() * 4)
+
+
+def get_todays_window(user: dict, now: datetime | None = None) -> tuple[str, str]:
+    """Haalt het tijdvenster op uit de weekplanning voor vandaag."""
+    start, end = todays_window_minutes(user, now)
+    return _minutes_to_hhmm(start), _minutes_to_hhmm(end)
+
+
+def _local_ts(now: datetime, minutes: int) -> float:
+    """Epoch-tijd van een minuut-van-de-dag op de datum van `now`."""
+    return datetime.combine(now.date(), dtime(minutes // 60, minutes % 60)).timestamp()
+
+
+# ============================================================
+#   ALARM LOG
+#
+#   Eén tabel per maand (alarm_log_YYYYMM) in plaats van één
+#   steeds groeiende alarm_log. De dubbel-check raakt alleen de
+#   partitie van de alarmdatum. Partities ouder dan de bewaartermijn
+#   worden als gzip JSON-lines in ~/barkr/archive/ gezet en gedropt.
+#   Welke alarmen vandaag al afgehandeld zijn staat ook in geheugen
+#   (FiredAlarmSet); de database is alleen nog het duurzame record.
+# ============================================================
+
+ALARM_LOG_RETENTION_MONTHS = int(os.environ.get("BARKR_ALARM_RETENTION_MONTHS", "12"))
+ALARM_ARCHIVE_DIR          = os.path.expanduser("~/barkr/archive")
+
+_alarm_partitions: set = set()
+_ALARM_COLUMNS = ("device_id", "alarm_date", "window_start", "window_end", "fired_at")
+
+
+def alarm_partition(alarm_date: str) -> str:
+    """'2026-03-14' → 'alarm_log_202603'."""
+    return f"alarm_log_{alarm_date[:4]}{alarm_date[5:7]}"
+
+
+def ensure_alarm_partition(c, table: str):
+    if table in _alarm_partitions:
+        return
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+        id           INTEGER PRIMARY KEY AUTOINCREMENT,
+        device_id    TEXT,
+        alarm_date   TEXT,
+        window_start TEXT,
+        window_end   TEXT,
+        fired_at     TEXT,
+        UNIQUE(device_id, alarm_date, window_start, window_end)
+    )''')
+    _alarm_partitions.add(table)
+
+
+def list_alarm_partitions(c) -> list:
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name GLOB 'alarm_log_[0-9][0-9][0-9][0-9][0-9][0-9]'")
+    return sorted(row[0] for row in c.fetchall())
+
+
+def migrate_alarm_log(conn):
+    """Verdeelt de oude alarm_log tabel over maandpartities en dropt hem."""
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='alarm_log'")
+    if not c.fetchone():
+        return
+    c.execute("SELECT DISTINCT substr(alarm_date, 1, 7) FROM alarm_log WHERE alarm_date LIKE '____-__-__'")
+    months = [row[0] for row in c.fetchall()]
+    with conn:
+        for month in months:
+            table = alarm_partition(month + "-01")
+            ensure_alarm_partition(c, table)
+            c.execute(f'''INSERT OR IGNORE INTO {table} ({", ".join(_ALARM_COLUMNS)})
+                          SELECT {", ".join(_ALARM_COLUMNS)} FROM alarm_log WHERE substr(alarm_date, 1, 7)=?''',
+                      (month,))
+        c.execute("SELECT COUNT(*) FROM alarm_log")
+        total = c.fetchone()[0]
+        c.execute("DROP TABLE alarm_log")
+    log_status(f"🗃️ alarm_log gemigreerd → {total} rijen over {len(months)} maandpartities")
+
+
+def archive_alarm_partitions(now: datetime | None = None) -> int:
+    """Archiveert en dropt partities ouder dan de bewaartermijn."""
+    now = now or datetime.now()
+    month_index = now.year * 12 + now.month - 1 - ALARM_LOG_RETENTION_MONTHS
+    oldest_kept = f"alarm_log_{month_index // 12:04d}{month_index % 12 + 1:02d}"
+    conn = get_db()
+    archived = 0
+    try:
+        c = conn.cursor()
+        for table in list_alarm_partitions(c):
+            if table >= oldest_kept:
+                continue
+            os.makedirs(ALARM_ARCHIVE_DIR, exist_ok=True)
+            path = os.path.join(ALARM_ARCHIVE_DIR, f"{table}.jsonl.gz")
+            c.execute(f"SELECT {', '.join(_ALARM_COLUMNS)} FROM {table} ORDER BY id")
+            rows = c.fetchall()
+            with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(dict(zip(_ALARM_COLUMNS, row)), ensure_ascii=False) + "\n")
+            os.replace(path + ".tmp", path)
+            with conn:
+                c.execute(f"DROP TABLE {table}")
+            _alarm_partitions.discard(table)
+            archived += 1
+            log_status(f"📦 {table} GEARCHIVEERD → {len(rows)} rijen naar {path}")
+    finally:
+        conn.close()
+    return archived
+
+
+class FiredAlarmSet:
+    """(device_id, datum, start, eind) van vandaag; wisselt om middernacht."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._day: str | None = None
+        self._keys: set = set()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._keys)
+
+    def reset(self, day: str):
+        """Leest de alarmen van `day` uit zijn partitie en vervangt de set."""
+        table = alarm_partition(day)
+        conn = get_db()
+        c = conn.cursor()
+        try:
+            c.execute(f"SELECT device_id, alarm_date, window_start, window_end FROM {table} WHERE alarm_date=?", (day,))
+            keys = set(c.fetchall())
+        except sqlite3.OperationalError:
+            keys = set()  # partitie bestaat nog niet
+        conn.close()
+        with self._lock:
+            self._day, self._keys = day, keys
+
+    def contains(self, key: tuple) -> bool | None:
+        """None als de datum niet de dag van de set is (dan de database vragen)."""
+        with self._lock:
+            if key[1] == self._day:
+                return key in self._keys
+        if self._day is None or key[1] > self._day:
+            self.reset(key[1])  # eerste gebruik of middernacht gepasseerd
+            with self._lock:
+                return key in self._keys
+        return None
+
+    def add(self, key: tuple):
+        with self._lock:
+            if key[1] == self._day:
+                self._keys.add(key)
+
+
+fired_alarms = FiredAlarmSet()
+
+
+def alarm_already_fired(device_id_key: str, alarm_date: str, window_start: str, window_end: str) -> bool:
+    cached = fired_alarms.contains((device_id_key, alarm_date, window_start, window_end))
+    if cached is not None:
+        return cached
+    table = alarm_partition(alarm_date)
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        c.execute(f"SELECT id FROM {table} WHERE device_id=? AND alarm_date=? AND window_start=? AND window_end=?",
+                  (device_id_key, alarm_date, window_start, window_end))
+        found = c.fetchone() is not None
+    except sqlite3.OperationalError:
+        found = False  # partitie bestaat nog niet: deze maand nog niets gevuurd
+    conn.close()
+    return found
+
+
+def mark_alarm_fired(device_id_key: str, alarm_date: str, window_start: str, window_end: str):
+    table = alarm_partition(alarm_date)
+    conn = get_db()
+    c = conn.cursor()
+    ensure_alarm_partition(c, table)
+    c.execute(f"INSERT OR IGNORE INTO {table} (device_id, alarm_date, window_start, window_end, fired_at) VALUES (?,?,?,?,?)",
+              (device_id_key, alarm_date, window_start, window_end, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    conn.commit()
+    conn.close()
+    fired_alarms.add((device_id_key, alarm_date, window_start, window_end))
+
+
+def upsert_user(device_id: str, fields: dict):
+    """Voegt gebruiker toe of werkt bij. Sleutel is ALTIJD device_id."""
+    clean = device_id.strip()
+    if not clean:
+        log_status("⚠️ upsert_user aangeroepen zonder device_id — genegeerd")
+        return
     # Web sessies (browser) mogen nooit een nieuw record aanmaken
     # Ze mogen alleen bestaande records bijwerken
     if clean.startswith('web_'):
@@ -268,58 +1425,48 @@ def upsert_user(device_id: str, fields: dict):
     conn = get_db()
     c = conn.cursor()
     # Haal bestaand record op via device_id
-    c.execute("SELECT last_ping_time FROM users WHERE device_id=?", (clean,))
+    c.execute("SELECT last_ping_ts FROM users WHERE device_id=?", (clean,))
     existing  = c.fetchone()
     # Als niet gevonden via device_id, zoek via own_phone en update device_id
     if not existing and own_phone and is_valid_phone(own_phone):
-        c.execute("SELECT last_ping_time FROM users WHERE own_phone=? ORDER BY rowid DESC LIMIT 1", (own_phone,))
+        c.execute("SELECT last_ping_ts FROM users WHERE own_phone=? ORDER BY rowid DESC LIMIT 1", (own_phone,))
         existing = c.fetchone()
         if existing:
-            c.execute("UPDATE users SET device_id=? WHERE own_phone=? AND (device_id IS NULL OR device_id='')", (clean, own_phone))
+            c.execute("UPDATE users SET device_id=?, settings_updated_ts=? WHERE own_phone=? AND (device_id IS NULL OR device_id='')",
+                      (clean, int(time.time()), own_phone))
             conn.commit()
-    last_ping = existing[0] if existing else ""
+    last_ping = existing[0] if existing else 0
     if existing:
         # Update bestaand record
         c.execute('''UPDATE users SET
-                    own_phone=?, user_name=?, contacts=?, schedules=?,
-                    vacation_mode=?, notify_self=?
+                    own_phone=?, user_name=?, contacts=?, schedules=?, schedule_packed=?,
+                    vacation_mode=?, notify_self=?, settings_updated_ts=?
                     WHERE device_id=?''',
                   (own_phone,
                    fields.get('user_name', ''),
                    fields.get('contacts', '[]'),
                    fields.get('schedules', '{}'),
+                   compile_schedules(fields.get('schedules', '{}')),
                    int(fields.get('vacation_mode', False)),
                    int(fields.get('notify_self', True)),
+                   int(time.time()),
                    clean))
     else:
         # Nieuw record aanmaken
         c.execute('''INSERT INTO users (device_id, own_phone, user_name, contacts, schedules,
-                    vacation_mode, last_ping_time, notify_self)
-                    VALUES (?,?,?,?,?,?,?,?)''',
+                    schedule_packed, vacation_mode, last_ping_ts, notify_self, settings_updated_ts)
+                    VALUES (?,?,?,?,?,?,?,?,?,?)''',
                   (clean, own_phone,
                    fields.get('user_name', ''),
                    fields.get('contacts', '[]'),
                    fields.get('schedules', '{}'),
+                   compile_schedules(fields.get('schedules', '{}')),
                    int(fields.get('vacation_mode', False)),
                    last_ping,
-                   int(fields.get('notify_self', True))))
-    conn.commit()
-    conn.close()
-
-
-def update_ping(device_id_or_phone: str, timestamp: str):
-    clean = device_id_or_phone.strip()
-    conn = get_db()
-    c = conn.cursor()
-    # Zoek op device_id eerst, dan op own_phone als fallback
-    c.execute("UPDATE users SET last_ping_time=? WHERE device_id=?", (timestamp, clean))
-    if c.rowcount == 0:
-        clean_phone = normalize_phone(clean)
-        c.execute("UPDATE users SET last_ping_time=? WHERE own_phone=?", (timestamp, clean_phone))
-    updated = c.rowcount
+                   int(fields.get('notify_self', True)),
+                   int(time.time())))
     conn.commit()
     conn.close()
-    return updated > 0
 
 
 def escalate_user(user: dict, start_str: str, end_str: str):
@@ -338,29 +1485,28 @@ def escalate_user(user: dict, start_str: str, end_str: str):
     for contact in contacts:
         phone = contact.get('phone', '')
         if phone:
-            ok = send_whatsapp(phone, message, context=f"alarm:{own_phone}")
-            log_status(f"{'✅' if ok else '❌'} Alarm → {phone} ({contact.get('name','?')})")
-            time.sleep(6)
+            outbox.enqueue(phone, message, context=f"alarm:{own_phone}", kind="alarm",
+                           meta={"label": f"Alarm → {phone} ({contact.get('name','?')})"})
 
 
-def send_inactivity_alert(user: dict):
+def send_inactivity_alert(user: dict) -> bool:
     own_phone   = user.get('own_phone', '')
     device_id   = user.get('device_id', own_phone) or own_phone
     notify_self = bool(user.get('notify_self', 1))
     user_name   = user.get('user_name', '') or own_phone
-    today_str   = datetime.now().strftime("%Y-%m-%d")
+    now         = datetime.now()
 
     # Schuifje uit — geen melding
     if not notify_self:
-        return
+        return False
 
     # Geen telefoonnummer ingevuld — stil overslaan, geen log spam
     if not own_phone or not is_valid_phone(own_phone):
-        return
+        return False
 
     # Al een keer gestuurd vandaag — maximaal 1x per dag
-    if user.get('last_inactivity_alert') == today_str:
-        return
+    if user.get('last_inactivity_alert_ts', 0) >= _local_ts(now, 0):
+        return False
 
     msg = (
         f"⚠️ *Barkr — App niet actief*\n\n"
@@ -370,37 +1516,94 @@ def send_inactivity_alert(user: dict):
         f"Open de app → tik op het vraagteken → kies Opstartgids. 🐾\n\n"
         f"Wil je deze berichten niet? Open Barkr → Instellingen → schuifje UIT."
     )
-    log_status(f"📱 INACTIVITEITSMELDING WORDT VERSTUURD → {user_name} [dev:{device_id[:8]}] → {own_phone}")
-    if send_whatsapp(own_phone, msg, context=f"inactivity:{device_id}"):
-        log_status(f"✅ INACTIVITEITSMELDING VERSTUURD → {user_name} [dev:{device_id[:8]}]")
+    if cluster and not cluster.claim(f"inactivity|{device_id}|{now:%Y-%m-%d}"):
+        log_status(f"⏭️ INACTIVITEITSMELDING AL VERSTUURD DOOR ANDERE NODE → {user_name} [dev:{device_id[:8]}]")
+        conn = get_db()
+        with conn:
+            conn.execute("UPDATE users SET last_inactivity_alert_ts=? WHERE device_id=?",
+                         (int(now.timestamp()), device_id))
+        conn.close()
+        return True
+    log_status(f"📱 INACTIVITEITSMELDING WORDT VERSTUURD → {user_name} [dev:{device_id[:8]}] → {own_phone}",
+               event="inactivity", device_id=device_id)
+    if outbox.enqueue(own_phone, msg, context=f"inactivity:{device_id}", kind="inactivity",
+                      meta={"label": f"INACTIVITEITSMELDING VERSTUURD → {user_name} [dev:{device_id[:8]}]"}):
         conn = get_db()
         c = conn.cursor()
-        c.execute("UPDATE users SET last_inactivity_alert=? WHERE device_id=?", (today_str, device_id))
+        c.execute("UPDATE users SET last_inactivity_alert_ts=? WHERE device_id=?", (int(now.timestamp()), device_id))
         conn.commit()
         conn.close()
-    else:
-        log_status(f"❌ INACTIVITEITSMELDING MISLUKT → {user_name} [dev:{device_id[:8]}]")
+        journal.append(EV_INACTIVITY, device_id)
+        return True
+    log_status(f"❌ INACTIVITEITSMELDING MISLUKT → {user_name} [dev:{device_id[:8]}]")
+    return False
 
 
-def get_fcm_access_token() -> str:
-    """Haal een OAuth2 access token op via het service account."""
-    import time as time_mod
-    now = time_mod.time()
-    if _fcm_token_cache["token"] and _fcm_token_cache["expires"] > now + 60:
-        return _fcm_token_cache["token"]
-    try:
-        if not os.path.exists(FCM_SERVICE_ACCOUNT_FILE):
-            return ""
-        import json as json_mod, base64, hashlib
-        with open(FCM_SERVICE_ACCOUNT_FILE) as f:
-            sa = json_mod.load(f)
+class FcmCredentials:
+    """Service account sleutel en OAuth2 access token voor FCM.
+
+    De sleutel wordt één keer geparsed en opnieuw geladen als het
+    bestand wijzigt. Een achtergrondthread ververst het token ruim voor
+    het verloopt, zodat token() nooit op crypto of OAuth hoeft te wachten.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._mtime = None
+        self._email = ""
+        self._key = None
+        self._token = ""
+        self._expires = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self._key is not None
+
+    def token(self) -> str:
+        with self._lock:
+            if self._token and self._expires > time.time():
+                return self._token
+        self._wake.set()
+        return ""
+
+    def start(self):
+        threading.Thread(target=self._run, name="fcm-credentials", daemon=True).start()
+
+    def _load_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            if self._key is not None:
+                log_status("⚠️ FCM SERVICE ACCOUNT VERWIJDERD → wake-ups uit")
+            with self._lock:
+                self._mtime, self._key, self._token, self._expires = None, None, "", 0.0
+            return
+        if mtime == self._mtime:
+            return
+        from cryptography.hazmat.primitives import serialization
+        with open(self.path) as f:
+            sa = json.load(f)
+        key = serialization.load_pem_private_key(sa["private_key"].encode(), password=None)
+        with self._lock:
+            was_available = self._key is not None
+            self._mtime, self._email, self._key = mtime, sa["client_email"], key
+            self._token, self._expires = "", 0.0
+        log_status("🔑 FCM SERVICE ACCOUNT GELADEN")
+        if not was_available:
+            reseed_fcm_deadlines()
+
+    def _refresh(self):
+        import base64
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
 
         # Maak JWT aan
-        import urllib.request, urllib.parse
-        header = base64.urlsafe_b64encode(json_mod.dumps({"alg":"RS256","typ":"JWT"}).encode()).rstrip(b"=")
-        now_int = int(now)
-        claim = base64.urlsafe_b64encode(json_mod.dumps({
-            "iss": sa["client_email"],
+        now_int = int(time.time())
+        header = base64.urlsafe_b64encode(json.dumps({"alg":"RS256","typ":"JWT"}).encode()).rstrip(b"=")
+        claim = base64.urlsafe_b64encode(json.dumps({
+            "iss": self._email,
             "scope": "https://www.googleapis.com/auth/firebase.messaging",
             "aud": "https://oauth2.googleapis.com/token",
             "iat": now_int,
@@ -408,57 +1611,62 @@ def get_fcm_access_token() -> str:
         }).encode()).rstrip(b"=")
         msg = header + b"." + claim
 
-        # Signeer met private key
-        from cryptography.hazmat.primitives import hashes, serialization
-        from cryptography.hazmat.primitives.asymmetric import padding
-        private_key = serialization.load_pem_private_key(sa["private_key"].encode(), password=None)
+        # Signeer met de gecachte private key
         signature = base64.urlsafe_b64encode(
-            private_key.sign(msg, padding.PKCS1v15(), hashes.SHA256())
+            self._key.sign(msg, padding.PKCS1v15(), hashes.SHA256())
         ).rstrip(b"=")
         jwt_token = (msg + b"." + signature).decode()
 
         # Wissel JWT in voor access token
-        data = urllib.parse.urlencode({
+        resp = transport.request("oauth", "POST", FCM_TOKEN_URL, data={
             "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
             "assertion": jwt_token
-        }).encode()
-        req = urllib.request.Request("https://oauth2.googleapis.com/token", data=data)
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            result = json_mod.loads(resp.read())
-            token = result.get("access_token", "")
-            _fcm_token_cache["token"] = token
-            _fcm_token_cache["expires"] = now + 3600
-            return token
-    except Exception as e:
-        log_status(f"❌ FCM TOKEN FOUT → {e}")
-        return ""
+        })
+        result = resp.json()
+        token = result.get("access_token", "")
+        if not token:
+            raise RuntimeError(f"geen access_token ({resp.status_code})")
+        with self._lock:
+            self._token = token
+            self._expires = now_int + int(result.get("expires_in", 3600))
+
+    def _run(self):
+        while True:
+            wait = FCM_KEY_CHECK_INTERVAL
+            try:
+                self._load_if_changed()
+                if self._key is not None:
+                    remaining = self._expires - time.time()
+                    if remaining < FCM_TOKEN_REFRESH_MARGIN:
+                        self._refresh()
+                        remaining = self._expires - time.time()
+                    wait = min(wait, max(1.0, remaining - FCM_TOKEN_REFRESH_MARGIN))
+            except Exception as e:
+                log_status(f"❌ FCM TOKEN FOUT → {e}")
+                wait = FCM_RETRY_INTERVAL
+            self._wake.wait(wait)
+            self._wake.clear()
+
+
+fcm_credentials = FcmCredentials(FCM_SERVICE_ACCOUNT_FILE)
+
+
+def get_fcm_access_token() -> str:
+    """Geeft het actuele OAuth2 access token, of "" als er (nog) geen is."""
+    return fcm_credentials.token()
 
 
 def send_fcm_wakeup(fcm_token: str, device_id: str, user_name: str) -> bool:
     """Stuurt een stille FCM wake-up push via V1 API."""
-    if not fcm_token or not os.path.exists(FCM_SERVICE_ACCOUNT_FILE):
+    if not fcm_token or not fcm_credentials.available:
         return False
     try:
         access_token = get_fcm_access_token()
         if not access_token:
             return False
-        payload = {
-            "message": {
-                "token": fcm_token,
-                "data": {"type": "wakeup", "device_id": device_id},
-                "android": {"priority": "high"}
-            }
-        }
-        r = requests.post(FCM_URL_V1,
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json"
-            },
-            json=payload,
-            timeout=10
-        )
+        r = get_provider("fcm").send(fcm_token, {"type": "wakeup", "device_id": device_id}, access_token)
         if r.status_code == 200:
-            log_status(f"📡 FCM WAKE-UP → {user_name} [{device_id[:8]}]")
+            log_status(f"📡 FCM WAKE-UP → {user_name} [{device_id[:8]}]", event="fcm", device_id=device_id)
             return True
         else:
             log_status(f"❌ FCM WAKE-UP MISLUKT → {user_name} | {r.status_code} | {r.text[:100]}")
@@ -468,327 +1676,2540 @@ def send_fcm_wakeup(fcm_token: str, device_id: str, user_name: str) -> bool:
         return False
 
 
-def monitoring_loop():
-    log_status("🚀 BARKR ENGINE v10.36 GESTART | Sleutel: device_id")
+# ============================================================
+#   DEVICE REGISTRY
+#
+#   Gezaghebbende in-memory stand per device_id. Heartbeats werken
+#   alleen dit register bij; een achtergrondschrijver zet gewijzigde
+#   pings en namen elke paar seconden in één transactie weg.
+#   Een ping die de opgeslagen tijd minder dan PING_WRITE_RESOLUTION
+#   verschuift (en de naam niet wijzigt) wacht tot er wél iets te
+#   schrijven is; bij afsluiten wordt alles weggeschreven.
+#   Per toestel houdt het register ook de laatste ping en ontgrendeling
+#   bij die binnen het venster van die dag vielen (window_*_ts). De
+#   vensterbeslissing kijkt daarnaar, zodat pings die na het einde maar
+#   vóór de beslissing binnenkomen het bewijs niet overschrijven.
+# ============================================================
 
-    while True:
-        try:
-            current_time = time.time()
+REGISTRY_FLUSH_INTERVAL = 5  # seconden
+PING_WRITE_RESOLUTION   = int(os.environ.get("BARKR_PING_WRITE_RESOLUTION", "30"))  # seconden
+WINDOW_UNLOCK_SLACK     = 120  # ontgrendeling tot zo lang na het einde telt nog als actief
 
-            # Detecteer offline
-            for phone, state in list(user_states.items()):
-                if state["status"] == "online" and (current_time - state["last_ping"]) > PING_TIMEOUT:
-                    user_states[phone]["status"] = "offline"
-                    log_status(f"📵 OFFLINE → {state.get('name','?')} [dev:{phone[:8]}] | {int(current_time - state['last_ping'])}s geen ping")
+_REGISTRY_FIELDS = ("device_id", "own_phone", "user_name", "schedule_packed",
+                    "last_ping_ts", "last_unlocked_ts", "window_ping_ts", "window_unlocked_ts")
+_PING_FIELDS = ("last_ping_ts", "last_unlocked_ts", "window_ping_ts", "window_unlocked_ts")
 
-            conn = get_db()
-            conn.row_factory = sqlite3.Row
-            c = conn.cursor()
-            c.execute("SELECT * FROM users")
-            users = c.fetchall()
-            conn.close()
 
-            now       = datetime.now()
-            today_str = now.strftime("%Y-%m-%d")
+def window_bounds(schedule_packed, ts: float) -> tuple[float, float] | None:
+    """(start, eind) van het venster op de dag van `ts`; None zonder venster."""
+    if not schedule_packed:
+        return None
+    day = datetime.fromtimestamp(ts)
+    start_min, end_min = todays_window_minutes({"schedule_packed": schedule_packed}, day)
+    if start_min >= end_min:
+        return None
+    return _local_ts(day, start_min), _local_ts(day, end_min)
 
-            for row in users:
-                user      = dict(row)
-                own_phone = user.get('own_phone', '')
-                device_id = user.get('device_id', own_phone) or own_phone
-                user_name = user.get('user_name', own_phone)
 
-                if user.get('vacation_mode'):
-                    continue
+def _note_window(entry: dict, ping_ts: int, unlocked: bool) -> bool:
+    """Legt een ping vast als vensterbewijs als hij binnen zijn venster viel."""
+    bounds = window_bounds(entry.get("schedule_packed"), ping_ts)
+    if not bounds:
+        return False
+    start_ts, end_ts = bounds
+    changed = False
+    if start_ts <= ping_ts <= end_ts and ping_ts > (entry.get("window_ping_ts") or 0):
+        entry["window_ping_ts"] = ping_ts
+        changed = True
+    if unlocked and start_ts <= ping_ts <= end_ts + WINDOW_UNLOCK_SLACK \
+            and ping_ts > (entry.get("window_unlocked_ts") or 0):
+        entry["window_unlocked_ts"] = ping_ts
+        changed = True
+    return changed
 
-                # FCM wake-up als laatste ping > 2 minuten geleden
-                # Dit wekt de telefoon op ongeacht batterij-instellingen
-                last_ping_time = user.get('last_ping_time', '')
-                fcm_token = user.get('fcm_token', '')
-                if last_ping_time and fcm_token and os.path.exists(FCM_SERVICE_ACCOUNT_FILE):
-                    try:
-                        last_ping_dt3 = datetime.strptime(last_ping_time, "%Y-%m-%d %H:%M:%S")
-                        minuten_stil = (now - last_ping_dt3).total_seconds() / 60
-                        last_fcm = user.get('last_fcm_wakeup', '')
-                        last_fcm_dt = datetime.strptime(last_fcm, "%Y-%m-%d %H:%M:%S") if last_fcm else None
-                        fcm_interval_ok = not last_fcm_dt or (now - last_fcm_dt).total_seconds() > FCM_WAKEUP_INTERVAL
-                        if minuten_stil > 2 and fcm_interval_ok:
-                            if send_fcm_wakeup(fcm_token, device_id, user_name):
-                                conn_fcm = get_db()
-                                conn_fcm.execute("UPDATE users SET last_fcm_wakeup=? WHERE device_id=?",
-                                    (now.strftime("%Y-%m-%d %H:%M:%S"), device_id))
-                                conn_fcm.commit()
-                                conn_fcm.close()
-                    except Exception:
-                        pass
-
-                # Inactiviteitsmelding — gebaseerd op device_id, niet telefoonnummer
-                if last_ping_time:
-                    try:
-                        last_ping_dt  = datetime.strptime(last_ping_time, "%Y-%m-%d %H:%M:%S")
-                        inactief_uren = (now - last_ping_dt).total_seconds() / 3600
-                        if inactief_uren >= INACTIVITY_HOURS:
-                            send_inactivity_alert(user)
-                    except ValueError:
-                        pass
-
-                # Tijdvenster uit weekplanning
-                start_str, end_str = get_todays_window(user)
-                if start_str == '00:00' and end_str == '00:00':
-                    continue
 
-                try:
-                    start_dt = datetime.combine(now.date(), datetime.strptime(start_str, "%H:%M").time())
-                    end_dt   = datetime.combine(now.date(), datetime.strptime(end_str, "%H:%M").time())
-                except ValueError:
-                    continue
+class DeviceRegistry:
+    """Actuele stand per toestel, plus een aliaskaart telefoon/naam → device_id.
 
-                if start_dt >= end_dt or now <= end_dt:
-                    continue
+    De aliaskaart volgt dezelfde regel als de SQL-fallback (nieuwste rij
+    wint, ORDER BY rowid DESC), zodat oude APK's zonder device_id niet bij
+    elke ping de database hoeven te doorzoeken.
+    """
 
-                if alarm_already_fired(device_id, today_str, start_str, end_str):
-                    continue
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices: dict = {}
+        self._dirty: set = set()
+        self._pending: set = set()  # gewijzigd, maar onder de schrijfresolutie
+        self._written: dict = {}    # device_id → (pingvelden..., user_name) zoals in de database
+        self._rowids: dict = {}
+        self._aliases: dict = {}  # ("phone"|"name", waarde) → (rowid, device_id)
+
+    @staticmethod
+    def _row_state(entry: dict) -> tuple:
+        return tuple(entry.get(key) or 0 for key in _PING_FIELDS) + (entry["user_name"],)
+
+    def _mark(self, device_id: str, entry: dict):
+        """Bepaalt of een wijziging weggeschreven moet worden of kan wachten."""
+        state = self._row_state(entry)
+        ping_ts, unlocked_ts, user_name = state[0], state[1], state[-1]
+        written = self._written.get(device_id)
+        if written is None or written[-1] != user_name \
+                or ping_ts - written[0] >= PING_WRITE_RESOLUTION \
+                or unlocked_ts - written[1] >= PING_WRITE_RESOLUTION:
+            self._dirty.add(device_id)
+            self._pending.discard(device_id)
+        elif state != written and device_id not in self._dirty:
+            self._pending.add(device_id)
+
+    def __len__(self) -> int:
+        return len(self._devices)
 
-                log_status(f"🏁 Deadline {end_str} bereikt voor {user_name} [dev:{device_id[:8]}]")
-
-                last_ping_dt = None
-                if last_ping_time:
-                    try:
-                        last_ping_dt = datetime.strptime(last_ping_time, "%Y-%m-%d %H:%M:%S")
-                    except ValueError:
-                        pass
-
-                # Controleer of de backend het venster volledig heeft bewaakt
-                # Bewijs: er moet een ping zijn ontvangen TIJDENS het venster (tussen start en eind)
-                # Een ping NA het venster telt niet — dan was de app niet actief tijdens het venster
-                ping_tijdens_venster = False
-                if last_ping_time:
-                    try:
-                        last_ping_dt2 = datetime.strptime(last_ping_time, "%Y-%m-%d %H:%M:%S")
-                        if start_dt <= last_ping_dt2 <= end_dt:
-                            ping_tijdens_venster = True
-                    except ValueError:
-                        pass
-
-                if not ping_tijdens_venster:
-                    log_status(f"⏭️ GEEN ALARM → {user_name} [dev:{device_id[:8]}] — geen ping ontvangen tijdens venster {start_str}–{end_str}, bewaking niet volledig")
-                    mark_alarm_fired(device_id, today_str, start_str, end_str)
+    def _learn_aliases(self, rowid: int, entry: dict):
+        device_id = entry["device_id"]
+        for key in (("phone", entry["own_phone"]), ("name", entry["user_name"])):
+            if not key[1]:
+                continue
+            current = self._aliases.get(key)
+            if current is None or current[0] <= rowid or current[1] not in self._devices:
+                self._aliases[key] = (rowid, device_id)
+
+    def _forget_aliases(self, entry: dict):
+        for key in (("phone", entry["own_phone"]), ("name", entry["user_name"])):
+            current = self._aliases.get(key)
+            if current and current[1] == entry["device_id"]:
+                del self._aliases[key]
+
+    def load_all(self):
+        conn = get_db()
+        c = conn.cursor()
+        c.execute(f"SELECT rowid, {', '.join(_REGISTRY_FIELDS)} FROM users ORDER BY rowid")
+        rows = c.fetchall()
+        conn.close()
+        self.load_rows((row[0], dict(zip(_REGISTRY_FIELDS, row[1:]))) for row in rows)
+
+    def load_rows(self, rows):
+        """Neemt (rowid, rij) paren over (database of snapshot), oplopend op rowid.
+
+        Pingvelden die dit proces al nieuwer heeft blijven staan.
+        """
+        count = 0
+        with self._lock:
+            for rowid, row in rows:
+                entry = {key: row.get(key) for key in _REGISTRY_FIELDS}
+                written = self._row_state(entry)
+                old = self._devices.get(entry["device_id"])
+                if old:
+                    for key in _PING_FIELDS:
+                        entry[key] = max(entry[key] or 0, old.get(key) or 0)
+                    self._forget_aliases(old)
+                self._devices[entry["device_id"]] = entry
+                self._written[entry["device_id"]] = written
+                self._rowids[entry["device_id"]] = rowid
+                self._learn_aliases(rowid, entry)
+                count += 1
+        log_status(f"🗂️ REGISTER GELADEN → {count} toestellen, {len(self._aliases)} aliassen")
+
+    def resolve_alias(self, own_phone: str, user_name: str) -> tuple[str, str] | None:
+        """Zoekt een toestel op telefoon en dan naam: (device_id, gevonden_via)."""
+        with self._lock:
+            for kind, value, label in (("phone", own_phone, "own_phone"), ("name", user_name, "naam")):
+                hit = self._aliases.get((kind, value)) if value else None
+                if hit and hit[1] in self._devices:
+                    return hit[1], label
+        return None
+
+    def load_device(self, device_id: str) -> dict | None:
+        """Leest één toestel (opnieuw) uit de database.
+
+        Instellingen komen uit de database, nog niet weggeschreven pings
+        uit het register blijven behouden.
+        """
+        conn = get_db()
+        c = conn.cursor()
+        c.execute(f"SELECT rowid, {', '.join(_REGISTRY_FIELDS)} FROM users WHERE device_id=?", (device_id,))
+        row = c.fetchone()
+        conn.close()
+        if not row:
+            return None
+        fresh = dict(zip(_REGISTRY_FIELDS, row[1:]))
+        with self._lock:
+            self._written[device_id] = self._row_state(fresh)
+            entry = self._devices.get(device_id)
+            if entry and (device_id in self._dirty or device_id in self._pending):
+                for key in _PING_FIELDS:
+                    fresh[key] = max(fresh[key] or 0, entry.get(key) or 0)
+            if entry:
+                self._forget_aliases(entry)
+            self._devices[device_id] = fresh
+            self._rowids[device_id] = row[0]
+            self._learn_aliases(row[0], fresh)
+            return dict(fresh)
+
+    def get(self, device_id: str) -> dict | None:
+        with self._lock:
+            entry = self._devices.get(device_id)
+            return dict(entry) if entry else None
+
+    def device_ids(self) -> list:
+        with self._lock:
+            return list(self._devices)
+
+    def record_ping(self, device_id: str, ping_ts: int, user_name: str, unlocked: bool) -> bool:
+        with self._lock:
+            entry = self._devices.get(device_id)
+            if entry is None:
+                return False
+            entry["last_ping_ts"] = ping_ts
+            _note_window(entry, ping_ts, unlocked)
+            if entry["user_name"] != user_name:
+                self._forget_aliases(entry)
+                entry["user_name"] = user_name
+                self._learn_aliases(self._rowids.get(device_id, 0), entry)
+            if unlocked:
+                entry["last_unlocked_ts"] = ping_ts
+            self._mark(device_id, entry)
+            return True
+
+    def record_pings(self, pings: list) -> list:
+        """Past een reeks (device_id, ping_ts, unlocked) in één keer toe.
+
+        Last-write-wins: een ping ouder dan wat het register al heeft wordt
+        niet toegepast. Geeft per ping "applied", "stale" of "unknown".
+        Een oudere ping telt wel nog als vensterbewijs.
+        """
+        results = []
+        with self._lock:
+            for device_id, ping_ts, unlocked in pings:
+                entry = self._devices.get(device_id)
+                if entry is None:
+                    results.append("unknown")
                     continue
+                noted = _note_window(entry, ping_ts, unlocked)
+                applied = False
+                if ping_ts > (entry["last_ping_ts"] or 0):
+                    entry["last_ping_ts"] = ping_ts
+                    applied = True
+                if unlocked and ping_ts > (entry["last_unlocked_ts"] or 0):
+                    entry["last_unlocked_ts"] = ping_ts
+                    applied = True
+                if applied or noted:
+                    self._mark(device_id, entry)
+                results.append("applied" if applied else "stale")
+        return results
+
+    def merge_ping(self, device_id: str, ping_ts: int, unlocked_ts: int, user_name: str,
+                   window_ping_ts: int = 0, window_unlocked_ts: int = 0) -> bool:
+        """Neemt een door een andere worker weggeschreven ping over als die nieuwer is.
+
+        Het vensterbewijs wordt altijd samengevoegd (het hoogste wint).
+        """
+        with self._lock:
+            entry = self._devices.get(device_id)
+            if entry is None:
+                return False
+            entry["window_ping_ts"] = max(window_ping_ts or 0, entry.get("window_ping_ts") or 0)
+            entry["window_unlocked_ts"] = max(window_unlocked_ts or 0, entry.get("window_unlocked_ts") or 0)
+            if ping_ts <= (entry["last_ping_ts"] or 0):
+                return False
+            entry["last_ping_ts"] = ping_ts
+            entry["last_unlocked_ts"] = max(unlocked_ts or 0, entry["last_unlocked_ts"] or 0)
+            entry["user_name"] = user_name
+            self._written[device_id] = self._row_state(entry)
+            return True
+
+    def rename(self, old_id: str, new_id: str):
+        with self._lock:
+            entry = self._devices.pop(old_id, None)
+            if entry is not None:
+                entry["device_id"] = new_id
+                self._devices[new_id] = entry
+            if old_id in self._rowids:
+                self._rowids[new_id] = self._rowids.pop(old_id)
+            if old_id in self._written:
+                self._written[new_id] = self._written.pop(old_id)
+            if old_id in self._pending:
+                self._pending.discard(old_id)
+                self._pending.add(new_id)
+            for key, (rowid, device_id) in list(self._aliases.items()):
+                if device_id == old_id:
+                    self._aliases[key] = (rowid, new_id)
+            if old_id in self._dirty:
+                self._dirty.discard(old_id)
+                self._dirty.add(new_id)
+
+    def overlay(self, user: dict) -> dict:
+        """Vervangt de pingvelden van een databaserij door de actuele stand."""
+        with self._lock:
+            entry = self._devices.get(user.get('device_id', ''))
+            if entry:
+                user["user_name"] = entry["user_name"]
+                for key in _PING_FIELDS:
+                    user[key] = entry.get(key) or 0
+        return user
+
+    def flush(self, force: bool = False) -> int:
+        """Schrijft gewijzigde toestellen in één transactie weg.
+
+        Wachtende pings gaan mee zodra ze ouder zijn dan de resolutie, zodat
+        de database nooit verder achterloopt; force schrijft alles (afsluiten).
+        """
+        cutoff = time.time() - PING_WRITE_RESOLUTION
+        with self._lock:
+            ripe = {d for d in self._pending
+                    if force or (self._devices.get(d, {}).get("last_ping_ts") or 0) <= cutoff}
+            ids = self._dirty | ripe
+            if not ids:
+                return 0
+            batch = [self._row_state(e) + (e["device_id"],) for e in (self._devices.get(d) for d in ids) if e]
+            self._dirty.clear()
+            self._pending -= ripe
+        conn = get_db()
+        try:
+            with conn:
+                conn.executemany(f"UPDATE users SET {', '.join(f'{k}=?' for k in _PING_FIELDS)}, user_name=? "
+                                 "WHERE device_id=?", batch)
+        except Exception:
+            with self._lock:
+                self._dirty.update(row[-1] for row in batch)
+            raise
+        finally:
+            conn.close()
+        with self._lock:
+            for row in batch:
+                self._written[row[-1]] = row[:-1]
+        return len(batch)
+
+
+registry = DeviceRegistry()
+metrics.gauge("barkr_registry_devices", "Toestellen in het register.", lambda: len(registry))
 
-                # Bewijs van leven = unlocked ping binnen het venster
-                was_actief = False
-                last_unlocked = user.get('last_unlocked_ping', '')
-                if last_unlocked:
-                    try:
-                        last_unlocked_dt = datetime.strptime(last_unlocked, "%Y-%m-%d %H:%M:%S")
-                        if start_dt <= last_unlocked_dt <= (end_dt + timedelta(minutes=2)):
-                            was_actief = True
-                    except ValueError:
-                        pass
-
-                if was_actief:
-                    log_status(f"✅ GEEN ALARM → {user_name} [dev:{device_id[:8]}] was actief binnen venster {start_str}–{end_str} (laatste actief: {last_unlocked})")
-                else:
-                    log_status(f"🚨 ALARM WORDT VERSTUURD → {user_name} [dev:{device_id[:8]}] | geen activiteit in venster {start_str}–{end_str}")
-                    log_status(f"   📱 Laatste ping: {last_ping_time} | Laatste actief: {last_unlocked or 'nooit'}")
-                    escalate_user(user, start_str, end_str)
-
-                mark_alarm_fired(device_id, today_str, start_str, end_str)
 
+def registry_writer():
+    while True:
+        time.sleep(REGISTRY_FLUSH_INTERVAL)
+        try:
+            registry.flush()
         except Exception as e:
-            log_status(f"⚠️ LOOP FOUT: {e}")
-            alert_developer("Loop crash", str(e))
+            log_status(f"⚠️ REGISTER FLUSH FOUT: {e}")
+            alert_developer("Register flush", str(e))
 
-        time.sleep(5)
+
+def flush_on_shutdown():
+    try:
+        flushed = registry.flush(force=True)
+        log_status(f"💾 AFSLUITEN → {flushed} toestellen weggeschreven")
+    except Exception as e:
+        log_status(f"❌ AFSLUITEN FLUSH FOUT: {e}")
 
 
 # ============================================================
-#   ENDPOINTS
+#   EVENT JOURNAL
+#
+#   Append-only binair logboek van pings en alarmbeslissingen in
+#   ~/barkr/journal/. Elk record heeft een CRC zodat een half
+#   geschreven staart na een crash herkend en afgekapt wordt.
+#   Segmenten roteren op grootte; oude segmenten worden samengevoegd
+#   tot de laatste ping per toestel plus alle beslissingen.
+#   Bij opstart zet het terugspelen de pings die nog niet in de
+#   database stonden terug in het register en de presence.
+#   Alleen de engine schrijft (één proces, via de engine-lock).
 # ============================================================
 
-@app.route('/status', methods=['GET'])
-def status():
-    return jsonify({"status": "online", "version": "10.36"}), 200
+JOURNAL_DIR            = os.path.expanduser("~/barkr/journal")
+JOURNAL_SEGMENT_BYTES  = 4 * 1024 * 1024
+JOURNAL_MAX_SEGMENTS   = 8     # gesloten segmenten voordat er gecompacteerd wordt
+JOURNAL_DECISION_DAYS  = 90    # beslissingen zo lang bewaren bij compactie
 
+EV_PING       = 1  # vlag 1 = ontgrendeld; tekst = naam
+EV_WINDOW     = 2  # vlag: 0 = niet bewaakt, 1 = actief, 2 = alarm; tekst = "HH:MM-HH:MM"
+EV_INACTIVITY = 3  # inactiviteitsmelding in de wachtrij gezet
 
-@app.route('/heartbeat', methods=['POST'])
-def heartbeat():
-    """Ontvangt telefoonnummer + naam. Pi bepaalt tijdvenster zelf."""
-    data = request.get_json(silent=True)
-    if not data or not authenticate(data):
-        return jsonify({"status": "error"}), 403
+WINDOW_UNMONITORED, WINDOW_ACTIVE, WINDOW_ALARM = 0, 1, 2
 
-    device_id     = (data.get('device_id') or '').strip()
-    own_phone     = normalize_phone(data.get('own_phone', ''))
-    user_name     = (data.get('name') or '').strip()
-    source        = data.get('source', 'unknown')
-    device_status = data.get('device_status', 'unknown')
+_JOURNAL_HEADER = struct.Struct("<II")   # lengte body, crc32(body)
+_JOURNAL_BODY   = struct.Struct("<BdB")  # soort, tijdstip, vlag
+_JOURNAL_STR    = struct.Struct("<H")
 
-    if not device_id:
-        # Fallback voor oude APK versies: gebruik own_phone als device_id
-        if own_phone and is_valid_phone(own_phone):
-            device_id = own_phone
-        else:
-            return jsonify({"status": "ignored", "reason": "geen device_id"}), 200
 
-    now_str      = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    current_time = time.time()
+def _journal_encode(kind: int, ts: float, device_id: str, flag: int = 0, text: str = "") -> bytes:
+    body = bytearray(_JOURNAL_BODY.pack(kind, ts, flag))
+    for value in (device_id, text):
+        raw = value.encode()[:0xFFFF]
+        body += _JOURNAL_STR.pack(len(raw)) + raw
+    return _JOURNAL_HEADER.pack(len(body), zlib.crc32(body)) + bytes(body)
 
-    state = user_states.get(own_phone, {"status": "offline", "last_ping": 0, "name": user_name})
-    if state["status"] == "offline":
-        log_status(f"📱 ONLINE → {user_name} [dev:{device_id[:8]}] | bron: {source}")
 
-    # Haal tijdvenster op voor logging — zoek op device_id, dan own_phone, dan naam
-    conn_tmp = get_db()
-    c_tmp = conn_tmp.cursor()
-    # Eerst exact device_id
-    c_tmp.execute("SELECT schedules, device_id FROM users WHERE device_id=?", (device_id,))
-    row_tmp = c_tmp.fetchone()
-    matched_by = "device_id"
-    # Fallback: own_phone
-    if not row_tmp and own_phone:
-        c_tmp.execute("SELECT schedules, device_id FROM users WHERE own_phone=? ORDER BY rowid DESC LIMIT 1", (own_phone,))
-        row_tmp = c_tmp.fetchone()
-        matched_by = "own_phone"
-    # Fallback: naam
-    if not row_tmp and user_name:
-        c_tmp.execute("SELECT schedules, device_id FROM users WHERE user_name=? ORDER BY rowid DESC LIMIT 1", (user_name,))
-        row_tmp = c_tmp.fetchone()
-        matched_by = "naam"
-    conn_tmp.close()
+def _journal_decode(body: bytes) -> tuple:
+    kind, ts, flag = _JOURNAL_BODY.unpack_from(body)
+    pos, strings = _JOURNAL_BODY.size, []
+    for _ in range(2):
+        (size,) = _JOURNAL_STR.unpack_from(body, pos)
+        pos += _JOURNAL_STR.size
+        strings.append(body[pos:pos + size].decode())
+        pos += size
+    return kind, ts, strings[0], flag, strings[1]
 
-    window_info = "geen venster"
-    if row_tmp and row_tmp[0]:
+
+class EventJournal:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._file = None
+        self._seq = 0
+        self._size = 0
+        self.appended = 0
+
+    @property
+    def active(self) -> bool:
+        return self._file is not None
+
+    @property
+    def seq(self) -> int:
+        """Segment waar nu in geschreven wordt."""
+        return self._seq
+
+    def _segments(self) -> list:
         try:
-            scheds = json.loads(row_tmp[0])
-            day_idx = datetime.now().weekday()
-            sched = scheds.get(str(day_idx), {})
-            ws = sched.get('startTime', '00:00')
-            we = sched.get('endTime', '00:00')
-            if ws != '00:00' or we != '00:00':
-                window_info = f"{ws}–{we}"
-        except Exception:
-            pass
-        # Als gevonden via andere sleutel: koppel device_id zodat volgende keer direct gevonden wordt
-        if matched_by != "device_id" and row_tmp[1] != device_id:
-            conn_fix = get_db()
-            c_fix = conn_fix.cursor()
-            c_fix.execute("UPDATE users SET device_id=? WHERE device_id=?", (device_id, row_tmp[1]))
-            conn_fix.commit()
-            conn_fix.close()
-            log_status(f"   🔗 Device_id bijgewerkt: {row_tmp[1][:8]} → {device_id[:8]} (gevonden via {matched_by})")
-    else:
-        log_status(f"   ⚠️ Geen instellingen gevonden voor device:{device_id[:8]} phone:{own_phone} naam:{user_name}")
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(n[:-4]) for n in names if n.endswith(".seg") and n[:-4].isdigit())
 
-    source = data.get('source', 'webview')
-    status_icon = "🔓" if device_status == "unlocked" else "🔒"
-    status_txt = "IN GEBRUIK" if device_status == "unlocked" else "VERGRENDELD"
-    log_status(f"💓 {status_icon} PING -> {user_name} [dev:{device_id[:8]}] | {status_txt} | venster: {window_info} | bron: {source}")
-    user_states[own_phone] = {"status": "online", "last_ping": current_time, "name": user_name}
-
-    updated = update_ping(device_id, now_str)
-    if not updated:
-        upsert_user(device_id, {
-            'user_name': user_name, 'contacts': '[]',
-            'schedules': '{}', 'vacation_mode': False, 'notify_self': True,
-        })
-        update_ping(device_id, now_str)
-        log_status(f"👤 NIEUWE GEBRUIKER → {user_name} [dev:{device_id[:8]}]")
+    def _path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{seq:08d}.seg")
 
-    # Update naam en last_unlocked_ping als toestel in gebruik is
-    conn = get_db()
-    c = conn.cursor()
-    if device_status == 'unlocked':
-        c.execute("UPDATE users SET user_name=?, last_unlocked_ping=? WHERE device_id=?", (user_name, now_str, device_id))
-    else:
-        c.execute("UPDATE users SET user_name=? WHERE device_id=?", (user_name, device_id))
-    conn.commit()
-    conn.close()
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self._segments()
+        with self._lock:
+            self._seq = (segments[-1] if segments else 0) + 1
+            self._file = open(self._path(self._seq), "ab")
+            self._size = 0
 
-    return jsonify({"status": "received"}), 200
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
 
+    def append(self, kind: int, device_id: str, flag: int = 0, text: str = "", ts: float | None = None):
+        """Hot path: één write naar de OS-buffer; fsync gebeurt in sync()."""
+        if self._file is None:
+            return
+        record = _journal_encode(kind, time.time() if ts is None else ts, device_id, flag, text)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(record)
+            self._file.flush()
+            self._size += len(record)
+            self.appended += 1
+            if self._size >= JOURNAL_SEGMENT_BYTES:
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._seq += 1
+                self._file = open(self._path(self._seq), "ab")
+                self._size = 0
 
-@app.route('/ping', methods=['POST'])
-def ping():
-    """Backward compatible endpoint voor WebView pings."""
-    data = request.get_json(silent=True)
-    if not data or not authenticate(data):
-        return jsonify({"status": "error"}), 403
+    def sync(self):
+        with self._lock:
+            if self._file:
+                os.fsync(self._file.fileno())
 
-    device_id = (data.get('device_id') or '').strip()
-    own_phone = normalize_phone(data.get('own_phone', ''))
-    user_name = (data.get('name') or '').strip()
+    def read(self, seq: int, repair: bool = False):
+        """Leest de records van één segment; stopt bij de eerste kapotte.
 
-    if not device_id and (not own_phone or not is_valid_phone(own_phone)):
-        return jsonify({"status": "ignored", "reason": "geen device_id of geldig nummer"}), 200
+        Met repair wordt het segment daar afgekapt (halve write bij crash).
+        """
+        path = self._path(seq)
+        with open(path, "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + _JOURNAL_HEADER.size <= len(data):
+            size, crc = _JOURNAL_HEADER.unpack_from(data, pos)
+            body = data[pos + _JOURNAL_HEADER.size:pos + _JOURNAL_HEADER.size + size]
+            if len(body) != size or zlib.crc32(body) != crc:
+                break
+            yield _journal_decode(body)
+            pos += _JOURNAL_HEADER.size + size
+        if pos < len(data):
+            log_status(f"⚠️ JOURNAL {seq:08d}.seg beschadigd vanaf byte {pos} ({len(data) - pos} bytes)")
+            if repair:
+                with open(path, "r+b") as f:
+                    f.truncate(pos)
 
-    now_str      = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    current_time = time.time()
+    def events(self, repair: bool = False, since: int = 0):
+        """Alle records in volgorde (vanaf segment `since`), behalve het
+        segment waar nu in geschreven wordt."""
+        for seq in self._segments():
+            if seq >= since and (self._file is None or seq != self._seq):
+                yield from self.read(seq, repair)
 
-    state = user_states.get(device_id or own_phone, {"status": "offline", "last_ping": 0, "name": user_name})
-    if state["status"] == "offline":
-        log_status(f"📱 ONLINE → {user_name} [dev:{device_id[:8] if device_id else own_phone[:8]}] | bron: webview")
+    def compact(self) -> int:
+        """Voegt gesloten segmenten samen: laatste ping per toestel + beslissingen."""
+        closed = [s for s in self._segments() if s < self._seq]
+        if len(closed) <= JOURNAL_MAX_SEGMENTS:
+            return 0
+        keep_after = time.time() - JOURNAL_DECISION_DAYS * 86400
+        last_ping: dict = {}
+        decisions = []
+        for seq in closed:
+            for event in self.read(seq):
+                kind, ts, device_id = event[0], event[1], event[2]
+                if kind == EV_PING:
+                    previous = last_ping.get(device_id)
+                    if previous is None or ts >= previous[1]:
+                        last_ping[device_id] = event
+                elif ts >= keep_after:
+                    decisions.append(event)
+        events = sorted(list(last_ping.values()) + decisions, key=lambda e: e[1])
+        target = self._path(closed[-1])
+        tmp = target + ".tmp"
+        with open(tmp, "wb") as f:
+            for kind, ts, device_id, flag, text in events:
+                f.write(_journal_encode(kind, ts, device_id, flag, text))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, target)
+        for seq in closed[:-1]:
+            os.remove(self._path(seq))
+        log_status(f"🗜️ JOURNAL GECOMPACTEERD → {len(closed)} segmenten → {len(events)} records")
+        return len(closed) - 1
 
-    # Haal tijdvenster op voor logging — zoek op device_id, dan own_phone, dan naam
-    conn_tmp = get_db()
-    c_tmp = conn_tmp.cursor()
-    # Eerst exact device_id
-    c_tmp.execute("SELECT schedules, device_id FROM users WHERE device_id=?", (device_id,))
-    row_tmp = c_tmp.fetchone()
-    matched_by = "device_id"
-    # Fallback: own_phone
-    if not row_tmp and own_phone:
-        c_tmp.execute("SELECT schedules, device_id FROM users WHERE own_phone=? ORDER BY rowid DESC LIMIT 1", (own_phone,))
-        row_tmp = c_tmp.fetchone()
-        matched_by = "own_phone"
-    # Fallback: naam
-    if not row_tmp and user_name:
-        c_tmp.execute("SELECT schedules, device_id FROM users WHERE user_name=? ORDER BY rowid DESC LIMIT 1", (user_name,))
-        row_tmp = c_tmp.fetchone()
-        matched_by = "naam"
-    conn_tmp.close()
 
-    window_info = "geen venster"
-    if row_tmp and row_tmp[0]:
-        try:
-            scheds = json.loads(row_tmp[0])
-            day_idx = datetime.now().weekday()
-            sched = scheds.get(str(day_idx), {})
-            ws = sched.get('startTime', '00:00')
-            we = sched.get('endTime', '00:00')
-            if ws != '00:00' or we != '00:00':
-                window_info = f"{ws}–{we}"
-        except Exception:
-            pass
-        # Als gevonden via andere sleutel: koppel device_id zodat volgende keer direct gevonden wordt
-        if matched_by != "device_id" and row_tmp[1] != device_id:
-            conn_fix = get_db()
-            c_fix = conn_fix.cursor()
-            c_fix.execute("UPDATE users SET device_id=? WHERE device_id=?", (device_id, row_tmp[1]))
-            conn_fix.commit()
-            conn_fix.close()
-            log_status(f"   🔗 Device_id bijgewerkt: {row_tmp[1][:8]} → {device_id[:8]} (gevonden via {matched_by})")
-    else:
-        log_status(f"   ⚠️ Geen instellingen gevonden voor device:{device_id[:8]} phone:{own_phone} naam:{user_name}")
+journal = EventJournal(JOURNAL_DIR)
 
-    source = data.get('source', 'webview')
-    log_status(f"💓 PING → {user_name} [dev:{device_id[:8]}] | venster: {window_info} | bron: {source}")
-    user_states[own_phone] = {"status": "online", "last_ping": current_time, "name": user_name}
 
-    updated = update_ping(device_id, now_str)
-    if not updated:
-        upsert_user(device_id, {
-            'user_name': user_name, 'contacts': '[]',
-            'schedules': '{}', 'vacation_mode': False, 'notify_self': True,
-        })
-        update_ping(own_phone, now_str)
+def replay_journal(since: int = 0) -> int:
+    """Zet pings uit het journal terug in het register en de presence.
 
-    # WebView ping = gebruiker heeft toestel open = altijd IN GEBRUIK
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("UPDATE users SET user_name=?, last_unlocked_ping=? WHERE device_id=?", (user_name, now_str, device_id))
-    conn.commit()
-    conn.close()
+    Pings die na de laatste flush binnenkwamen (crash, stroomuitval) gaan
+    zo niet verloren; last-write-wins laat nieuwere databasewaarden staan.
+    Met een snapshot (zie STARTUP STATE) alleen de staart vanaf `since`.
+    """
+    started = time.time()
+    newest: dict = {}
+    count = 0
+    for kind, ts, device_id, flag, text in journal.events(repair=True, since=since):
+        count += 1
+        if kind != EV_PING:
+            continue
+        ping_ts = int(ts)
+        last, unlocked = newest.get(device_id, (0, 0))
+        newest[device_id] = (max(last, ping_ts), max(unlocked, ping_ts if flag & 1 else 0))
+    pings = []
+    for device_id, (ping_ts, unlocked_ts) in newest.items():
+        pings.append((device_id, ping_ts, False))
+        if unlocked_ts:
+            pings.append((device_id, unlocked_ts, True))
+    restored = sum(1 for r in registry.record_pings(pings) if r == "applied")
+    online = 0
+    for device_id, (ping_ts, _unlocked) in newest.items():
+        entry = registry.get(device_id)
+        if entry and presence.seen(device_id, ping_ts, entry["user_name"], log=False):
+            online += 1
+    log_status(f"📜 JOURNAL TERUGGESPEELD → {count} records, {len(newest)} toestellen, "
+               f"{restored} pings hersteld, {online} online ({(time.time() - started) * 1000:.0f} ms)")
+    return restored
+
+
+def journal_maintenance():
+    last_snapshot = time.time()
+    while True:
+        time.sleep(REGISTRY_FLUSH_INTERVAL)
+        try:
+            journal.sync()
+            journal.compact()
+            if time.time() - last_snapshot >= SNAPSHOT_INTERVAL:
+                last_snapshot = time.time()
+                write_snapshot()
+        except Exception as e:
+            log_status(f"⚠️ JOURNAL FOUT: {e}")
+
+
+# ============================================================
+#   DEADLINE SCHEDULER
+#
+#   In plaats van elke 5 seconden de hele users-tabel te scannen
+#   houdt de engine per toestel de eerstvolgende deadlines bij in
+#   een prioriteitswachtrij: einde tijdvenster, FCM wake-up en
+#   inactiviteitsgrens. De loop slaapt tot de vroegste deadline en
+#   bekijkt alleen het toestel waarvan de deadline verstreken is.
+# ============================================================
+
+KIND_WINDOW     = "window"
+KIND_FCM        = "fcm"
+KIND_INACTIVITY = "inactivity"
+
+OFFLINE_CHECK_INTERVAL    = 5    # seconden, in-memory offline detectie
+FCM_RETRY_INTERVAL        = 60   # seconden na mislukte wake-up
+INACTIVITY_RETRY_INTERVAL = 300  # seconden na mislukte inactiviteitsmelding
+FCM_MAX_PARALLEL          = 8    # gelijktijdige wake-ups per batch
+RECONCILE_INTERVAL        = 60   # seconden tussen indexgestuurde vangnet-queries
+
+
+class DeadlineScheduler:
+    """Prioriteitswachtrij met per (device_id, soort) hooguit één deadline.
+
+    Het uitstellen van een deadline (bijv. door een heartbeat) kost alleen
+    een dict-update: het oude heap-item blijft staan en wordt bij het
+    uitnemen opnieuw ingepland op de nieuwe tijd. Een vervroeging voegt
+    een nieuw heap-item toe en wekt de engine.
+    """
+
+    def __init__(self):
+        self._heap: list = []
+        self._due: dict = {}
+        self._cond = threading.Condition()
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._due)
+
+    def schedule(self, device_id: str, kind: str, due: float):
+        with self._cond:
+            key = (device_id, kind)
+            current = self._due.get(key)
+            self._due[key] = due
+            if current is not None and current <= due:
+                return  # uitgesteld — oud heap-item verschuift lazy
+            heapq.heappush(self._heap, (due, device_id, kind))
+            if self._heap[0][0] == due:
+                self._cond.notify()
+            self._compact()
+
+    def postpone(self, device_id: str, kind: str, due: float):
+        """Verzet een bestaande deadline; doet niets als er geen is."""
+        with self._cond:
+            if (device_id, kind) not in self._due:
+                return
+        self.schedule(device_id, kind, due)
+
+    def cancel(self, device_id: str, kind: str | None = None):
+        with self._cond:
+            kinds = (kind,) if kind else (KIND_WINDOW, KIND_FCM, KIND_INACTIVITY)
+            for k in kinds:
+                self._due.pop((device_id, k), None)
+            self._compact()
+
+    def pop_due(self, now: float) -> dict:
+        """Haalt alle verstreken deadlines op als {device_id: {soorten}}."""
+        fired: dict = {}
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                due, device_id, kind = heapq.heappop(self._heap)
+                key = (device_id, kind)
+                current = self._due.get(key)
+                if current is None or current < due:
+                    continue  # geannuleerd of vervroegd
+                if current > due:
+                    heapq.heappush(self._heap, (current, device_id, kind))
+                    continue  # uitgesteld
+                del self._due[key]
+                fired.setdefault(device_id, set()).add(kind)
+        return fired
+
+    def wait(self, max_wait: float):
+        """Slaapt tot de vroegste deadline, een vervroeging of max_wait."""
+        with self._cond:
+            timeout = max_wait
+            if self._heap:
+                timeout = min(max_wait, max(0.0, self._heap[0][0] - time.time()))
+            if timeout > 0:
+                self._cond.wait(timeout)
+
+    def _compact(self):
+        # Geannuleerde/vervroegde items opruimen zodat de heap niet groeit
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(due, dev, kind) for (dev, kind), due in self._due.items()]
+            heapq.heapify(self._heap)
+
+
+scheduler = DeadlineScheduler()
+metrics.gauge("barkr_scheduler_deadlines", "Ingeplande deadlines.", lambda: len(scheduler))
+
+
+class _Presence:
+    __slots__ = ("ts", "online", "name", "queued")   # ts = laatste ping
+
+    def __init__(self, name: str):
+        self.ts, self.online, self.name, self.queued = 0.0, False, name, 0.0
+
+
+class PresenceTracker:
+    """Online/offline per device_id, met een verloopheap.
+
+    Alleen online toestellen staan in de heap, elk hooguit één keer; een
+    nieuwe ping verschuift alleen de verlooptijd in het record en het oude
+    heap-item wordt bij het uitnemen opnieuw ingepland (zoals bij de
+    DeadlineScheduler). expire() kost zo O(verlopen) i.p.v. O(alle).
+    De records staan in een begrensde StateStore: offline toestellen
+    verdwijnen na STATE_TTL, bij meer dan STATE_MAX_DEVICES gaat de
+    langst stille eruit. ONLINE en OFFLINE worden als events gelogd.
+    """
+
+    def __init__(self, timeout: float = PING_TIMEOUT, max_entries: int = STATE_MAX_DEVICES,
+                 ttl: float = STATE_TTL):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._store = StateStore("presence", max_entries, max(ttl, timeout))
+        self._heap: list = []     # (verloopt_om, device_id); record.queued = het geldige item
+        self._online = 0
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+    def online_count(self) -> int:
+        return self._online
+
+    def get(self, device_id: str) -> dict | None:
+        with self._lock:
+            state = self._store.get(device_id)
+            if state is None:
+                return None
+            return {"status": "online" if state.online else "offline", "last_ping": state.ts, "name": state.name}
+
+    def _dropped(self, evicted: list):
+        for _key, state in evicted:
+            if state.online:
+                self._online -= 1  # heap-item vervalt bij het uitnemen
+
+    def seen(self, device_id: str, ping_ts: float, name: str, source: str = "", log: bool = True) -> bool:
+        """Verwerkt een ping; True als het toestel hierdoor online komt."""
+        if not device_id:
+            return False
+        fresh = time.time() - ping_ts < self.timeout
+        with self._lock:
+            state = self._store.get(device_id)
+            if state and state.ts >= ping_ts:
+                return False
+            if state is None:
+                state = _Presence(name)
+            came_online = fresh and not state.online
+            state.ts, state.name = ping_ts, name or state.name
+            self._dropped(self._store.put(device_id, state))
+            if came_online:
+                state.online = True
+                self._online += 1
+                state.queued = ping_ts + self.timeout
+                heapq.heappush(self._heap, (state.queued, device_id))
+        if came_online and log:
+            log_status(f"📱 ONLINE → {name} [dev:{device_id[:8]}]" + (f" | bron: {source}" if source else ""),
+                       event="online", device_id=device_id, source=source)
+        return came_online
+
+    def expire(self, now: float) -> int:
+        """Zet toestellen waarvan de timeout verstreken is op offline en
+        ruimt records op die langer dan de ttl stil zijn."""
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] < now:
+                queued, device_id = heapq.heappop(self._heap)
+                state = self._store.get(device_id)
+                if state is None or not state.online or state.queued != queued:
+                    continue  # vergeten, al offline of een verouderd item
+                due = state.ts + self.timeout
+                if due >= now:
+                    state.queued = due
+                    heapq.heappush(self._heap, (due, device_id))
+                    continue  # intussen gepingd
+                state.online = False
+                self._online -= 1
+                expired.append((device_id, state.name, now - state.ts))
+            self._dropped(self._store.evict(now))
+        for device_id, name, silent in expired:
+            log_status(f"📵 OFFLINE → {name or '?'} [dev:{device_id[:8]}] | {int(silent)}s geen ping",
+                       event="offline", device_id=device_id)
+        return len(expired)
+
+    def forget(self, device_id: str):
+        with self._lock:
+            state = self._store.pop(device_id)
+            if state:
+                self._dropped([(device_id, state)])
+
+
+presence = PresenceTracker()
+metrics.gauge("barkr_devices_online", "Toestellen met een recente ping (engine).", presence.online_count)
+
+
+def _fmt_ts(ts: int) -> str:
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else ""
+
+
+def _next_midnight(now: datetime) -> float:
+    return datetime.combine(now.date() + timedelta(days=1), datetime.min.time()).timestamp() + 1
+
+
+def load_user(device_id: str) -> dict | None:
+    conn = get_db()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("SELECT * FROM users WHERE device_id=?", (device_id,))
+    row = c.fetchone()
+    conn.close()
+    return registry.overlay(dict(row)) if row else None
+
+
+def window_grace() -> float:
+    """Seconden na het einde van een venster voordat de engine beslist.
+
+    Met meerdere workers komen hun pings via sync_from_db binnen, in een
+    cluster via het updatelog van de andere nodes.
+    """
+    grace = SYNC_LOOKBACK if _multi_worker else 0
+    if cluster:
+        grace += CLUSTER_WINDOW_GRACE
+    return grace
+
+
+def schedule_device(user: dict, now: datetime | None = None, fired: set = frozenset()):
+    """(Her)plant alle deadlines van één toestel op basis van zijn record.
+
+    `fired` bevat de soorten die net verwerkt zijn; die krijgen een
+    minimale wachttijd zodat een mislukte poging niet direct herhaalt.
+    Buiten de engine een no-op: niemand leegt daar de scheduler, de
+    engine plant het toestel zelf in via sync_from_db.
+    """
+    if not _engine_started:
+        return
+    now       = now or datetime.now()
+    now_ts    = now.timestamp()
+    own_phone = user.get('own_phone', '')
+    device_id = user.get('device_id', own_phone) or own_phone
+    if not device_id:
+        return
+    if user.get('vacation_mode') or (cluster and not cluster.owns(device_id)):
+        scheduler.cancel(device_id)
+        return
+
+    # Einde tijdvenster vandaag, anders herberekenen om middernacht.
+    # Pas beslissen als pings uit het venster die via andere workers
+    # binnenkwamen er zeker zijn; decide_window kijkt naar het
+    # vensterbewijs, latere pings veranderen de uitkomst dus niet
+    window_due = _next_midnight(now)
+    start_min, end_min = todays_window_minutes(user, now)
+    if start_min < end_min:
+        decide_ts = _local_ts(now, end_min) + 1 + window_grace()
+        if now_ts < decide_ts:
+            window_due = decide_ts
+        elif not alarm_already_fired(device_id, now.strftime("%Y-%m-%d"),
+                                     _minutes_to_hhmm(start_min), _minutes_to_hhmm(end_min)):
+            window_due = now_ts
+    scheduler.schedule(device_id, KIND_WINDOW, window_due)
+
+    # Zonder ping nog geen grens; de deadline bestaat wel zodat de
+    # eerste heartbeat hem via touch_deadlines kan verzetten
+    last_ping_ts = user.get('last_ping_ts') or now_ts + FCM_WAKEUP_INTERVAL
+
+    _schedule_fcm(device_id, user, last_ping_ts, now_ts, fired)
+
+    # Inactiviteitsmelding — alleen als er ook iemand te melden valt
+    if user.get('notify_self', 1) and is_valid_phone(own_phone):
+        inactivity_due = last_ping_ts + INACTIVITY_HOURS * 3600
+        if (user.get('last_inactivity_alert_ts') or 0) >= _local_ts(now, 0):
+            inactivity_due = max(inactivity_due, _next_midnight(now))
+        elif KIND_INACTIVITY in fired:
+            inactivity_due = max(inactivity_due, now_ts + INACTIVITY_RETRY_INTERVAL)
+        scheduler.schedule(device_id, KIND_INACTIVITY, inactivity_due)
+    else:
+        scheduler.cancel(device_id, KIND_INACTIVITY)
+
+
+def _schedule_fcm(device_id: str, user: dict, last_ping_ts: float, now_ts: float, fired: set = frozenset()):
+    """FCM wake-up zodra de laatste ping > 2 minuten oud is.
+
+    Zonder service account sleutel geen deadline: die zou elke retry
+    opnieuw afgaan en het toestel laden voor niets. Zodra de sleutel
+    verschijnt plant reseed_fcm_deadlines() ze alsnog in.
+    """
+    if not user.get('fcm_token') or not fcm_credentials.available:
+        scheduler.cancel(device_id, KIND_FCM)
+        return
+    last_fcm_ts = user.get('last_fcm_wakeup_ts') or 0
+    fcm_due = last_ping_ts + PING_TIMEOUT + 1
+    if last_fcm_ts:
+        fcm_due = max(fcm_due, last_fcm_ts + FCM_WAKEUP_INTERVAL + 1)
+    if KIND_FCM in fired:
+        fcm_due = max(fcm_due, now_ts + FCM_RETRY_INTERVAL)
+    scheduler.schedule(device_id, KIND_FCM, fcm_due)
+
+
+def reseed_fcm_deadlines() -> int:
+    """Plant de FCM deadlines van alle toestellen met een token (sleutel net geladen)."""
+    if not _engine_started:
+        return 0
+    conn = get_db()
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute("""SELECT device_id, fcm_token, last_ping_ts, last_fcm_wakeup_ts FROM users
+                           WHERE fcm_token != '' AND vacation_mode = 0""").fetchall()
+    conn.close()
+    now_ts = time.time()
+    count = 0
+    for row in rows:
+        user = registry.overlay(dict(row))
+        if cluster and not cluster.owns(user['device_id']):
+            continue
+        last_ping_ts = user.get('last_ping_ts') or now_ts + FCM_WAKEUP_INTERVAL
+        _schedule_fcm(user['device_id'], user, last_ping_ts, now_ts)
+        count += 1
+    log_status(f"⏰ FCM DEADLINES INGEPLAND → {count} toestellen")
+    return count
+
+
+# Alleen de getypeerde kolommen die schedule_device nodig heeft
+_SCHEDULE_COLUMNS = ("device_id", "own_phone", "vacation_mode", "notify_self", "fcm_token",
+                     "schedule_packed", "last_ping_ts", "last_fcm_wakeup_ts", "last_inactivity_alert_ts")
+
+
+def stale_candidates(now_ts: float) -> dict:
+    """Indexgestuurde range queries naar toestellen die nu aan de beurt zijn.
+
+    Geeft {device_id: {soorten}} voor toestellen die > 2 minuten stil zijn
+    en een wake-up mogen krijgen, en voor toestellen die langer dan
+    INACTIVITY_HOURS stil zijn en vandaag nog geen melding kregen.
+    """
+    now_ts = int(now_ts)
+    today_ts = int(_local_ts(datetime.fromtimestamp(now_ts), 0))
+    found: dict = {}
+    conn = get_db()
+    c = conn.cursor()
+    if fcm_credentials.available:
+        c.execute("""SELECT device_id FROM users
+                     WHERE fcm_token != '' AND last_ping_ts > 0 AND last_ping_ts < ?
+                       AND last_fcm_wakeup_ts < ? AND vacation_mode = 0""",
+                  (now_ts - PING_TIMEOUT, now_ts - FCM_WAKEUP_INTERVAL))
+        for (device_id,) in c.fetchall():
+            found.setdefault(device_id, set()).add(KIND_FCM)
+    c.execute("""SELECT device_id FROM users
+                 WHERE last_ping_ts > 0 AND last_ping_ts < ? AND last_inactivity_alert_ts < ?
+                   AND notify_self = 1 AND own_phone != '' AND vacation_mode = 0""",
+              (now_ts - INACTIVITY_HOURS * 3600, today_ts))
+    for (device_id,) in c.fetchall():
+        found.setdefault(device_id, set()).add(KIND_INACTIVITY)
+    conn.close()
+    return found
+
+
+def reconcile_stale(now_ts: float):
+    """Vangnet: plant kandidaten uit de database direct in.
+
+    De verwerking controleert daarna met de actuele registerstand of de
+    wake-up of melding echt nodig is.
+    """
+    for device_id, kinds in stale_candidates(now_ts).items():
+        if cluster and not cluster.owns(device_id):
+            continue
+        for kind in kinds:
+            scheduler.postpone(device_id, kind, now_ts)
+
+
+def touch_deadlines(device_id: str, ping_ts: float):
+    """Een ping verschuift de wake-up- en inactiviteitsgrens van het toestel."""
+    if not _engine_started:
+        return
+    scheduler.postpone(device_id, KIND_FCM, ping_ts + PING_TIMEOUT + 1)
+    scheduler.postpone(device_id, KIND_INACTIVITY, ping_ts + INACTIVITY_HOURS * 3600)
+
+
+def seed_scheduler():
+    """Plant bij opstart alle deadlines in, uit de rijen van load_startup_state."""
+    global _startup_rows
+    users, _startup_rows = _startup_rows, None
+    if users is None:
+        conn = get_db()
+        conn.row_factory = sqlite3.Row
+        users = [dict(row) for row in conn.execute(f"SELECT {', '.join(_SCHEDULE_COLUMNS)} FROM users")]
+        conn.close()
+    now = datetime.now()
+    for row in users:
+        schedule_device(registry.overlay(dict(row)), now)
+    log_status(f"⏰ SCHEDULER GEVULD → {len(users)} toestellen, {len(scheduler)} deadlines")
+
+
+# ============================================================
+#   STARTUP STATE
+#
+#   De engine schrijft elke SNAPSHOT_INTERVAL een snapshot van alle
+#   toestellen (register- en planningskolommen, met de actuele pings
+#   uit het register) naar ~/barkr/journal/snapshot.jsonl.gz, samen met
+#   het journalsegment waar het op dat moment in schreef. Bij opstart:
+#   snapshot inlezen, alleen de rijen ophalen die sindsdien instellingen
+#   of pings kregen (geïndexeerd op settings_updated_ts/last_ping_ts),
+#   en daarna de journalstaart vanaf dat segment terugspelen. Klopt het
+#   aantal rijen niet (verwijderd toestel, geen of kapotte snapshot),
+#   dan valt het terug op de volledige scan van users.
+#   Andere kolommen (laatste FCM/inactiviteitsmelding) kunnen in de
+#   snapshot achterlopen; dat kost hooguit een deadline die te vroeg
+#   afgaat, de verwerking leest het toestel dan vers uit de database.
+# ============================================================
+
+SNAPSHOT_FILE     = os.path.join(JOURNAL_DIR, "snapshot.jsonl.gz")
+SNAPSHOT_INTERVAL = 600   # seconden
+SNAPSHOT_VERSION  = 1
+SNAPSHOT_MARGIN   = 60    # seconden overlap voor transacties die nog liepen
+
+_SNAPSHOT_COLUMNS = tuple(dict.fromkeys(_REGISTRY_FIELDS + _SCHEDULE_COLUMNS))
+_startup_rows: list | None = None   # voor seed_scheduler; daarna weer None
+_startup_seq: int | None = None     # journalsegment vanaf waar teruggespeeld wordt
+
+
+def write_snapshot() -> int:
+    started = time.time()
+    since_seq = journal.seq
+    conn = get_db()
+    rows = conn.execute(f"SELECT rowid, {', '.join(_SNAPSHOT_COLUMNS)} FROM users ORDER BY rowid").fetchall()
+    conn.close()
+    header = {"version": SNAPSHOT_VERSION, "journal_seq": since_seq, "created": int(started), "rows": len(rows)}
+    tmp = SNAPSHOT_FILE + ".tmp"
+    os.makedirs(os.path.dirname(SNAPSHOT_FILE), exist_ok=True)
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        f.write(json.dumps(header) + "\n")
+        for row in rows:
+            record = registry.overlay(dict(zip(_SNAPSHOT_COLUMNS, row[1:])))
+            record["schedule_packed"] = (record["schedule_packed"] or b"").hex()
+            f.write(json.dumps([row[0], record], ensure_ascii=False) + "\n")
+    os.replace(tmp, SNAPSHOT_FILE)
+    log_status(f"📸 SNAPSHOT → {len(rows)} toestellen ({(time.time() - started) * 1000:.0f} ms)", level="debug")
+    return len(rows)
+
+
+def read_snapshot() -> tuple[dict, dict] | None:
+    """(header, {rowid: rij}) of None als er geen bruikbare snapshot is."""
+    try:
+        with gzip.open(SNAPSHOT_FILE, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != SNAPSHOT_VERSION:
+                return None
+            rows = {}
+            for line in f:
+                rowid, record = json.loads(line)
+                record["schedule_packed"] = bytes.fromhex(record["schedule_packed"]) or None
+                rows[rowid] = record
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, KeyError) as e:
+        log_status(f"⚠️ SNAPSHOT ONLEESBAAR → volledige scan ({e})")
+        return None
+    if len(rows) != header.get("rows"):
+        return None
+    return header, rows
+
+
+def load_startup_state(keep_rows: bool = True) -> int:
+    """Vult het register (en de rijen voor seed_scheduler) bij opstart.
+
+    Geeft het journalsegment vanaf waar teruggespeeld moet worden
+    (0 = alles, na een volledige scan). Gunicorn workers bewaren de rijen
+    niet: als een worker pas later engine wordt, zijn ze verouderd.
+    """
+    global _startup_rows, _startup_seq
+    started = time.time()
+    snapshot = read_snapshot()
+    since_seq, source = 0, "volledige scan"
+    rows = None
+    if snapshot:
+        header, rows = snapshot
+        since = header["created"] - SNAPSHOT_MARGIN
+        conn = get_db()
+        delta = conn.execute(f"SELECT rowid, {', '.join(_SNAPSHOT_COLUMNS)} FROM users "
+                             "WHERE settings_updated_ts >= ? OR last_ping_ts >= ?",
+                             (since, since - SYNC_LOOKBACK)).fetchall()
+        (total,) = conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        conn.close()
+        for row in delta:
+            rows[row[0]] = dict(zip(_SNAPSHOT_COLUMNS, row[1:]))
+        if len(rows) == total:
+            since_seq = header["journal_seq"]
+            source = f"snapshot + {len(delta)} gewijzigd"
+        else:
+            log_status(f"⚠️ SNAPSHOT VEROUDERD ({len(rows)} rijen, database {total}) → volledige scan")
+            rows = None
+    if rows is None:
+        conn = get_db()
+        rows = {row[0]: dict(zip(_SNAPSHOT_COLUMNS, row[1:])) for row in
+                conn.execute(f"SELECT rowid, {', '.join(_SNAPSHOT_COLUMNS)} FROM users")}
+        conn.close()
+    ordered = sorted(rows.items())
+    registry.load_rows(ordered)
+    _startup_rows = [row for _rowid, row in ordered] if keep_rows else None
+    _startup_seq = since_seq
+    log_status(f"🗂️ OPSTARTSTAND → {len(ordered)} toestellen uit {source} "
+               f"({(time.time() - started) * 1000:.0f} ms)")
+    return since_seq
+
+
+def fcm_wakeup_due(user: dict, now: datetime) -> bool:
+    # FCM wake-up als laatste ping > 2 minuten geleden
+    # Dit wekt de telefoon op ongeacht batterij-instellingen
+    last_ping_ts = user.get('last_ping_ts') or 0
+    if not last_ping_ts or not user.get('fcm_token') or not fcm_credentials.available:
+        return False
+    now_ts = now.timestamp()
+    last_fcm_ts = user.get('last_fcm_wakeup_ts') or 0
+    fcm_interval_ok = not last_fcm_ts or now_ts - last_fcm_ts > FCM_WAKEUP_INTERVAL
+    return now_ts - last_ping_ts > PING_TIMEOUT and fcm_interval_ok
+
+
+class FcmDispatcher:
+    """Verstuurt alle wake-ups van één tick gelijktijdig, met begrensde parallelliteit.
+
+    Geslaagde wake-ups worden in één transactie weggeschreven.
+    """
+
+    def __init__(self, max_parallel: int = FCM_MAX_PARALLEL):
+        self._executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="fcm")
+        self.last_batch = {"sent": 0, "ok": 0, "failed": 0, "duration": 0.0}
+
+    def dispatch(self, users: list, now: datetime) -> dict:
+        batch = [u for u in users if fcm_wakeup_due(u, now)]
+        if not batch:
+            return {"sent": 0, "ok": 0, "failed": 0, "duration": 0.0}
+        started = time.time()
+        # Token vooraf ophalen zodat niet elke thread apart gaat verversen
+        if get_fcm_access_token():
+            results = list(self._executor.map(
+                lambda u: send_fcm_wakeup(u['fcm_token'], u['device_id'], u.get('user_name', '')), batch))
+        else:
+            results = [False] * len(batch)
+
+        now_ts = int(now.timestamp())
+        done = [u for u, ok in zip(batch, results) if ok]
+        if done:
+            conn = get_db()
+            with conn:
+                conn.executemany("UPDATE users SET last_fcm_wakeup_ts=? WHERE device_id=?",
+                                 [(now_ts, u['device_id']) for u in done])
+            conn.close()
+            for u in done:
+                u['last_fcm_wakeup_ts'] = now_ts
+
+        stats = {"sent": len(batch), "ok": len(done), "failed": len(batch) - len(done),
+                 "duration": round(time.time() - started, 3)}
+        self.last_batch = stats
+        log_status(f"📡 FCM BATCH → {stats['sent']} wake-ups | ✅ {stats['ok']} | ❌ {stats['failed']} | {stats['duration']}s")
+        return stats
+
+
+fcm_dispatcher = FcmDispatcher()
+
+
+def inactivity_due(user: dict, now: datetime) -> bool:
+    # Inactiviteitsmelding — gebaseerd op device_id, niet telefoonnummer
+    last_ping_ts = user.get('last_ping_ts') or 0
+    return bool(last_ping_ts) and now.timestamp() - last_ping_ts >= INACTIVITY_HOURS * 3600
+
+
+def decide_window(user: dict, now: datetime) -> tuple | None:
+    """Beoordeelt het verstreken tijdvenster van vandaag, zonder bijwerkingen.
+
+    Geeft (uitkomst, start, eind) of None als er (nog) niets te beslissen is.
+    """
+    own_phone = user.get('own_phone', '')
+    device_id = user.get('device_id', own_phone) or own_phone
+
+    # Tijdvenster uit de voorgecompileerde weekplanning
+    start_min, end_min = todays_window_minutes(user, now)
+    if start_min >= end_min:
+        return None
+    start_ts = _local_ts(now, start_min)
+    end_ts   = _local_ts(now, end_min)
+    if now.timestamp() <= end_ts:
+        return None
+    start_str, end_str = _minutes_to_hhmm(start_min), _minutes_to_hhmm(end_min)
+
+    if alarm_already_fired(device_id, now.strftime("%Y-%m-%d"), start_str, end_str):
+        return None
+
+    # Controleer of de backend het venster volledig heeft bewaakt
+    # Bewijs: er moet een ping zijn ontvangen TIJDENS het venster (tussen start en eind)
+    # Een ping NA het venster telt niet — dan was de app niet actief tijdens het venster.
+    # window_*_ts is het bewijs uit het venster zelf; last_*_ts kan intussen
+    # al een ping van na het einde zijn (de beslissing kan later vallen)
+    if not any(ts and start_ts <= ts <= end_ts
+               for ts in (user.get('window_ping_ts'), user.get('last_ping_ts'))):
+        return WINDOW_UNMONITORED, start_str, end_str
+
+    # Bewijs van leven = unlocked ping binnen het venster
+    if any(ts and start_ts <= ts <= end_ts + WINDOW_UNLOCK_SLACK
+           for ts in (user.get('window_unlocked_ts'), user.get('last_unlocked_ts'))):
+        return WINDOW_ACTIVE, start_str, end_str
+    return WINDOW_ALARM, start_str, end_str
+
+
+def apply_window_decision(user: dict, now: datetime, decision: tuple):
+    """Voert een vensterbeslissing uit: loggen, journal, alarm, vastleggen.
+
+    Alleen de engine markeert een alarm als gevuurd, pas na het uitvoeren;
+    mislukt dat, dan beslist de volgende pass opnieuw. Een shard kent de
+    alarmen van de engine niet, dus een ALARM hier nog een keer controleren;
+    ACTIVE en UNMONITORED worden altijd gelogd.
+    """
+    own_phone = user.get('own_phone', '')
+    device_id = user.get('device_id', own_phone) or own_phone
+    user_name = user.get('user_name', own_phone)
+    outcome, start_str, end_str = decision
+    if outcome == WINDOW_ALARM and alarm_already_fired(device_id, now.strftime("%Y-%m-%d"), start_str, end_str):
+        return
+
+    fields = {"event": "window", "device_id": device_id, "window": f"{start_str}-{end_str}"}
+    log_status(f"🏁 Deadline {end_str} bereikt voor {user_name} [dev:{device_id[:8]}]", level="debug", **fields)
+    if outcome == WINDOW_UNMONITORED:
+        log_status(f"⏭️ GEEN ALARM → {user_name} [dev:{device_id[:8]}] — geen ping ontvangen tijdens venster {start_str}–{end_str}, bewaking niet volledig",
+                   outcome="unmonitored", **fields)
+    elif outcome == WINDOW_ACTIVE:
+        log_status(f"✅ GEEN ALARM → {user_name} [dev:{device_id[:8]}] was actief binnen venster {start_str}–{end_str} (laatste actief: {_fmt_ts(user.get('last_unlocked_ts') or 0)})",
+                   outcome="active", **fields)
+    else:
+        log_status(f"🚨 ALARM WORDT VERSTUURD → {user_name} [dev:{device_id[:8]}] | geen activiteit in venster {start_str}–{end_str}"
+                   f" | laatste ping: {_fmt_ts(user.get('last_ping_ts') or 0)} | laatste actief: {_fmt_ts(user.get('last_unlocked_ts') or 0) or 'nooit'}",
+                   level="warning", outcome="alarm", **fields)
+    journal.append(EV_WINDOW, device_id, outcome, f"{start_str}-{end_str}")
+    if outcome == WINDOW_ALARM:
+        # In een cluster verstuurt alleen de node die de claim wint
+        if cluster and not cluster.claim(f"alarm|{device_id}|{now:%Y-%m-%d}|{start_str}|{end_str}"):
+            log_status(f"⏭️ ALARM AL VERSTUURD DOOR ANDERE NODE → {user_name} [dev:{device_id[:8]}]")
+        else:
+            escalate_user(user, start_str, end_str)
+    mark_alarm_fired(device_id, now.strftime("%Y-%m-%d"), start_str, end_str)
+
+
+def evaluate_device(user: dict, kinds: set, now: datetime) -> dict:
+    """Beoordeelt de verstreken deadlines van één toestel; alleen lezen.
+
+    Draait in de engine zelf of in een shard-proces (zie SHARDED ENGINE).
+    """
+    if user.get('vacation_mode'):
+        return {"inactivity": False, "window": None}
+    return {
+        "inactivity": KIND_INACTIVITY in kinds and inactivity_due(user, now),
+        "window":     decide_window(user, now) if KIND_WINDOW in kinds else None,
+    }
+
+
+def apply_evaluation(user: dict, kinds: set, now: datetime, evaluation: dict):
+    """Voert de beslissingen uit en plant de deadlines van het toestel opnieuw."""
+    try:
+        if evaluation["inactivity"]:
+            with engine_phase("inactivity"):
+                if send_inactivity_alert(user):
+                    user['last_inactivity_alert_ts'] = int(now.timestamp())
+        if evaluation["window"]:
+            with engine_phase("window"):
+                apply_window_decision(user, now, evaluation["window"])
+    finally:
+        schedule_device(user, now, fired=kinds)
+
+
+def load_users(device_ids) -> dict:
+    ids = list(device_ids)
+    users = {}
+    conn = get_db()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        c.execute(f"SELECT * FROM users WHERE device_id IN ({','.join('?' * len(chunk))})", chunk)
+        for row in c.fetchall():
+            users[row['device_id']] = registry.overlay(dict(row))
+    conn.close()
+    return users
+
+
+def process_device_event(device_id: str, kinds: set, now: datetime, user: dict | None = None):
+    """Verwerkt de verstreken deadlines van één toestel en plant opnieuw.
+
+    FCM wake-ups zijn dan al per batch verstuurd door de FcmDispatcher.
+    """
+    user = user or load_user(device_id)
+    if not user:
+        scheduler.cancel(device_id)
+        return
+    apply_evaluation(user, kinds, now, evaluate_device(user, kinds, now))
+
+
+# ============================================================
+#   SHARDED ENGINE
+#
+#   Met BARKR_ENGINE_SHARDS=N (N > 1) beoordelen N processen de
+#   verstreken deadlines, elk voor een vaste hash-shard van de
+#   device_ids (crc32 % N): een toestel komt nooit bij twee shards.
+#   Een shard leest zijn toestellen via een eigen read-only
+#   verbinding en stuurt alleen beslissingen terug; de engine blijft
+#   de enige die deadlines plant, berichten verstuurt en schrijft.
+#   Standaard (0/1) draait alles in het engine-proces zelf.
+# ============================================================
+
+ENGINE_SHARDS        = int(os.environ.get("BARKR_ENGINE_SHARDS", "0"))
+SHARD_TIMEOUT        = 30   # seconden voordat een shard als vastgelopen geldt
+SHARD_STATS_INTERVAL = 60   # seconden tussen de tick-statistieken per shard
+
+
+def shard_of(device_id: str, shards: int) -> int:
+    return zlib.crc32(device_id.encode()) % shards
+
+
+def _shard_main(index: int, tasks, results):
+    """Hoofdlus van een shard-proces (spawn: eigen interpreter, eigen pool)."""
+    global db_pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    db_pool = ConnectionPool(DB_FILE, size=2, readonly=True)
+    while True:
+        job = tasks.get()
+        if job is None:
+            return
+        tick, now_ts, items = job
+        now = datetime.fromtimestamp(now_ts)
+        started = time.perf_counter()
+        users = load_users(device_id for device_id, _kinds, _overlay in items)
+        loaded = time.perf_counter()
+        out = []
+        for device_id, kinds, overlay in items:
+            user = users.get(device_id)
+            evaluation = None
+            if user:
+                user.update(overlay)
+                try:
+                    evaluation = evaluate_device(user, kinds, now)
+                except Exception as e:
+                    evaluation = {"error": str(e)}
+            out.append((device_id, kinds, user, evaluation))
+        results.put((index, tick, out, loaded - started, time.perf_counter() - loaded))
+
+
+class ShardPool:
+    def __init__(self, shards: int):
+        self.shards = shards
+        self._ctx = multiprocessing.get_context("spawn")
+        self._results = self._ctx.Queue()
+        self._tasks: list = [None] * shards
+        self._procs: list = [None] * shards
+        self._tick = 0
+        self._stats = [[0, 0, 0.0, 0.0, 0.0] for _ in range(shards)]  # ticks, toestellen, laden, beoordelen, max
+        self._stats_since = time.time()
+        for i in range(shards):
+            self._start(i)
+        log_status(f"🧩 SHARDED ENGINE → {shards} processen")
+
+    def _start(self, i: int):
+        self._tasks[i] = self._ctx.Queue()
+        proc = self._ctx.Process(target=_shard_main, args=(i, self._tasks[i], self._results),
+                                 name=f"barkr-shard-{i}", daemon=True)
+        proc.start()
+        self._procs[i] = proc
+
+    def _restart(self, i: int):
+        log_status(f"⚠️ SHARD {i} reageert niet — herstart")
+        self._procs[i].kill()
+        self._procs[i].join(5)
+        self._start(i)
+
+    def evaluate(self, due: dict, overlays: dict, now: datetime) -> tuple[list, dict]:
+        """Verdeelt de verstreken deadlines over de shards.
+
+        Geeft (resultaten, niet-beoordeeld); de engine plant die laatste
+        opnieuw in zodat ze nooit door een andere shard beoordeeld worden.
+        """
+        self._tick += 1
+        batches: dict = {}
+        for device_id, kinds in due.items():
+            batches.setdefault(shard_of(device_id, self.shards), []).append(
+                (device_id, kinds, overlays.get(device_id, {})))
+        for i, items in batches.items():
+            self._tasks[i].put((self._tick, now.timestamp(), items))
+
+        results, waiting = [], set(batches)
+        deadline = time.time() + SHARD_TIMEOUT
+        while waiting:
+            try:
+                index, tick, out, load_s, eval_s = self._results.get(timeout=max(0.1, deadline - time.time()))
+            except Empty:
+                break
+            if tick != self._tick:
+                continue  # laat antwoord van een eerder vastgelopen shard
+            waiting.discard(index)
+            results.extend(out)
+            stats = self._stats[index]
+            stats[0] += 1
+            stats[1] += len(out)
+            stats[2] += load_s
+            stats[3] += eval_s
+            stats[4] = max(stats[4], load_s + eval_s)
+
+        failed = {}
+        for i in waiting:
+            self._restart(i)
+            failed.update((device_id, kinds) for device_id, kinds, _overlay in batches[i])
+        self._maybe_log()
+        return results, failed
+
+    def _maybe_log(self):
+        if time.time() - self._stats_since < SHARD_STATS_INTERVAL:
+            return
+        parts = []
+        for i, (ticks, devices, load_s, eval_s, worst) in enumerate(self._stats):
+            if ticks:
+                parts.append(f"#{i}: {ticks} ticks, {devices} toestellen, laden {load_s / ticks * 1000:.1f} ms, "
+                             f"beoordelen {eval_s / ticks * 1000:.1f} ms, max {worst * 1000:.1f} ms")
+        if parts:
+            log_status("🧩 SHARD TICKS → " + " | ".join(parts))
+        self._stats = [[0, 0, 0.0, 0.0, 0.0] for _ in range(self.shards)]
+        self._stats_since = time.time()
+
+    def close(self):
+        for i, proc in enumerate(self._procs):
+            if proc and proc.is_alive():
+                self._tasks[i].put(None)
+        for proc in self._procs:
+            if proc:
+                proc.join(2)
+
+
+def _ping_overlay(device_id: str) -> dict:
+    entry = registry.get(device_id)
+    if not entry:
+        return {}
+    return {key: entry.get(key) for key in ("user_name",) + _PING_FIELDS}
+
+
+def _handle_device_error(device_id: str, kinds: set, current_time: float, e: Exception):
+    log_status(f"⚠️ DEADLINE FOUT [dev:{device_id[:8]}]: {e}")
+    alert_developer("Deadline fout", f"{device_id[:8]}: {e}")
+    for kind in kinds:
+        scheduler.schedule(device_id, kind, current_time + FCM_RETRY_INTERVAL)
+
+
+ENGINE_STATS_WINDOW = 1000  # laatste passes voor /admin/stats
+ENGINE_SLOW_TICKS   = 50    # traagste passes met hun opbouw, voor /admin/ticks
+
+
+class TickLog:
+    """Opbouw per pass van de monitoring loop: recente passes en de traagste.
+
+    De fasen tellen op binnen een pass; "inactivity" en "window" vallen
+    binnen "deadlines".
+    """
+
+    def __init__(self, recent: int = ENGINE_STATS_WINDOW, slowest: int = ENGINE_SLOW_TICKS):
+        self._lock = threading.Lock()
+        self.recent: deque = deque(maxlen=recent)
+        self._slowest: list = []  # min-heap op duur, hooguit `slowest` groot
+        self._keep = slowest
+        self._seq = 0
+        self._phases: dict | None = None
+
+    def begin(self):
+        self._phases = {}
+
+    def add_phase(self, phase: str, seconds: float):
+        if self._phases is not None:
+            self._phases[phase] = self._phases.get(phase, 0.0) + seconds
+
+    def end(self, elapsed: float, due: int):
+        phases, self._phases = self._phases or {}, None
+        tick = {"ts": round(time.time(), 3), "ms": round(elapsed * 1000, 3), "due": due,
+                "phases": {k: round(v * 1000, 3) for k, v in phases.items()}}
+        with self._lock:
+            self._seq += 1
+            self.recent.append(tick)
+            entry = (elapsed, self._seq, tick)
+            if len(self._slowest) < self._keep:
+                heapq.heappush(self._slowest, entry)
+            elif elapsed > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self) -> list:
+        with self._lock:
+            return [tick for _e, _s, tick in sorted(self._slowest, reverse=True)]
+
+    def passes(self) -> list:
+        with self._lock:
+            return [(t["ms"] / 1000, t["due"]) for t in self.recent]
+
+
+tick_log = TickLog()
+
+
+@contextmanager
+def engine_phase(phase: str):
+    """Meet een fase van de engine: histogram voor /metrics en opbouw van de pass."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        ENGINE_PHASE_SECONDS.observe(elapsed, phase)
+        tick_log.add_phase(phase, elapsed)
+
+
+def monitoring_loop():
+    log_status("🚀 BARKR ENGINE v10.36 GESTART | Sleutel: device_id")
+    seed_scheduler()
+    last_reconcile = time.time()
+    current_day = None
+    shard_pool = ShardPool(ENGINE_SHARDS) if ENGINE_SHARDS > 1 else None
+    if shard_pool:
+        atexit.register(shard_pool.close)
+
+    while True:
+        pass_start = time.perf_counter()
+        tick_log.begin()
+        due: dict = {}
+        try:
+            current_time = time.time()
+
+            # Eens per dag (en bij opstart): alarmen van vandaag in geheugen,
+            # oude alarmpartities archiveren
+            today = datetime.now().date()
+            if today != current_day:
+                with engine_phase("daily"):
+                    current_day = today
+                    fired_alarms.reset(today.isoformat())
+                    log_status(f"🔔 ALARMSET {today.isoformat()} → {len(fired_alarms)} al afgehandeld")
+                    archive_alarm_partitions()
+
+            # Detecteer offline — alleen toestellen waarvan de timeout verstreek
+            with engine_phase("offline"):
+                presence.expire(current_time)
+
+            if current_time - last_reconcile >= RECONCILE_INTERVAL:
+                with engine_phase("reconcile"):
+                    reconcile_stale(current_time)
+                last_reconcile = current_time
+
+            due = scheduler.pop_due(current_time)
+            for kinds in due.values():
+                for kind in kinds:
+                    ENGINE_DEADLINES.inc(kind)
+            now = datetime.now()
+            evaluations: dict = {}
+            users: dict = {}
+            if due:
+                with engine_phase("load"):
+                    if shard_pool:
+                        overlays = {device_id: _ping_overlay(device_id) for device_id in due}
+                        results, failed = shard_pool.evaluate(due, overlays, now)
+                        users = {device_id: user for device_id, _kinds, user, _ev in results if user}
+                        evaluations = {device_id: ev for device_id, _kinds, _user, ev in results}
+                        for device_id, kinds in failed.items():
+                            due.pop(device_id, None)
+                            _handle_device_error(device_id, kinds, current_time, TimeoutError("shard reageert niet"))
+                    else:
+                        users = load_users(due.keys())
+
+            fcm_batch = [users[d] for d, kinds in due.items()
+                         if KIND_FCM in kinds and d in users and not users[d].get('vacation_mode')]
+            if fcm_batch:
+                with engine_phase("fcm"):
+                    fcm_dispatcher.dispatch(fcm_batch, now)
+
+            if due:
+                with engine_phase("deadlines"):
+                    for device_id, kinds in due.items():
+                        try:
+                            evaluation = evaluations.get(device_id)
+                            if evaluation is None:
+                                process_device_event(device_id, kinds, now, users.get(device_id))
+                            elif "error" in evaluation:
+                                raise RuntimeError(evaluation["error"])
+                            else:
+                                apply_evaluation(users[device_id], kinds, now, evaluation)
+                        except Exception as e:
+                            _handle_device_error(device_id, kinds, current_time, e)
+
+        except Exception as e:
+            log_status(f"⚠️ LOOP FOUT: {e}")
+            alert_developer("Loop crash", str(e))
+        finally:
+            elapsed = time.perf_counter() - pass_start
+            tick_log.end(elapsed, len(due))
+            ENGINE_PASS_SECONDS.observe(elapsed)
+
+        scheduler.wait(OFFLINE_CHECK_INTERVAL)
+
+
+# ============================================================
+#   PROFILER
+#
+#   Opt-in sampling profiler voor de engine en de request handlers.
+#   Een thread leest met PROFILE_HZ de stacks van alle threads uit
+#   (sys._current_frames), houdt alleen de engine- en request-threads
+#   die niet staan te wachten, en schrijft na N seconden een collapsed
+#   stack bestand (flamegraph.pl / speedscope) naar ~/barkr/profiles/.
+#   Starten: BARKR_PROFILE=<seconden> bij opstart van de engine, of
+#   POST /admin/profile {"secret": ..., "seconds": N}.
+# ============================================================
+
+PROFILE_DIR         = os.path.expanduser("~/barkr/profiles")
+PROFILE_HZ          = int(os.environ.get("BARKR_PROFILE_HZ", "100"))
+PROFILE_MAX_SECONDS = 600
+PROFILE_AT_START    = int(os.environ.get("BARKR_PROFILE", "0"))
+
+# Bovenste frames in deze modules betekenen: de thread wacht (geen CPU)
+_IDLE_MODULES = ("threading.py", "selectors.py", "socket.py", "queue.py", "ssl.py", "socketserver.py")
+_REQUEST_ENTRY = {"wsgi_app", "dispatch"}  # Flask/werkzeug, asyncio ingest
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = False
+        self.last_result: dict | None = None
+
+    def start(self, seconds: float) -> str | None:
+        """Start een meting; geeft het doelbestand, of None als er al een loopt."""
+        with self._lock:
+            if self.running:
+                return None
+            self.running = True
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"profile-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.collapsed")
+        threading.Thread(target=self._run, args=(min(seconds, PROFILE_MAX_SECONDS), path),
+                         name="profiler", daemon=True).start()
+        log_status(f"🔬 PROFILER GESTART → {seconds:g}s @ {PROFILE_HZ} Hz")
+        return path
+
+    @staticmethod
+    def _label(code) -> str:
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _role(self, thread_name: str, frames: list) -> str | None:
+        if thread_name == "engine":
+            return "engine"
+        if any(f.f_code.co_name in _REQUEST_ENTRY for f in frames):
+            return "request"
+        return None
+
+    def _run(self, seconds: float, path: str):
+        names = {}
+        stacks: dict = {}
+        samples = idle = 0
+        interval = 1.0 / max(1, PROFILE_HZ)
+        me = threading.get_ident()
+        deadline = time.perf_counter() + seconds
+        try:
+            while time.perf_counter() < deadline:
+                for thread in threading.enumerate():
+                    names[thread.ident] = thread.name
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    frames = []
+                    while frame is not None:
+                        frames.append(frame)
+                        frame = frame.f_back
+                    role = self._role(names.get(ident, ""), frames)
+                    if role is None:
+                        continue
+                    samples += 1
+                    if os.path.basename(frames[0].f_code.co_filename) in _IDLE_MODULES:
+                        idle += 1
+                        continue
+                    key = ";".join([role] + [self._label(f.f_code) for f in reversed(frames)])
+                    stacks[key] = stacks.get(key, 0) + 1
+                time.sleep(interval)
+            with open(path + ".tmp", "w") as f:
+                for key, count in sorted(stacks.items()):
+                    f.write(f"{key} {count}\n")
+            os.replace(path + ".tmp", path)
+            self.last_result = {"file": path, "seconds": seconds, "samples": samples, "idle": idle,
+                                "stacks": len(stacks)}
+            log_status(f"🔬 PROFIEL KLAAR → {path} | {samples - idle} actieve samples, {idle} wachtend")
+        except Exception as e:
+            log_status(f"⚠️ PROFILER FOUT: {e}")
+        finally:
+            with self._lock:
+                self.running = False
+
+
+profiler = SamplingProfiler()
+
+
+# ============================================================
+#   SERVING MODES
+#
+#   Ontwikkeling: `python3 pi_backend.py` draait alles in één proces.
+#   Productie: `gunicorn -c gunicorn.conf.py` start meerdere workers.
+#   Elke worker neemt heartbeats aan in zijn eigen register en schrijft
+#   die weg; precies één worker wint de engine-lock (flock) en draait de
+#   monitoring engine, outbox en FCM credentials. Sterft die worker,
+#   dan neemt een andere het binnen ENGINE_ELECTION_INTERVAL over.
+#   De engine leest pings en instellingen van de andere workers uit de
+#   database, zodat de presence en de deadlines één geheel blijven.
+# ============================================================
+
+ENGINE_LOCK_FILE         = os.path.expanduser("~/barkr/engine.lock")
+ENGINE_ELECTION_INTERVAL = 10  # seconden
+
+_multi_worker = False
+_engine_started = False  # alleen het engine-proces houdt deadlines bij
+_engine_lock_fd = None
+
+
+def try_become_engine() -> bool:
+    global _engine_lock_fd
+    import fcntl
+    fd = os.open(ENGINE_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    _engine_lock_fd = fd  # open houden: de lock leeft zo lang als dit proces
+    return True
+
+
+def start_engine():
+    global _engine_started
+    _engine_started = True
+    since_seq = load_startup_state() if _startup_seq is None else _startup_seq
+    try:
+        replay_journal(since_seq)
+    except Exception as e:
+        log_status(f"⚠️ JOURNAL TERUGSPELEN MISLUKT: {e}")
+    journal.open()
+    atexit.register(journal.close)
+    threading.Thread(target=journal_maintenance, name="journal", daemon=True).start()
+    if cluster:
+        cluster.join()
+        threading.Thread(target=cluster.run_member, name="cluster-member", daemon=True).start()
+    outbox.start()
+    fcm_credentials.start()
+    if _multi_worker:
+        threading.Thread(target=registry_sync_loop, name="registry-sync", daemon=True).start()
+    threading.Thread(target=monitoring_loop, name="engine", daemon=True).start()
+    if PROFILE_AT_START:
+        profiler.start(PROFILE_AT_START)
+
+
+SYNC_LOOKBACK = PING_WRITE_RESOLUTION + 2 * REGISTRY_FLUSH_INTERVAL
+
+
+def sync_from_db(ping_cursor: int, settings_cursor: int) -> tuple[int, int]:
+    """Haalt pings en instellingen op die andere workers hebben weggeschreven."""
+    conn = get_db()
+    c = conn.cursor()
+    # Workers schrijven pings met vertraging weg (flush-interval plus
+    # schrijfresolutie); kijk zover terug, merge_ping is idempotent
+    c.execute(f"SELECT device_id, user_name, {', '.join(_PING_FIELDS)} FROM users WHERE last_ping_ts >= ?",
+              (ping_cursor - SYNC_LOOKBACK,))
+    pings = c.fetchall()
+    c.execute("SELECT device_id, settings_updated_ts FROM users WHERE settings_updated_ts >= ?",
+              (settings_cursor,))
+    changed = c.fetchall()
+    conn.close()
+
+    # Zelfde seconde kan opnieuw langskomen; herplannen is idempotent
+    for device_id, updated_ts in changed:
+        settings_cursor = max(settings_cursor, updated_ts)
+        registry.load_device(device_id)
+        user = load_user(device_id)
+        if user:
+            schedule_device(user)
+
+    for device_id, user_name, ping_ts, unlocked_ts, window_ping_ts, window_unlocked_ts in pings:
+        ping_cursor = max(ping_cursor, ping_ts)
+        if registry.merge_ping(device_id, ping_ts, unlocked_ts, user_name, window_ping_ts, window_unlocked_ts):
+            journal.append(EV_PING, device_id, int(unlocked_ts == ping_ts), user_name, ping_ts)
+            touch_deadlines(device_id, ping_ts)
+        if not cluster:  # in een cluster volgt de presence het updatelog
+            presence.seen(device_id, ping_ts, user_name)
+    return ping_cursor, settings_cursor
+
+
+def registry_sync_loop():
+    ping_cursor = int(time.time()) - PING_TIMEOUT
+    settings_cursor = int(time.time())
+    while True:
+        time.sleep(REGISTRY_FLUSH_INTERVAL)
+        try:
+            ping_cursor, settings_cursor = sync_from_db(ping_cursor, settings_cursor)
+        except Exception as e:
+            log_status(f"⚠️ REGISTER SYNC FOUT: {e}")
+
+
+def engine_election_loop():
+    while not try_become_engine():
+        time.sleep(ENGINE_ELECTION_INTERVAL)
+    log_status(f"👑 ENGINE GEKOZEN → worker pid {os.getpid()}")
+    start_engine()
+
+
+def start_worker_services():
+    """Aangeroepen per gunicorn worker (post_worker_init)."""
+    global _multi_worker
+    _multi_worker = True
+    load_startup_state(keep_rows=False)
+    atexit.register(db_pool.close_all)
+    atexit.register(transport.close)
+    atexit.register(flush_on_shutdown)
+    threading.Thread(target=registry_writer, name="registry-writer", daemon=True).start()
+    if cluster:
+        threading.Thread(target=cluster.run_publisher, name="cluster-publish", daemon=True).start()
+    threading.Thread(target=engine_election_loop, name="engine-election", daemon=True).start()
+
+
+# ============================================================
+#   CLUSTER (meerdere nodes)
+#
+#   Optioneel: meerdere backend-nodes achter de tunnel. Elk toestel
+#   hoort via consistent hashing bij precies één node; alleen die
+#   node plant en beoordeelt zijn deadlines. Coördinatie loopt via
+#   een uitwisselbare CoordinationBackend:
+#     - lidmaatschap met lease (een node die stopt valt na de TTL af)
+#     - alarmclaims: een alarm wordt alleen verstuurd door de node die
+#       de claim wint, ook als het eigendom net wisselt
+#     - een updatelog van pings en instellingen, zodat elke node de
+#       toestellen kent die hij kan gaan overnemen
+#   SqliteCoordination is de lokale stand-in (gedeeld bestand op één
+#   host, voor tests); een netwerkbackend implementeert dezelfde API.
+#   Aanzetten met BARKR_CLUSTER_DB=/pad/naar/cluster.db.
+# ============================================================
+
+CLUSTER_DB               = os.environ.get("BARKR_CLUSTER_DB", "")
+CLUSTER_NODE_ID          = os.environ.get("BARKR_NODE_ID", f"{socket.gethostname()}:{HTTP_PORT}")
+CLUSTER_SYNC_INTERVAL    = 2    # seconden tussen publiceren/ophalen
+CLUSTER_LEASE_TTL        = 15   # seconden zonder verlenging → node valt af
+CLUSTER_VNODES           = 64   # virtuele punten per node op de ring
+CLUSTER_PING_RETENTION   = 3600 # seconden dat pings in het updatelog blijven
+CLUSTER_COMPACT_INTERVAL = 300
+CLUSTER_WINDOW_GRACE     = 3 * CLUSTER_SYNC_INTERVAL  # publiceren + ophalen + marge vóór een vensterbeslissing
+
+_CLUSTER_SETTINGS = ("device_id", "own_phone", "user_name", "contacts", "schedules",
+                     "vacation_mode", "notify_self", "fcm_token")
+
+
+class CoordinationBackend:
+    """Interface voor gedeelde coördinatie tussen nodes."""
+
+    def renew(self, node_id: str, ttl: float):
+        raise NotImplementedError
+
+    def leave(self, node_id: str):
+        raise NotImplementedError
+
+    def members(self) -> list:
+        raise NotImplementedError
+
+    def claim(self, key: str, node_id: str) -> bool:
+        """True voor precies één aanroeper per key."""
+        raise NotImplementedError
+
+    def append_updates(self, node_id: str, updates: list):
+        """updates: [(device_id, soort, payload-dict)] in één keer."""
+        raise NotImplementedError
+
+    def fetch_updates(self, cursor: int, limit: int = 5000) -> tuple[list, int]:
+        """Geeft ([(node_id, device_id, soort, payload)], nieuwe cursor)."""
+        raise NotImplementedError
+
+    def compact(self):
+        pass
+
+
+class SqliteCoordination(CoordinationBackend):
+    def __init__(self, path: str):
+        self.path = path
+        conn = self._connect()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS members (
+                node_id TEXT PRIMARY KEY, expires_at REAL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS alarm_claims (
+                claim_key TEXT PRIMARY KEY, node_id TEXT, claimed_at REAL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS device_updates (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, node_id TEXT, device_id TEXT,
+                kind TEXT, payload TEXT, created_at REAL)""")
+        conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _run(self, fn):
+        conn = self._connect()
+        try:
+            with conn:
+                return fn(conn)
+        finally:
+            conn.close()
+
+    def renew(self, node_id, ttl):
+        self._run(lambda c: c.execute("INSERT INTO members VALUES (?, ?) ON CONFLICT(node_id) DO UPDATE "
+                                      "SET expires_at=excluded.expires_at", (node_id, time.time() + ttl)))
+
+    def leave(self, node_id):
+        self._run(lambda c: c.execute("DELETE FROM members WHERE node_id=?", (node_id,)))
+
+    def members(self):
+        rows = self._run(lambda c: c.execute("SELECT node_id FROM members WHERE expires_at > ?",
+                                             (time.time(),)).fetchall())
+        return sorted(row[0] for row in rows)
+
+    def claim(self, key, node_id):
+        cur = self._run(lambda c: c.execute("INSERT OR IGNORE INTO alarm_claims VALUES (?, ?, ?)",
+                                            (key, node_id, time.time())))
+        return cur.rowcount == 1
+
+    def append_updates(self, node_id, updates):
+        now = time.time()
+        self._run(lambda c: c.executemany(
+            "INSERT INTO device_updates (node_id, device_id, kind, payload, created_at) VALUES (?,?,?,?,?)",
+            [(node_id, device_id, kind, json.dumps(payload), now) for device_id, kind, payload in updates]))
+
+    def fetch_updates(self, cursor, limit=5000):
+        rows = self._run(lambda c: c.execute(
+            "SELECT seq, node_id, device_id, kind, payload FROM device_updates WHERE seq > ? ORDER BY seq LIMIT ?",
+            (cursor, limit)).fetchall())
+        if not rows:
+            return [], cursor
+        return [(r[1], r[2], r[3], json.loads(r[4])) for r in rows], rows[-1][0]
+
+    def compact(self):
+        def run(c):
+            c.execute("DELETE FROM device_updates WHERE kind='ping' AND created_at < ?",
+                      (time.time() - CLUSTER_PING_RETENTION,))
+            c.execute("""DELETE FROM device_updates WHERE kind='settings' AND seq NOT IN (
+                             SELECT MAX(seq) FROM device_updates WHERE kind='settings' GROUP BY device_id)""")
+            c.execute("DELETE FROM alarm_claims WHERE claimed_at < ?", (time.time() - 7 * 86400,))
+            c.execute("DELETE FROM members WHERE expires_at < ?", (time.time() - 3600,))
+        self._run(run)
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes: int = CLUSTER_VNODES):
+        self.nodes = tuple(sorted(nodes))
+        points = sorted((self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._keys = [point for point, _node in points]
+        self._owners = [node for _point, node in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def owner(self, key: str) -> str | None:
+        if not self._keys:
+            return None
+        return self._owners[bisect.bisect(self._keys, self._hash(key)) % len(self._keys)]
+
+
+class ClusterNode:
+    def __init__(self, backend: CoordinationBackend, node_id: str):
+        self.backend = backend
+        self.node_id = node_id
+        self.ring = HashRing([node_id])
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._pings: dict = {}      # device_id → (ping_ts, unlocked_ts, naam), nog te publiceren
+        self._settings: set = set()
+        self._renames: list = []
+        self._seen: set | None = None  # tijdens join: toestellen met instellingen in het log
+
+    def owns(self, device_id: str) -> bool:
+        return self.ring.owner(device_id) in (None, self.node_id)
+
+    def claim(self, key: str) -> bool:
+        return self.backend.claim(key, self.node_id)
+
+    # --- publiceren (elk proces dat heartbeats aanneemt) -------------
+
+    def note_ping(self, device_id: str, ping_ts: int, unlocked: bool, user_name: str):
+        with self._lock:
+            last, unlocked_ts, name = self._pings.get(device_id, (0, 0, user_name))
+            self._pings[device_id] = (max(last, ping_ts), max(unlocked_ts, ping_ts if unlocked else 0),
+                                      user_name or name)
+
+    def note_settings(self, device_id: str):
+        with self._lock:
+            self._settings.add(device_id)
+
+    def note_rename(self, old_id: str, new_id: str):
+        with self._lock:
+            self._renames.append((old_id, new_id))
+            self._settings.add(new_id)
+
+    def publish(self) -> int:
+        """Zet verzamelde wijzigingen in één keer in het updatelog."""
+        with self._lock:
+            pings, self._pings = self._pings, {}
+            settings, self._settings = self._settings, set()
+            renames, self._renames = self._renames, []
+        # Volgorde: hernoemingen, dan instellingen, dan pings — een
+        # ontvangende node kent het toestel dan voordat de ping komt
+        updates = [(new_id, "rename", {"old": old_id}) for old_id, new_id in renames]
+        if settings:
+            conn = get_db()
+            conn.row_factory = sqlite3.Row
+            for device_id in settings:
+                row = conn.execute(f"SELECT {', '.join(_CLUSTER_SETTINGS)} FROM users WHERE device_id=?",
+                                   (device_id,)).fetchone()
+                if row:
+                    updates.append((device_id, "settings", dict(row)))
+            conn.close()
+        for device_id, (ping_ts, unlocked_ts, user_name) in pings.items():
+            # Het vensterbewijs gaat mee: samengevoegde pings verliezen anders
+            # een ping uit het venster als er daarna nog een kwam
+            entry = registry.get(device_id) or {}
+            updates.append((device_id, "ping", {"ts": ping_ts, "unlocked_ts": unlocked_ts, "name": user_name,
+                                                "window_ts": entry.get("window_ping_ts") or 0,
+                                                "window_unlocked_ts": entry.get("window_unlocked_ts") or 0}))
+        if updates:
+            self.backend.append_updates(self.node_id, updates)
+        return len(updates)
+
+    def run_publisher(self):
+        while True:
+            time.sleep(CLUSTER_SYNC_INTERVAL)
+            try:
+                self.publish()
+            except Exception as e:
+                log_status(f"⚠️ CLUSTER PUBLICEREN FOUT: {e}")
+
+    # --- lidmaatschap en eigendom (alleen de engine) -----------------
+
+    def _apply_settings(self, payload: dict):
+        conn = get_db()
+        with conn:
+            conn.execute(f"""INSERT INTO users ({', '.join(_CLUSTER_SETTINGS)}, schedule_packed, settings_updated_ts)
+                             VALUES ({', '.join('?' * len(_CLUSTER_SETTINGS))}, ?, ?)
+                             ON CONFLICT(device_id) DO UPDATE SET
+                             {', '.join(f'{col}=excluded.{col}' for col in _CLUSTER_SETTINGS[1:])},
+                             schedule_packed=excluded.schedule_packed,
+                             settings_updated_ts=excluded.settings_updated_ts""",
+                         [payload.get(col) for col in _CLUSTER_SETTINGS]
+                         + [compile_schedules(payload.get('schedules') or '{}'), int(time.time())])
+        conn.close()
+
+    def _apply_rename(self, old_id: str, new_id: str):
+        conn = get_db()
+        with conn:
+            conn.execute("UPDATE users SET device_id=?, settings_updated_ts=? WHERE device_id=?",
+                         (new_id, int(time.time()), old_id))
+        conn.close()
+        registry.rename(old_id, new_id)
+        scheduler.cancel(old_id)
+        presence.forget(old_id)
+
+    def pull(self) -> int:
+        """Past updates van alle nodes (ook de eigen) toe op register en planning."""
+        updates, self._cursor = self.backend.fetch_updates(self._cursor)
+        for node_id, device_id, kind, payload in updates:
+            if kind == "rename":
+                if node_id != self.node_id:
+                    self._apply_rename(payload["old"], device_id)
+            elif kind == "settings":
+                if self._seen is not None:
+                    self._seen.add(device_id)
+                if node_id != self.node_id:
+                    self._apply_settings(payload)
+                registry.load_device(device_id)
+                if self.owns(device_id):
+                    user = load_user(device_id)
+                    if user:
+                        schedule_device(user)
+            elif kind == "ping":
+                self._apply_ping(node_id, device_id, payload)
+        return len(updates)
+
+    def _apply_ping(self, node_id: str, device_id: str, payload: dict):
+        ping_ts, unlocked_ts = payload["ts"], payload["unlocked_ts"]
+        if node_id != self.node_id:
+            # Ping van een andere node: via het register ook in de eigen database
+            pings = [(device_id, ping_ts, False)] + ([(device_id, unlocked_ts, True)] if unlocked_ts else [])
+            if payload.get("window_ts"):
+                pings.append((device_id, payload["window_ts"], False))
+            if payload.get("window_unlocked_ts"):
+                pings.append((device_id, payload["window_unlocked_ts"], True))
+            if "applied" in registry.record_pings(pings):
+                journal.append(EV_PING, device_id, int(unlocked_ts == ping_ts), payload["name"], ping_ts)
+                touch_deadlines(device_id, ping_ts)
+        if self.owns(device_id):
+            presence.seen(device_id, ping_ts, payload["name"], source=f"node {node_id}")
+
+    def refresh_membership(self) -> bool:
+        """Verlengt de lease en herverdeelt als er nodes bij- of afgekomen zijn."""
+        self.backend.renew(self.node_id, CLUSTER_LEASE_TTL)
+        members = self.backend.members()
+        if self.node_id not in members:
+            members.append(self.node_id)
+        if tuple(sorted(members)) == self.ring.nodes:
+            return False
+        old_ring, self.ring = self.ring, HashRing(members)
+        self.rebalance(old_ring)
+        return True
+
+    def rebalance(self, old_ring: "HashRing"):
+        gained = lost = 0
+        for device_id in registry.device_ids():
+            was_mine = old_ring.owner(device_id) in (None, self.node_id)
+            mine = self.owns(device_id)
+            if mine and not was_mine:
+                user = load_user(device_id)
+                if user:
+                    schedule_device(user)
+                gained += 1
+            elif was_mine and not mine:
+                scheduler.cancel(device_id)
+                presence.forget(device_id)
+                lost += 1
+        log_status(f"⚖️ CLUSTER → nodes: {', '.join(self.ring.nodes)} | {gained} toestellen overgenomen, {lost} afgestaan")
+
+    def join(self):
+        """Eenmalig vóór de engine start: lease, ring en updatelog inhalen.
+
+        Toestellen die alleen in de eigen database staan (van vóór het
+        cluster) worden daarna gepubliceerd, zodat elke node ze kent.
+        """
+        self.backend.renew(self.node_id, CLUSTER_LEASE_TTL)
+        self.ring = HashRing(self.backend.members() or [self.node_id])
+        self._seen = set()
+        caught_up = 0
+        while True:
+            applied = self.pull()
+            caught_up += applied
+            if not applied:
+                break
+        unseen = [device_id for device_id in registry.device_ids() if device_id not in self._seen]
+        self._seen = None
+        for device_id in unseen:
+            self.note_settings(device_id)
+        log_status(f"🌐 CLUSTER NODE {self.node_id} → nodes: {', '.join(self.ring.nodes)} | "
+                   f"{caught_up} updates ingehaald, {len(unseen)} toestellen te publiceren")
+        atexit.register(self.backend.leave, self.node_id)
+
+    def run_member(self):
+        last_compact = time.time()
+        while True:
+            time.sleep(CLUSTER_SYNC_INTERVAL)
+            try:
+                self.refresh_membership()
+                self.pull()
+                if time.time() - last_compact >= CLUSTER_COMPACT_INTERVAL:
+                    self.backend.compact()
+                    last_compact = time.time()
+            except Exception as e:
+                log_status(f"⚠️ CLUSTER FOUT: {e}")
+
+
+cluster = ClusterNode(SqliteCoordination(CLUSTER_DB), CLUSTER_NODE_ID) if CLUSTER_DB else None
+
+
+def _tracks_states() -> bool:
+    """Houden de ingest-handlers de presence zelf bij? Alleen in één proces zonder cluster."""
+    return not _multi_worker and cluster is None
+
+
+# ============================================================
+#   ENDPOINTS
+# ============================================================
+
+@app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def _observe_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "onbekend"
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint, request.method)
+        HTTP_RESPONSES.inc(endpoint, response.status_code)
+    return response
+
+
+def is_local_request(remote_addr: str, headers) -> bool:
+    """Alleen rechtstreeks vanaf de Pi zelf; cloudflared verbindt ook via
+    localhost maar zet dan Cf-Connecting-Ip / X-Forwarded-For."""
+    return remote_addr in ("127.0.0.1", "::1") \
+        and not headers.get('cf-connecting-ip') and not headers.get('x-forwarded-for')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not is_local_request(request.remote_addr, request.headers):
+        return jsonify({"status": "error"}), 403
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/status', methods=['GET'])
+def status():
+    return jsonify({"status": "online", "version": "10.36", "db_pool": db_pool.metrics()}), 200
+
+
+def _pass_summary(passes: list) -> dict:
+    durations = sorted(d for d, _n in passes)
+    if not durations:
+        return {"passes": 0}
+    pick = lambda q: round(durations[min(len(durations) - 1, int(q * len(durations)))] * 1000, 3)
+    return {"passes": len(durations), "p50_ms": pick(0.50), "p99_ms": pick(0.99),
+            "max_ms": round(durations[-1] * 1000, 3), "devices": sum(n for _d, n in passes)}
+
+
+@app.route('/admin/stats', methods=['POST'])
+def admin_stats():
+    """Interne cijfers voor benchmarks en diagnose (alleen met secret)."""
+    data = request.get_json(silent=True)
+    if not data or not authenticate(data):
+        return jsonify({"status": "error"}), 403
+    passes = tick_log.passes()
+    conn = get_db()
+    outbox_counts = dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+    conn.close()
+    db_bytes = sum(os.path.getsize(DB_FILE + suffix) for suffix in ("", "-wal")
+                   if os.path.exists(DB_FILE + suffix))
+    return jsonify({
+        "engine":    bool(passes),
+        "devices":   len(registry),
+        "deadlines": len(scheduler),
+        "online":    presence.online_count(),
+        "state":     {s.name: s.stats() for s in state_stores},
+        "loop":      _pass_summary(passes),
+        "loop_busy": _pass_summary([p for p in passes if p[1]]),
+        "outbox":    outbox_counts,
+        "db_bytes":  db_bytes,
+        "db_pool":   db_pool.metrics(),
+    }), 200
+
+
+@app.route('/admin/profile', methods=['POST'])
+def admin_profile():
+    """Start de sampling profiler: {"secret": ..., "seconds": 30}."""
+    data = request.get_json(silent=True)
+    if not data or not authenticate(data):
+        return jsonify({"status": "error"}), 403
+    try:
+        seconds = float(data.get('seconds', 30))
+    except (TypeError, ValueError):
+        seconds = 0
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({"status": "error", "reason": f"seconds: 1–{PROFILE_MAX_SECONDS}"}), 400
+    path = profiler.start(seconds)
+    if path is None:
+        return jsonify({"status": "busy", "reason": "er loopt al een meting"}), 409
+    return jsonify({"status": "started", "file": path, "seconds": seconds,
+                    "previous": profiler.last_result}), 200
+
+
+@app.route('/admin/ticks', methods=['POST'])
+def admin_ticks():
+    """Opbouw van de traagste en de laatste passes van de monitoring loop."""
+    data = request.get_json(silent=True)
+    if not data or not authenticate(data):
+        return jsonify({"status": "error"}), 403
+    try:
+        count = max(1, min(int(data.get('recent', 20)), ENGINE_STATS_WINDOW))
+    except (TypeError, ValueError):
+        count = 20
+    recent = list(tick_log.recent)[-count:]
+    return jsonify({"slowest": tick_log.slowest(), "recent": recent,
+                    "profile": profiler.last_result, "profiling": profiler.running}), 200
+
+
+def _window_info(entry: dict) -> str:
+    start, end = todays_window_minutes(entry)
+    if start or end:
+        return f"{_minutes_to_hhmm(start)}–{_minutes_to_hhmm(end)}"
+    return "geen venster"
+
+
+def resolve_device(device_id: str, own_phone: str, user_name: str) -> dict | None:
+    """Zoekt het toestel op device_id, dan own_phone, dan naam."""
+    entry = registry.get(device_id) if device_id else None
+    if entry:
+        return entry
+    # Door een andere worker aangemaakt: eerst op device_id in de database,
+    # anders koppelt de alias hieronder een andere rij aan dit device_id
+    entry = registry.load_device(device_id) if device_id else None
+    if entry:
+        return entry
+
+    # Eerst de aliaskaart; de database alleen voor toestellen die dit
+    # proces nog niet kent (bijv. aangemaakt door een andere worker)
+    alias = registry.resolve_alias(own_phone, user_name)
+    if alias:
+        found_id, matched_by = alias
+    else:
+        conn_tmp = get_db()
+        c_tmp = conn_tmp.cursor()
+        row_tmp = None
+        matched_by = "device_id"
+        # Fallback: own_phone
+        if own_phone:
+            c_tmp.execute("SELECT device_id FROM users WHERE own_phone=? ORDER BY rowid DESC LIMIT 1", (own_phone,))
+            row_tmp = c_tmp.fetchone()
+            matched_by = "own_phone"
+        # Fallback: naam
+        if not row_tmp and user_name:
+            c_tmp.execute("SELECT device_id FROM users WHERE user_name=? ORDER BY rowid DESC LIMIT 1", (user_name,))
+            row_tmp = c_tmp.fetchone()
+            matched_by = "naam"
+        conn_tmp.close()
+        if not row_tmp:
+            return None
+        found_id = row_tmp[0]
+    # Als gevonden via andere sleutel: koppel device_id zodat volgende keer direct gevonden wordt
+    if device_id and found_id != device_id:
+        conn_fix = get_db()
+        c_fix = conn_fix.cursor()
+        c_fix.execute("UPDATE users SET device_id=?, settings_updated_ts=? WHERE device_id=?",
+                      (device_id, int(time.time()), found_id))
+        conn_fix.commit()
+        conn_fix.close()
+        registry.rename(found_id, device_id)
+        scheduler.cancel(found_id)
+        if cluster:
+            cluster.note_rename(found_id, device_id)
+        log_status(f"   🔗 Device_id bijgewerkt: {found_id[:8]} → {device_id[:8]} (gevonden via {matched_by})")
+        found_id = device_id
+    return registry.get(found_id) or registry.load_device(found_id)
+
+
+HEARTBEAT_IGNORED = {"status": "ignored", "reason": "geen device_id"}
+PING_IGNORED      = {"status": "ignored", "reason": "geen device_id of geldig nummer"}
+
+
+def heartbeat_fields(data):
+    """Leest een /heartbeat body uit. None = negeren (geen device_id)."""
+    device_id = (data.get('device_id') or '').strip()
+    own_phone = normalize_phone(data.get('own_phone', ''))
+    if not device_id:
+        # Fallback voor oude APK versies: gebruik own_phone als device_id
+        if own_phone and is_valid_phone(own_phone):
+            device_id = own_phone
+        else:
+            return None
+    return {
+        'device_id':     device_id,
+        'own_phone':     own_phone,
+        'user_name':     (data.get('name') or '').strip(),
+        'source':        data.get('source', 'unknown'),
+        'device_status': data.get('device_status', 'unknown'),
+        'received_at':   time.time(),
+    }
+
+
+def ping_fields(data):
+    """Leest een /ping body uit. None = negeren (geen device_id of nummer)."""
+    device_id = (data.get('device_id') or '').strip()
+    own_phone = normalize_phone(data.get('own_phone', ''))
+    if not device_id and (not own_phone or not is_valid_phone(own_phone)):
+        return None
+    return {
+        'device_id':   device_id,
+        'own_phone':   own_phone,
+        'user_name':   (data.get('name') or '').strip(),
+        'source':      data.get('source', 'webview'),
+        'received_at': time.time(),
+    }
+
+
+def _register_new_device(device_id, user_name, ping_ts, unlocked):
+    """Legt een onbekend toestel vast, inclusief de eerste ping, in één upsert."""
+    if device_id.startswith('web_'):
+        return False  # web sessies maken nooit een nieuw record aan
+    unlocked_ts = ping_ts if unlocked else 0
+    conn = get_db()
+    with conn:
+        conn.execute('''INSERT INTO users (device_id, user_name, contacts, schedules, schedule_packed,
+                            last_ping_ts, last_unlocked_ts, settings_updated_ts)
+                        VALUES (?, ?, '[]', '{}', ?, ?, ?, ?)
+                        ON CONFLICT(device_id) DO UPDATE SET
+                            user_name        = excluded.user_name,
+                            last_ping_ts     = MAX(last_ping_ts, excluded.last_ping_ts),
+                            last_unlocked_ts = MAX(last_unlocked_ts, excluded.last_unlocked_ts)''',
+                     (device_id, user_name, compile_schedules('{}'), ping_ts, unlocked_ts, int(time.time())))
+    conn.close()
+    if not registry.load_device(device_id):
+        return False
+    if cluster:
+        cluster.note_settings(device_id)
+    new_user = load_user(device_id)
+    if new_user:
+        schedule_device(new_user)
+    return True
+
+
+def apply_heartbeat(fields):
+    """Verwerkt een gevalideerde heartbeat (Flask én asyncio ingest)."""
+    device_id     = fields['device_id']
+    own_phone     = fields['own_phone']
+    user_name     = fields['user_name']
+    source        = fields['source']
+    device_status = fields['device_status']
+    current_time  = fields['received_at']
+    ping_ts       = int(current_time)
+
+    # Haal tijdvenster op voor logging — zoek op device_id, dan own_phone, dan naam
+    entry = resolve_device(device_id, own_phone, user_name)
+    window_info = "geen venster"
+    if entry:
+        window_info = _window_info(entry)
+    else:
+        log_status(f"   ⚠️ Geen instellingen gevonden voor device:{device_id[:8]} phone:{own_phone} naam:{user_name}")
+
+    if source == 'unknown':
+        source = 'webview'
+    status_icon = "🔓" if device_status == "unlocked" else "🔒"
+    status_txt = "IN GEBRUIK" if device_status == "unlocked" else "VERGRENDELD"
+    log_status(f"💓 {status_icon} PING -> {user_name} [dev:{device_id[:8]}] | {status_txt} | venster: {window_info} | bron: {source}",
+               event="ping", device_id=device_id, window=window_info, source=source, status=device_status)
+    if _tracks_states():
+        presence.seen(device_id, current_time, user_name, source=source)
+
+    # Ping en naam alleen in het register; de writer zet ze weg
+    unlocked = device_status == 'unlocked'
+    if not registry.record_ping(device_id, ping_ts, user_name, unlocked):
+        if _register_new_device(device_id, user_name, ping_ts, unlocked):
+            log_status(f"👤 NIEUWE GEBRUIKER → {user_name} [dev:{device_id[:8]}]")
+    journal.append(EV_PING, device_id, int(unlocked), user_name, current_time)
+    if cluster:
+        cluster.note_ping(device_id, ping_ts, unlocked, user_name)
+    touch_deadlines(device_id, current_time)
+
+
+def apply_ping(fields):
+    """Verwerkt een gevalideerde WebView ping (Flask én asyncio ingest)."""
+    device_id    = fields['device_id']
+    own_phone    = fields['own_phone']
+    user_name    = fields['user_name']
+    current_time = fields['received_at']
+    ping_ts      = int(current_time)
+
+    # Haal tijdvenster op voor logging — zoek op device_id, dan own_phone, dan naam
+    entry = resolve_device(device_id, own_phone, user_name)
+    window_info = "geen venster"
+    if entry:
+        window_info = _window_info(entry)
+        device_id = entry['device_id']
+    else:
+        log_status(f"   ⚠️ Geen instellingen gevonden voor device:{device_id[:8]} phone:{own_phone} naam:{user_name}")
+
+    log_status(f"💓 PING → {user_name} [dev:{device_id[:8]}] | venster: {window_info} | bron: {fields['source']}",
+               event="ping", device_id=device_id, window=window_info, source=fields['source'])
+    if _tracks_states() and device_id:
+        presence.seen(device_id, current_time, user_name, source="webview")
+
+    # WebView ping = gebruiker heeft toestel open = altijd IN GEBRUIK
+    if not registry.record_ping(device_id, ping_ts, user_name, unlocked=True) and device_id:
+        _register_new_device(device_id, user_name, ping_ts, True)
+    if device_id:
+        journal.append(EV_PING, device_id, 1, user_name, current_time)
+        if cluster:
+            cluster.note_ping(device_id, ping_ts, True, user_name)
+    touch_deadlines(device_id, current_time)
+
+
+@app.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    """Ontvangt telefoonnummer + naam. Pi bepaalt tijdvenster zelf."""
+    data = request.get_json(silent=True)
+    if not data or not authenticate(data):
+        return jsonify({"status": "error"}), 403
+
+    fields = heartbeat_fields(data)
+    if fields is None:
+        return jsonify(HEARTBEAT_IGNORED), 200
+    apply_heartbeat(fields)
+    return jsonify({"status": "received"}), 200
+
+
+HEARTBEAT_BATCH_MAX  = 500  # pings per /heartbeat/batch verzoek
+HEARTBEAT_MAX_SKEW   = 60   # seconden dat een client-tijdstempel vóór mag lopen
+
+
+def _batch_timestamp(value, now: float) -> int | None:
+    """Client-tijdstempel naar epoch-seconden (ook milliseconden); None = ongeldig."""
+    if value is None:
+        return int(now)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        return None
+    if value > 1e12:  # System.currentTimeMillis()
+        value /= 1000
+    if value > now + HEARTBEAT_MAX_SKEW:
+        return None
+    return int(min(value, now))
+
+
+@app.route('/heartbeat/batch', methods=['POST'])
+def heartbeat_batch():
+    """Meerdere pings in één verzoek (opgespaarde pings na Doze, relays).
+
+    Body: {"secret": ..., "heartbeats": [{device_id, timestamp, device_status, source}, ...]}
+    Alle pings worden in één keer op het register toegepast, last-write-wins
+    op timestamp; het antwoord bevat per ping het resultaat.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not authenticate(data):
+        return jsonify({"status": "error"}), 403
+    items = data.get('heartbeats')
+    if not isinstance(items, list):
+        return jsonify({"status": "error", "reason": "heartbeats ontbreekt"}), 400
+    if len(items) > HEARTBEAT_BATCH_MAX:
+        return jsonify({"status": "error", "reason": f"maximaal {HEARTBEAT_BATCH_MAX} per verzoek"}), 413
+
+    now = time.time()
+    results: list = [None] * len(items)
+    pings, positions = [], []
+    for i, item in enumerate(items):
+        raw_id = item.get('device_id') if isinstance(item, dict) else None
+        device_id = raw_id.strip() if isinstance(raw_id, str) else ''
+        ping_ts = _batch_timestamp(item.get('timestamp'), now) if device_id else None
+        if ping_ts is None:
+            results[i] = {"device_id": device_id, "result": "invalid"}
+            continue
+        pings.append((device_id, ping_ts, item.get('device_status') == 'unlocked'))
+        positions.append(i)
+
+    # Toestellen die een andere worker aanmaakte staan nog niet in dit
+    # register; eerst uit de database halen, net als bij /heartbeat
+    for device_id in {p[0] for p in pings}:
+        if not registry.get(device_id):
+            registry.load_device(device_id)
+
+    touched: set = set()
+    for (device_id, ping_ts, unlocked), i, result in zip(pings, positions, registry.record_pings(pings)):
+        results[i] = {"device_id": device_id, "result": result}
+        if result == "applied":
+            touched.add(device_id)
+            journal.append(EV_PING, device_id, int(unlocked), "", ping_ts)
+            if cluster:
+                cluster.note_ping(device_id, ping_ts, unlocked, "")
+
+    for device_id in touched:
+        entry = registry.get(device_id)
+        if not entry:
+            continue
+        ping_ts, name = entry['last_ping_ts'], entry['user_name']
+        touch_deadlines(device_id, ping_ts)
+        if _tracks_states():
+            presence.seen(device_id, ping_ts, name, source="batch")
+
+    counts: dict = {}
+    for r in results:
+        counts[r["result"]] = counts.get(r["result"], 0) + 1
+    log_status(f"💓 BATCH → {len(items)} pings | " + " ".join(f"{k}:{v}" for k, v in sorted(counts.items())),
+               event="batch", pings=len(items), results=counts)
+    return jsonify({"status": "received", "applied": counts.get("applied", 0), "results": results}), 200
+
+
+@app.route('/ping', methods=['POST'])
+def ping():
+    """Backward compatible endpoint voor WebView pings."""
+    data = request.get_json(silent=True)
+    if not data or not authenticate(data):
+        return jsonify({"status": "error"}), 403
 
+    fields = ping_fields(data)
+    if fields is None:
+        return jsonify(PING_IGNORED), 200
+    apply_ping(fields)
     return jsonify({"status": "received"}), 200
 
 
@@ -802,7 +4223,8 @@ def save_settings():
     own_phone = normalize_phone(data.get('ownPhone', ''))
     user_name = (data.get('name') or '').strip()
 
-    log_status(f"📥 SAVE_SETTINGS ONTVANGEN → naam:{user_name} device:{device_id[:8] if device_id else 'GEEN'} phone:{own_phone or 'GEEN'}")
+    log_status(f"📥 SAVE_SETTINGS ONTVANGEN → naam:{user_name} device:{device_id[:8] if device_id else 'GEEN'} phone:{own_phone or 'GEEN'}",
+               level="debug", event="settings", device_id=device_id)
 
     # Negeer lege web-browser sessies (geen naam, geen telefoon, geen contacten)
     if device_id and device_id.startswith('web_') and not user_name and not own_phone:
@@ -827,6 +4249,12 @@ def save_settings():
         'vacation_mode': data.get('vacationMode', False),
         'notify_self':  data.get('notifySelf', True),
     })
+    registry.load_device(device_id)
+    if cluster:
+        cluster.note_settings(device_id)
+    saved_user = load_user(device_id)
+    if saved_user:
+        schedule_device(saved_user)
 
     # Welkomstbericht sturen naar nieuwe contacten (eenmalig, geen opt-in nodig met TextMeBot)
     for contact in contacts:
@@ -835,7 +4263,7 @@ def save_settings():
         if not contact_phone or not is_valid_phone(contact_phone):
             continue
         already = is_opted_in(contact_phone)
-        log_status(f"🔍 CONTACT CHECK → {contact_name} ({contact_phone}) | al welkom gestuurd: {already}")
+        log_status(f"🔍 CONTACT CHECK → {contact_name} ({contact_phone}) | al welkom gestuurd: {already}", level="debug")
         if not already:
             msg = (
                 "\U0001f44b Hallo " + contact_name + "!\n\n"
@@ -843,16 +4271,10 @@ def save_settings():
                 "Barkr bewaakt het welzijn van " + user_name + ". Als " + user_name + " binnen een ingesteld tijdvenster niet actief is, ontvang jij automatisch een bericht.\n\n"
                 "Je hoeft niets te doen. \U0001f43e"
             )
-            def send_welcome(p=contact_phone, m=msg, cn=contact_name, un=user_name):
-                time.sleep(2)
-                ok = send_whatsapp(p, m, context=f"welcome:{p}")
-                if ok:
-                    register_opt_in(p, un)
-                    log_status(f"✅ WELKOMSTBERICHT VERSTUURD → {cn} ({p})")
-                else:
-                    log_status(f"❌ WELKOMSTBERICHT MISLUKT → {cn} ({p})")
-            import threading
-            threading.Thread(target=send_welcome, daemon=True).start()
+            outbox.enqueue(contact_phone, msg, context=f"welcome:{contact_phone}", kind="welcome",
+                           meta={"opted_in_by": user_name,
+                                 "label": f"WELKOMSTBERICHT VERSTUURD → {contact_name} ({contact_phone})"},
+                           dedupe=True)
 
     # Log alle opgeslagen instellingen
     schedules = data.get('schedules', {})
@@ -869,10 +4291,9 @@ def save_settings():
     vacation = "aan" if data.get('vacationMode', False) else "uit"
     contact_str = ", ".join([c.get('name','?') + "(" + normalize_phone(c.get('phone','')) + ")" for c in contacts]) if contacts else "geen"
 
-    log_status(f"💾 INSTELLINGEN OPGESLAGEN → {user_name} [dev:{device_id[:8]}]")
-    log_status(f"   📅 Vensters: {venster_str}")
-    log_status(f"   👤 Contacten: {contact_str}")
-    log_status(f"   🔔 Eigen melding: {notify} | 🏖️ Vakantie: {vacation}")
+    log_status(f"💾 INSTELLINGEN OPGESLAGEN → {user_name} [dev:{device_id[:8]}] | 📅 {venster_str} | 👤 {contact_str}"
+               f" | 🔔 eigen melding: {notify} | 🏖️ vakantie: {vacation}",
+               event="settings", device_id=device_id, window=venster_str, contacts=len(contacts))
     return jsonify({"status": "ok"}), 200
 
 
@@ -901,15 +4322,13 @@ def send_optin():
         f"Barkr bewaakt het welzijn van {user_name}. Als {user_name} binnen een ingesteld tijdvenster niet actief is, ontvang jij automatisch een bericht.\n\n"
         f"Je hoeft niets te doen — je staat nu automatisch als noodcontact geregistreerd. 🐾"
     )
-    ok = send_whatsapp(phone, msg, context=f"optin:{user_phone}")
-    if ok:
-        register_opt_in(phone, user_name)
-        if user_phone:
-            time.sleep(6)
-            send_whatsapp(user_phone,
-                f"✅ *Barkr*\n\nActivatiebericht verstuurd naar *{contact_name}*. 🐾",
-                context=f"confirm:{user_phone}")
-        return jsonify({"status": "sent"}), 200
+    # Opt-in registratie en bevestiging aan de gebruiker volgen na aflevering
+    msg_id = outbox.enqueue(phone, msg, context=f"optin:{user_phone}", kind="optin",
+                            meta={"opted_in_by": user_name, "contact_name": contact_name,
+                                  "confirm_to": user_phone,
+                                  "label": f"ACTIVATIEBERICHT VERSTUURD → {contact_name} ({normalize_phone(phone)})"})
+    if msg_id:
+        return jsonify({"status": "sent", "message_id": msg_id}), 200
     return jsonify({"status": "error"}), 500
 
 
@@ -919,14 +4338,23 @@ def test_contact():
     if not data:
         return jsonify({"status": "error"}), 400
     phone = data.get('phone', '')
-    ok = send_whatsapp(phone,
+    msg_id = outbox.enqueue(phone,
         f"🔔 *BARKR TEST*\n\nHallo {data.get('name','Contact')}! Uw nummer is actief als noodcontact.",
-        context="test")
-    return jsonify({"status": "success" if ok else "error"}), 200 if ok else 500
+        context="test", kind="test", meta={"label": f"TESTBERICHT VERSTUURD → {normalize_phone(phone)}"})
+    ok = msg_id is not None
+    return jsonify({"status": "success" if ok else "error", "message_id": msg_id}), 200 if ok else 500
 
 
 if __name__ == '__main__':
     init_db()
-    threading.Thread(target=monitoring_loop, daemon=True).start()
-    log_status("🌐 WEBSERVER GESTART OP POORT 5000")
-    app.run(host='0.0.0.0', port=5000)
+    # atexit draait in omgekeerde volgorde: eerst flushen, dan sluiten
+    atexit.register(db_pool.close_all)
+    atexit.register(transport.close)
+    atexit.register(flush_on_shutdown)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    threading.Thread(target=registry_writer, daemon=True).start()
+    if cluster:
+        threading.Thread(target=cluster.run_publisher, name="cluster-publish", daemon=True).start()
+    start_engine()
+    log_status(f"🌐 WEBSERVER GESTART OP POORT {HTTP_PORT} (ontwikkelserver — productie: gunicorn -c gunicorn.conf.py)")
+    app.run(host='0.0.0.0', port=HTTP_PORT)
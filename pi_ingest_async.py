@@ -0,0 +1,192 @@
+"""Asyncio ingest voor /heartbeat en /ping.
+
+    python3 pi_ingest_async.py            (poort 5001, of BARKR_ASYNC_PORT)
+
+Heartbeats zijn kleine JSON POSTs, elke 20 s per toestel. Eén event loop
+houdt duizenden keep-alive verbindingen open zonder een thread per
+verbinding. Verzoeken worden geparsed en geauthenticeerd in de loop en
+daarna doorgegeven aan één writer coroutine die ze in volgorde toepast
+(apply_heartbeat / apply_ping uit pi_backend). Request en response zijn
+gelijk aan de Flask endpoints; de overige endpoints blijven bij
+gunicorn. Laat de tunnel /heartbeat en /ping naar deze poort routeren.
+
+Dit proces doet mee als gewone worker (start_worker_services): eigen
+register met write-behind, en het kan als engine gekozen worden.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+
+import pi_backend as pb
+
+ASYNC_HOST         = os.environ.get("BARKR_ASYNC_HOST", "0.0.0.0")
+ASYNC_PORT         = int(os.environ.get("BARKR_ASYNC_PORT", "5001"))
+INGEST_QUEUE_SIZE  = 10000      # daarboven wacht de verbinding (backpressure)
+KEEPALIVE_TIMEOUT  = 75         # seconden stilte voordat een verbinding dicht gaat
+MAX_HEADER_LINES   = 100
+MAX_BODY           = 64 * 1024
+
+_REASONS = {200: "OK", 204: "No Content", 400: "Bad Request", 403: "Forbidden",
+            404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large"}
+_ENDPOINTS = {
+    '/heartbeat': (pb.heartbeat_fields, pb.apply_heartbeat, pb.HEARTBEAT_IGNORED),
+    '/ping':      (pb.ping_fields, pb.apply_ping, pb.PING_IGNORED),
+}
+
+
+def _response(status: int, body=None, headers: dict | None = None, keep_alive: bool = True) -> bytes:
+    """body: dict → JSON, bytes → platte tekst (Prometheus), None → leeg."""
+    if isinstance(body, bytes):
+        payload, content_type = body, "text/plain; version=0.0.4"
+    else:
+        payload = b"" if body is None else (json.dumps(body, separators=(',', ':')) + "\n").encode()
+        content_type = "application/json"
+    lines = [f"HTTP/1.1 {status} {_REASONS.get(status, 'OK')}",
+             "Access-Control-Allow-Origin: *",
+             f"Content-Length: {len(payload)}",
+             "Connection: " + ("keep-alive" if keep_alive else "close")]
+    if body is not None:
+        lines.append(f"Content-Type: {content_type}")
+    for name, value in (headers or {}).items():
+        lines.append(f"{name}: {value}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + payload
+
+
+class IngestServer:
+    """HTTP/1.1 keep-alive server met één writer coroutine."""
+
+    def __init__(self):
+        self.queue: asyncio.Queue | None = None
+        self.connections = 0
+        self.received = 0
+        self.applied = 0
+
+    async def serve(self, host: str = ASYNC_HOST, port: int = ASYNC_PORT):
+        self.queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+        writer = asyncio.create_task(self.writer_loop())
+        server = await asyncio.start_server(self.handle_connection, host, port,
+                                            backlog=1024, reuse_address=True)
+        pb.log_status(f"⚡ ASYNC INGEST GESTART OP POORT {port} (/heartbeat, /ping)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            writer.cancel()
+
+    async def writer_loop(self):
+        """Past updates één voor één toe, in volgorde van binnenkomst."""
+        loop = asyncio.get_running_loop()
+        while True:
+            apply, fields = await self.queue.get()
+            try:
+                if fields['device_id'] and pb.registry.get(fields['device_id']):
+                    # Bekend toestel: alleen register en deadlines, geen SQLite
+                    apply(fields)
+                else:
+                    # Onbekend toestel: DB opzoeken/aanmaken buiten de event loop
+                    await loop.run_in_executor(None, apply, fields)
+                self.applied += 1
+            except Exception as e:
+                pb.log_status(f"⚠️ Async ingest fout [dev:{fields['device_id'][:8]}]: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        peer = (writer.get_extra_info("peername") or ("",))[0]
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                if not request_line:
+                    break
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    writer.write(_response(400, {"status": "error"}, keep_alive=False))
+                    break
+                method, target, version = parts
+
+                headers = {}
+                for _ in range(MAX_HEADER_LINES):
+                    line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+                try:
+                    length = int(headers.get('content-length', '0'))
+                except ValueError:
+                    length = -1
+                if length < 0 or length > MAX_BODY or 'transfer-encoding' in headers:
+                    writer.write(_response(413 if length > MAX_BODY else 400, {"status": "error"}, keep_alive=False))
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                path = target.split('?', 1)[0]
+                start = time.perf_counter()
+                response = await self.dispatch(method, path, headers, body, keep_alive, peer)
+                endpoint = path if path in _ENDPOINTS or path in ('/status', '/metrics') else "onbekend"
+                pb.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint, method)
+                pb.HTTP_RESPONSES.inc(endpoint, int(response[9:12]))
+                writer.write(response)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def dispatch(self, method: str, path: str, headers: dict, body: bytes, keep_alive: bool,
+                       peer: str = "") -> bytes:
+        if method == 'OPTIONS':
+            # CORS preflight van de WebView, zoals flask_cors het beantwoordt
+            allow = {"Access-Control-Allow-Methods": "POST, OPTIONS"}
+            if 'access-control-request-headers' in headers:
+                allow["Access-Control-Allow-Headers"] = headers['access-control-request-headers']
+            return _response(200, None, allow, keep_alive)
+        if path == '/status' and method == 'GET':
+            return _response(200, {"status": "online", "ingest": "async", "connections": self.connections,
+                                   "received": self.received, "applied": self.applied,
+                                   "queued": self.queue.qsize()}, None, keep_alive)
+        if path == '/metrics' and method == 'GET':
+            if not pb.is_local_request(peer, headers):
+                return _response(403, {"status": "error"}, None, keep_alive)
+            return _response(200, pb.metrics.render().encode(), None, keep_alive)
+        endpoint = _ENDPOINTS.get(path)
+        if endpoint is None:
+            return _response(404, {"status": "error"}, None, keep_alive)
+        if method != 'POST':
+            return _response(405, {"status": "error"}, None, keep_alive)
+
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or not data or not pb.authenticate(data):
+            return _response(403, {"status": "error"}, None, keep_alive)
+
+        parse, apply, ignored = endpoint
+        fields = parse(data)
+        if fields is None:
+            return _response(200, ignored, None, keep_alive)
+        self.received += 1
+        await self.queue.put((apply, fields))
+        return _response(200, {"status": "received"}, None, keep_alive)
+
+
+if __name__ == '__main__':
+    pb.init_db()
+    pb.start_worker_services()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        asyncio.run(IngestServer().serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,47 @@
+"""Gedeelde opzet: pi_backend tegen een lege database in een tijdelijke HOME.
+
+De paden (~/barkr/...) worden bij het importeren vastgelegd, dus HOME
+moet gezet zijn vóór de import.
+"""
+import os
+import sys
+import tempfile
+import itertools
+
+os.environ["HOME"] = tempfile.mkdtemp(prefix="barkr-test-")
+os.environ.setdefault("BARKR_LOG_CONSOLE", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import pi_backend
+
+pi_backend.init_db()
+
+_ids = itertools.count(1)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    """pi_backend met een leeg register, lege planning en lege outbox."""
+    monkeypatch.setattr(pi_backend, "registry", pi_backend.DeviceRegistry())
+    monkeypatch.setattr(pi_backend, "scheduler", pi_backend.DeadlineScheduler())
+    conn = pi_backend.get_db()
+    with conn:
+        conn.execute("DELETE FROM users")
+        conn.execute("DELETE FROM outbox")
+    conn.close()
+    return pi_backend
+
+
+@pytest.fixture
+def make_user(backend):
+    """Maakt een toestel aan in de database (niet in het register)."""
+    def make(start="10:00", end="12:00", **fields):
+        n = next(_ids)
+        device_id = f"test-device-{n:020d}"
+        schedules = {str(day): {"startTime": start, "endTime": end} for day in range(7)}
+        backend.upsert_user(device_id, {"own_phone": f"3161{n:08d}", "user_name": f"Test {n}",
+                                        "schedules": backend.json.dumps(schedules), **fields})
+        return device_id
+    return make
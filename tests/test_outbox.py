@@ -0,0 +1,66 @@
+import time
+
+
+def _row(backend, msg_id):
+    conn = backend.get_db()
+    row = conn.execute("SELECT status, attempts, next_attempt FROM outbox WHERE id=?", (msg_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def test_claim_skips_rate_limited_recipient(backend):
+    queue = backend.OutboundQueue()
+    first = queue.enqueue("31600000001", "een", kind="test")
+    queue.enqueue("31600000001", "twee", kind="test")
+    other = queue.enqueue("31600000002", "drie", kind="test")
+
+    msg, _ = queue._claim()
+    assert msg[0] == first
+    assert _row(backend, first)[:2] == ("sending", 1)
+    msg, _ = queue._claim()
+    assert msg[0] == other
+    msg, wait = queue._claim()
+    assert msg is None and wait > 0
+
+
+def test_failed_delivery_is_retried_with_backoff(backend, monkeypatch):
+    monkeypatch.setattr(backend, "send_whatsapp", lambda *a, **k: False)
+    queue = backend.OutboundQueue()
+    msg_id = queue.enqueue("31600000003", "hallo", kind="test")
+
+    before = time.time()
+    queue._deliver(queue._claim()[0])
+    status, attempts, next_attempt = _row(backend, msg_id)
+    assert (status, attempts) == ("queued", 1)
+    assert next_attempt >= before + backend.OUTBOX_BACKOFF_BASE
+
+
+def test_delivery_gives_up_after_max_attempts(backend, monkeypatch):
+    monkeypatch.setattr(backend, "send_whatsapp", lambda *a, **k: False)
+    queue = backend.OutboundQueue()
+    msg_id = queue.enqueue("31600000004", "hallo", kind="test")
+    conn = backend.get_db()
+    with conn:
+        conn.execute("UPDATE outbox SET attempts=? WHERE id=?", (backend.OUTBOX_MAX_ATTEMPTS - 1, msg_id))
+    conn.close()
+
+    queue._deliver(queue._claim()[0])
+    assert _row(backend, msg_id)[:2] == ("failed", backend.OUTBOX_MAX_ATTEMPTS)
+
+
+def test_successful_delivery_is_marked_sent(backend, monkeypatch):
+    monkeypatch.setattr(backend, "send_whatsapp", lambda *a, **k: True)
+    queue = backend.OutboundQueue()
+    msg_id = queue.enqueue("31600000005", "hallo", kind="test")
+    queue._deliver(queue._claim()[0])
+    assert _row(backend, msg_id)[0] == "sent"
+
+
+def test_recover_requeues_stuck_sending_rows(backend):
+    queue = backend.OutboundQueue()
+    msg_id = queue.enqueue("31600000006", "hallo", kind="test")
+    queue._claim()                                  # 'sending', dan "crasht" het proces
+    assert _row(backend, msg_id)[0] == "sending"
+
+    assert backend.OutboundQueue().recover() == 1
+    assert _row(backend, msg_id)[0] == "queued"
@@ -0,0 +1,70 @@
+import time
+
+
+def _written_ping(backend, device_id):
+    conn = backend.get_db()
+    row = conn.execute("SELECT last_ping_ts FROM users WHERE device_id=?", (device_id,)).fetchone()
+    conn.close()
+    return row[0]
+
+
+def test_ping_within_resolution_waits_for_flush(backend, make_user):
+    device_id = make_user()
+    entry = backend.registry.load_device(device_id)
+    now = int(time.time())
+    backend.registry.record_ping(device_id, now - 5, entry["user_name"], False)
+    backend.registry.flush()                        # eerste ping: direct weg
+    backend.registry.record_ping(device_id, now, entry["user_name"], False)
+
+    assert backend.registry.flush() == 0            # binnen de resolutie: wacht
+    assert _written_ping(backend, device_id) == now - 5
+    assert backend.registry.flush(force=True) == 1  # afsluiten schrijft alles
+    assert _written_ping(backend, device_id) == now
+
+
+def test_ripe_pending_ping_is_flushed(backend, make_user):
+    device_id = make_user()
+    entry = backend.registry.load_device(device_id)
+    old = int(time.time()) - backend.PING_WRITE_RESOLUTION - 60
+    backend.registry.record_ping(device_id, old, entry["user_name"], False)
+    backend.registry.flush()
+    backend.registry.record_ping(device_id, old + 1, entry["user_name"], False)
+
+    assert backend.registry.flush() == 1            # ouder dan de resolutie
+    assert _written_ping(backend, device_id) == old + 1
+
+
+def test_rename_is_written_immediately(backend, make_user):
+    device_id = make_user()
+    entry = backend.registry.load_device(device_id)
+    backend.registry.record_ping(device_id, entry["last_ping_ts"] or 1, "Nieuwe naam", False)
+    assert backend.registry.flush() == 1
+
+
+def test_resolve_device_loads_from_database(backend, make_user):
+    """Een toestel van een andere worker: in de database, niet in het register."""
+    device_id = make_user()
+    conn = backend.get_db()
+    own_phone, user_name = conn.execute("SELECT own_phone, user_name FROM users WHERE device_id=?",
+                                        (device_id,)).fetchone()
+    conn.close()
+    assert backend.registry.get(device_id) is None
+
+    entry = backend.resolve_device(device_id, own_phone, user_name)
+    assert entry["device_id"] == device_id
+    assert backend.registry.get(device_id) is not None
+
+
+def test_resolve_device_prefers_device_id_over_phone_alias(backend, make_user):
+    older = make_user()
+    newer = make_user()
+    conn = backend.get_db()
+    (phone,) = conn.execute("SELECT own_phone FROM users WHERE device_id=?", (older,)).fetchone()
+    conn.close()
+    backend.registry.load_all()
+    backend.registry._devices.pop(newer)            # alleen in de database
+
+    # telefoonnummer van het oudere toestel, maar het device_id bestaat al
+    entry = backend.resolve_device(newer, phone, "")
+    assert entry["device_id"] == newer
+    assert backend.registry.get(older) is not None
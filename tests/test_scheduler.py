@@ -0,0 +1,39 @@
+def test_pop_due_returns_only_expired(backend):
+    s = backend.DeadlineScheduler()
+    s.schedule("a", "window", 100)
+    s.schedule("b", "window", 200)
+    assert s.pop_due(150) == {"a": {"window"}}
+    assert s.pop_due(250) == {"b": {"window"}}
+    assert len(s) == 0
+
+
+def test_postpone_moves_deadline_later(backend):
+    s = backend.DeadlineScheduler()
+    s.schedule("a", "inactivity", 100)
+    s.postpone("a", "inactivity", 300)
+    assert s.pop_due(200) == {}
+    assert len(s) == 1
+    assert s.pop_due(300) == {"a": {"inactivity"}}
+
+
+def test_postpone_without_deadline_does_nothing(backend):
+    s = backend.DeadlineScheduler()
+    s.postpone("a", "inactivity", 300)
+    assert len(s) == 0
+    assert s.pop_due(1000) == {}
+
+
+def test_schedule_earlier_advances_deadline(backend):
+    s = backend.DeadlineScheduler()
+    s.schedule("a", "window", 300)
+    s.schedule("a", "window", 100)
+    assert s.pop_due(150) == {"a": {"window"}}
+    assert s.pop_due(400) == {}
+
+
+def test_cancel_one_kind_keeps_the_others(backend):
+    s = backend.DeadlineScheduler()
+    s.schedule("a", "window", 100)
+    s.schedule("a", "fcm", 100)
+    s.cancel("a", "fcm")
+    assert s.pop_due(100) == {"a": {"window"}}
@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+
+
+def _at(hour, minute=0):
+    return datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+
+def _decide(backend, device_id, pings, decide_at):
+    entry = backend.registry.load_device(device_id)
+    for when, unlocked in pings:
+        backend.registry.record_ping(device_id, int(when.timestamp()), entry["user_name"], unlocked)
+    return backend.decide_window(backend.registry.get(device_id), decide_at)[0]
+
+
+def test_locked_pings_after_end_still_alarm(backend, make_user):
+    device_id = make_user("10:00", "12:00")
+    pings = [(_at(11), False), (_at(12, 30), False)]
+    assert _decide(backend, device_id, pings, _at(12, 41)) == backend.WINDOW_ALARM
+
+
+def test_unlock_in_window_survives_later_pings(backend, make_user):
+    device_id = make_user("10:00", "12:00")
+    pings = [(_at(11, 30), True), (_at(12, 30), True), (_at(12, 35), False)]
+    assert _decide(backend, device_id, pings, _at(12, 41)) == backend.WINDOW_ACTIVE
+
+
+def test_only_pings_after_end_is_unmonitored(backend, make_user):
+    device_id = make_user("10:00", "12:00")
+    pings = [(_at(12, 30), True)]
+    assert _decide(backend, device_id, pings, _at(12, 41)) == backend.WINDOW_UNMONITORED
+
+
+def test_no_decision_before_end(backend, make_user):
+    device_id = make_user("10:00", "12:00")
+    entry = backend.registry.load_device(device_id)
+    assert backend.decide_window(entry, _at(12) - timedelta(minutes=1)) is None